@@ -1,10 +1,21 @@
 from pathlib import Path
-from shiny import App, ui, render, reactive
-from search_engine import search_qdrant
+from shiny import App, ui, render, reactive, req
+from search_engine import SUMMARY_MAX_CONCURRENCY, SUMMARY_MODE, query_embedding_cache, retrieve_page, stream_card_summary, summarize_cards, render_result, format_summary
 import os
-from qdrant_client import QdrantClient
-from langchain_openai import OpenAIEmbeddings
-from unstructured_processing import process_files, clear_directory, delete_points_by_source_document
+import html
+import asyncio
+import shutil
+import tempfile
+from contextlib import aclosing
+from urllib.parse import parse_qs
+from caches import summary_cache
+from clients import get_ingestion_embedding_model, get_qdrant_client
+from qdrant_setup import DEFAULT_TENANT, validate_tenant
+from ingestion_queue import IngestionQueue
+from telemetry import get_logger, render_cache_metrics, render_metrics, start_periodic_summary
+from starlette.applications import Starlette
+from starlette.responses import PlainTextResponse
+from starlette.routing import Mount, Route
 from dotenv import load_dotenv
 
 
@@ -14,6 +25,8 @@ from dotenv import load_dotenv
 # load API keys
 load_dotenv()
 
+logger = get_logger(__name__)
+
 here = Path(__file__).parent
 
 app_ui = ui.page_fillable(
@@ -96,6 +109,9 @@ app_ui = ui.page_fillable(
             style="margin-top: 20px;"
         ),
 
+        # Progress of background ingestion jobs started from this session
+        ui.output_ui("ingestion_status"),
+
         # JavaScript to trigger search on Enter key press
         ui.tags.script(
             """
@@ -110,32 +126,88 @@ app_ui = ui.page_fillable(
             });
             """
         ),
+        # JavaScript to report result summaries as they scroll into view, so only those are generated
+        ui.tags.script(
+            """
+            const visibleCards = new Set();
+            const cardObserver = new IntersectionObserver(function(entries) {
+                const newlyVisible = entries
+                    .filter(entry => entry.isIntersecting && !visibleCards.has(entry.target.id))
+                    .map(entry => entry.target.id);
+                newlyVisible.forEach(id => visibleCards.add(id));
+                if (newlyVisible.length > 0) {
+                    Shiny.setInputValue('visible_cards', newlyVisible, {priority: 'event'});
+                }
+            });
+            new MutationObserver(function() {
+                document.querySelectorAll('.result-summary:not([data-observed])').forEach(function(element) {
+                    element.dataset.observed = 'true';
+                    cardObserver.observe(element);
+                });
+            }).observe(document.body, {childList: true, subtree: true});
+            """
+        ),
         ui.output_ui("search_results_section")
     )
 )
 
-# Initialize Qdrant client
-qdrant_client = QdrantClient(url='https://67be5618-eb3c-4be8-af45-490d7595393d.europe-west3-0.gcp.cloud.qdrant.io', 
-    api_key=os.getenv("QDRANT_API_KEY"))
-
-# Initialize OpenAI Embeddings
-embedding_model = OpenAIEmbeddings(openai_api_key=os.getenv("OPENAI_API_KEY"))
-
 UPLOAD_DIR = "uploads"
 OUTPUT_DIR = "output"
 TEMP_DIR = "temp_uploads"
 
 COLLECTION = "test_collection"
 
+# take each session's tenant from the ?tenant= URL parameter instead of DEFAULT_TENANT.
+# The parameter is not authenticated, so only enable this behind a proxy that sets it per team.
+TENANT_FROM_URL = os.getenv("TENANT_FROM_URL", "false").lower() in ("1", "true", "yes")
+
 def create_directory(directory):
     if not os.path.exists(directory):
         os.makedirs(directory)
 
+def session_tenant(url_search):
+    """Returns the tenant named in a session's URL query string, or None if the name is invalid."""
+    tenant = parse_qs(url_search.lstrip("?")).get("tenant", [DEFAULT_TENANT])[0]
+    try:
+        return validate_tenant(tenant)
+    except ValueError as e:
+        logger.warning("%s", e)
+        return None
+
+def tenant_directory(directory, tenant):
+    """Returns the tenant's subdirectory of an upload or output directory; the default tenant uses the directory itself."""
+    if tenant == DEFAULT_TENANT:
+        return directory
+    path = os.path.join(directory, tenant)
+    create_directory(path)
+    return path
+
 create_directory(UPLOAD_DIR)
 create_directory(OUTPUT_DIR)
 create_directory(TEMP_DIR)
 
+# Uploads are ingested by background workers so the session stays responsive
+ingestion_queue = IngestionQueue()
+
+def ingest_directory(batch_dir, progress, tenant=DEFAULT_TENANT):
+    # the ingestion stack is imported with the first upload, keeping it out of app startup
+    from unstructured_processing import process_files
+
+    try:
+        process_files(batch_dir, tenant_directory(OUTPUT_DIR, tenant), get_qdrant_client(), get_ingestion_embedding_model(), COLLECTION, progress=progress, tenant=tenant)
+    finally:
+        # clear this job's temporary files
+        shutil.rmtree(batch_dir, ignore_errors=True)
+
+# seconds between pushes of a streaming summary to the browser
+SUMMARY_STREAM_INTERVAL = float(os.getenv("SUMMARY_STREAM_INTERVAL", 0.1))
+
 def server(input, output, session):
+    # the tenant whose documents this session searches and uploads to
+    tenant = DEFAULT_TENANT
+    if TENANT_FROM_URL:
+        with reactive.isolate():
+            tenant = session_tenant(input[".clientdata_url_search"]())
 
     doc_types = reactive.Value(["PDF", "DOCX", "PPTX", "TXT"])
     sort_order = reactive.Value("Relevance")
@@ -231,34 +303,169 @@ def server(input, output, session):
         if sort_order:
             selected_sort_order.set(sort_order)
 
-    # Handle search queries when 'send_button' is clicked
-    @output
-    @render.ui
+    # the current query, its settings, the result cards shown so far and the cursor of the next page
+    search_state = reactive.Value(None)
+    # summary output id -> streaming state of the summaries of the current search's cards
+    summary_streams = {}
+    # at most SUMMARY_MAX_CONCURRENCY of the session's summaries stream at once; the rest wait their turn
+    summary_slots = asyncio.Semaphore(SUMMARY_MAX_CONCURRENCY)
+    search_count = 0
+
+    def add_cards(query, cards, first_index):
+        """Registers a summary output for each new result card.
+
+        Returns:
+            (summary output id, card) pairs.
+        """
+        added = []
+        for index, card in enumerate(cards, start=first_index):
+            card_id = f"summary_{search_count}_{index}"
+            # (text so far, finished), or None until the card has scrolled into view
+            summary = reactive.Value(None)
+            summary_streams[card_id] = {"query": query, "card": card, "summary": summary, "task": None}
+            output(id=card_id)(render_summary(summary, card))
+            added.append((card_id, card))
+        return added
+
+    def render_summary(summary, card):
+        @render.ui
+        def summary_output():
+            value = summary()
+            # the excerpt stands in for the summary until the first tokens arrive, and if it fails
+            if value is None or not value[0]:
+                if value is not None and value[1]:
+                    return ui.HTML(format_summary(card, None))
+                return ui.HTML(f"<span class='summary-pending'>{format_summary(card, None)}</span>")
+            text, finished = value
+            if not finished:
+                return ui.HTML(f"<span class='summary-streaming'>{html.escape(text)}</span>")
+            return ui.HTML(format_summary(card, text))
+        return summary_output
+
+    async def stream_summary(stream):
+        """Streams one card's summary into its output, pushing the text at most every SUMMARY_STREAM_INTERVAL seconds."""
+        text = ""
+        last_push = 0.0
+        loop = asyncio.get_running_loop()
+        # closed even when the task is cancelled, so its summary slot is released straight away
+        async with aclosing(stream_card_summary(stream["query"], stream["card"], semaphore=summary_slots)) as texts:
+            async for text in texts:
+                if loop.time() - last_push >= SUMMARY_STREAM_INTERVAL:
+                    last_push = loop.time()
+                    # the stream runs outside the session's task, so it takes the reactive lock to update the output
+                    async with reactive.lock():
+                        stream["summary"].set((text, False))
+                        await reactive.flush()
+        async with reactive.lock():
+            stream["summary"].set((text, True))
+            await reactive.flush()
+
+    async def summarize_together(streams):
+        """Summarizes several cards of one search with a single batched request and fills in their outputs."""
+        summaries = await summarize_cards(streams[0]["query"], [stream["card"] for stream in streams])
+        async with reactive.lock():
+            for stream, summary in zip(streams, summaries):
+                stream["summary"].set((summary or "", True))
+            await reactive.flush()
+
+    # Handle search queries when 'send_button' is clicked; retrieval is awaited, so other sessions keep running meanwhile
+    @reactive.effect
     @reactive.event(input.send_button)
-    def query_results():
+    async def run_search():
+        nonlocal search_count
         query = input.question_input().strip()
+        if not query:
+            search_state.set({"message": "Please enter a query."})
+            return
+        if tenant is None:
+            search_state.set({"message": "Unknown team. Please check the link you used to open the app."})
+            return
+
+        # drop the previous search's summaries, including any still being generated
+        for card_id, stream in summary_streams.items():
+            if stream["task"] is not None:
+                stream["task"].cancel()
+            output.remove(card_id)
+        summary_streams.clear()
+        search_count += 1
 
         # Use reactive values instead of input for settings from the modal
-        current_sort_order = sort_order()
-        enable_date_filter = date_filter_enabled()
-        start_date = date_range_start()
-        end_date = date_range_end()
-
-        current_doc_types = doc_types()
-
-        if query:
-            collection_name = COLLECTION
-            results = search_qdrant(query, collection_name, sort_order=current_sort_order, start_date=start_date, end_date=end_date, enable_date_filter=enable_date_filter, selected_doc_types=current_doc_types)
-
-            # Format and return results
-            if results:
-                # Wrap each result in a div with the search-result class
-                result_texts = results  # Results should be a list of summary strings
-                return ui.div([ui.div(ui.markdown(res), class_="search-result") for res in result_texts])
-            else:
-                return "No information found in the knowledge base."
-        else:
-            return "Please enter a query."
+        settings = {
+            "sort_order": sort_order(),
+            "enable_date_filter": date_filter_enabled(),
+            "start_date": date_range_start(),
+            "end_date": date_range_end(),
+            "selected_doc_types": doc_types(),
+            "tenant": tenant,
+        }
+        # an uncaught error in an effect would end the session, so it is shown in place of the results
+        try:
+            cards, cursor = await retrieve_page(query, COLLECTION, **settings)
+        except Exception as e:
+            logger.exception("Search failed: %s", e)
+            search_state.set({"message": "The search failed. Please try again."})
+            return
+        search_state.set({"query": query, "settings": settings, "cards": add_cards(query, cards, 0), "cursor": cursor})
+
+    # Fetch the next page when 'load_more' is clicked
+    @reactive.effect
+    @reactive.event(input.load_more)
+    async def load_more_results():
+        state = search_state()
+        if not state or not state.get("cursor"):
+            return
+        try:
+            cards, cursor = await retrieve_page(state["query"], COLLECTION, cursor=state["cursor"], **state["settings"])
+        except Exception as e:
+            logger.exception("Loading more results failed: %s", e)
+            # the cards already shown stay, with the message under them
+            search_state.set({**state, "error": "Could not load more results. Please try again."})
+            return
+        added = add_cards(state["query"], cards, len(state["cards"]))
+        search_state.set({**state, "cards": state["cards"] + added, "cursor": cursor, "error": None})
+
+    # Summaries are only generated for cards the browser reports as scrolled into view
+    @reactive.effect
+    @reactive.event(input.visible_cards)
+    def summarize_visible_cards():
+        streams = [summary_streams[card_id] for card_id in input.visible_cards() if card_id in summary_streams]
+        streams = [stream for stream in streams if stream["task"] is None]
+        if not streams:
+            return
+
+        # batched summaries come back as one JSON response, so they are not streamed
+        if SUMMARY_MODE == "batched":
+            task = asyncio.create_task(summarize_together(streams))
+            for stream in streams:
+                stream["task"] = task
+            return
+
+        for stream in streams:
+            stream["task"] = asyncio.create_task(stream_summary(stream))
+
+    # Cards are shown as soon as retrieval finishes; each summary fills in on its own
+    @output
+    @render.ui
+    def query_results():
+        state = search_state()
+        req(state)
+        if "message" in state:
+            return state["message"]
+
+        # Format and return results
+        if not state["cards"]:
+            return "No information found in the knowledge base."
+
+        # Wrap each result in a div with the search-result class
+        cards = [
+            ui.div(ui.markdown(render_result(card, str(ui.output_ui(card_id, inline=True, class_="result-summary")))), class_="search-result")
+            for card_id, card in state["cards"]
+        ]
+        if state.get("error"):
+            cards.append(ui.div(state["error"], class_="load-more"))
+        if state["cursor"]:
+            cards.append(ui.div(ui.input_action_button("load_more", "Load more", class_="btn-primary"), class_="load-more"))
+        return ui.div(cards)
 
     @render.image
     def search_icon():
@@ -306,30 +513,36 @@ def server(input, output, session):
     @reactive.effect
     @reactive.event(input.upload_button)
     def handle_upload():
-        print("entered handle_upload function")
+        logger.debug("entered handle_upload function")
         files = input.doc_upload()
-        print("uploaded files")
-        if files is not None:
-            # uploaded_files = []
-            for file_info in files:
-                input_path = os.path.join("uploads", file_info["name"])
-                temp_path = os.path.join(TEMP_DIR, file_info["name"])
-
-                if os.path.exists(input_path):
-                    show_duplicate_modal(input_path, temp_path, file_info)
-                else:
-                    upload_helper(input_path, temp_path, file_info)
+        logger.debug("uploaded files")
+        if files is not None and tenant is None:
+            ui.modal_remove()
+            ui.notification_show("Unknown team. Please check the link you used to open the app.", type="error")
+        elif files is not None:
+            upload_dir = tenant_directory(UPLOAD_DIR, tenant)
+            duplicates = [file_info for file_info in files if os.path.exists(os.path.join(upload_dir, file_info["name"]))]
+            if duplicates:
+                # hold the whole selection until the user decides, so it is still ingested in one run
+                pending_upload.update(files=list(files), duplicates=duplicates)
+                show_duplicate_modal(duplicates)
+            else:
+                upload_helper(files)
         else:
             ui.modal_remove()  # Hide the modal after upload
-    
+
+    # the selection waiting on the duplicate file modal
+    pending_upload = {"files": [], "duplicates": []}
+
     # function to either cancel or continue with the upload after duplicate files are detected
-    def show_duplicate_modal(input_path, temp_path, file_info):
-        print("entered display_modal")
-        
+    def show_duplicate_modal(duplicates):
+        logger.debug("entered display_modal")
+        names = ", ".join(file_info["name"] for file_info in duplicates)
+
         # create duplicate file modal for when duplicate files are detected
         duplicate_file_modal = ui.modal(
             ui.div(
-                "A file of the same name has already been uploaded. Uploading again will overwrite the previous file's contents. Proceed with the upload?"
+                f"Files of the same name have already been uploaded: {names}. Uploading again will overwrite the previous files' contents. Proceed with the upload?"
                 ),
             ui.tags.div(
                 ui.div(
@@ -344,39 +557,97 @@ def server(input, output, session):
         )
         ui.modal_show(duplicate_file_modal)
 
-        @reactive.effect  
-        @reactive.event(input.cancel_duplicate)  
-        def handle_cancel():  
-            print("clicked cancel")
+    @reactive.effect
+    @reactive.event(input.cancel_duplicate)
+    def handle_cancel_duplicate():
+        logger.debug("clicked cancel")
+        # the other files of the selection are still uploaded
+        duplicates = [file_info["name"] for file_info in pending_upload["duplicates"]]
+        files = [file_info for file_info in pending_upload["files"] if file_info["name"] not in duplicates]
+        pending_upload.update(files=[], duplicates=[])
+        if files:
+            upload_helper(files)
+        else:
             ui.modal_remove()
-        
-        @reactive.effect  
-        @reactive.event(input.upload_duplicate)  
-        def handle_upload():  
-            print("clicked upload")
-            delete_points_by_source_document(UPLOAD_DIR, COLLECTION, file_info["name"])
-            upload_helper(input_path, temp_path, file_info)
-
-    def upload_helper(input_path, temp_path, file_info):
-        print("entered upload helper")
-        # Read and write file data
-        with open(file_info["datapath"], "rb") as f:
-            file_data = f.read()
-        
-        with open(input_path, "wb") as f1, open(temp_path, 'wb') as f2:
-            f1.write(file_data)
-            f2.write(file_data)
-        
-        # uploaded_files.append(file_info["name"])
-        
-        # Process the uploaded file
-        process_files(TEMP_DIR, OUTPUT_DIR, qdrant_client, embedding_model, COLLECTION)
 
-        # clear temporary directory
-        clear_directory(TEMP_DIR)
+    @reactive.effect
+    @reactive.event(input.upload_duplicate)
+    def handle_upload_duplicate():
+        logger.debug("clicked upload")
+        # process_files syncs each file's chunks, so only changed chunks are re-embedded
+        files = pending_upload["files"]
+        pending_upload.update(files=[], duplicates=[])
+        if files:
+            upload_helper(files)
+        else:
+            ui.modal_remove()
+
+    def upload_helper(files):
+        """Saves the uploaded files and ingests them together in a single background job.
+
+        One process_files run partitions the files in parallel and packs their chunks into
+        shared embedding and upsert batches, rather than paying for a run per file.
+        """
+        logger.debug("entered upload helper")
+        # each job works in its own temporary directory so parallel jobs don't see each other's files
+        batch_dir = tempfile.mkdtemp(dir=TEMP_DIR)
+        upload_dir = tenant_directory(UPLOAD_DIR, tenant)
+
+        # copy in blocks rather than reading whole documents into memory
+        for file_info in files:
+            input_path = os.path.join(upload_dir, file_info["name"])
+            shutil.copyfile(file_info["datapath"], input_path)
+            shutil.copyfile(input_path, os.path.join(batch_dir, file_info["name"]))
+
+        # Process the uploaded files in the background
+        job = ingestion_queue.submit([file_info["name"] for file_info in files], lambda progress: ingest_directory(batch_dir, progress, tenant))
+        session_jobs.set(session_jobs() + [job.id])
 
         ui.modal_remove()  # Hide the modal after upload
-        show_upload_complete_modal()
+
+    # ids of the ingestion jobs started from this session
+    session_jobs = reactive.Value([])
+    notified_jobs = set()
+
+    @render.ui
+    def ingestion_status():
+        jobs = [job.snapshot() for job in map(ingestion_queue.get, session_jobs()) if job is not None]
+        active = [job for job in jobs if job["status"] not in ("done", "failed")]
+        if not active:
+            return None
+
+        # poll the background workers until every job has finished
+        reactive.invalidate_later(1)
+        items = []
+        for job in active:
+            status = job["status"].capitalize()
+            counts = job["progress"].get(job["status"])
+            if counts and counts[1]:
+                status += f" ({counts[0]}/{counts[1]})"
+            items.append(ui.tags.li(f"{', '.join(job['filenames'])}: {status}"))
+        return ui.tags.div(ui.tags.ul(*items), class_="ingestion-status", style="max-width: 800px; margin: 20px auto 0;")
+
+    @reactive.effect
+    def notify_finished_uploads():
+        jobs = [job.snapshot() for job in map(ingestion_queue.get, session_jobs()) if job is not None]
+        if any(job["status"] not in ("done", "failed") for job in jobs):
+            reactive.invalidate_later(1)
+
+        finished = [job for job in jobs if job["status"] in ("done", "failed") and job["id"] not in notified_jobs]
+        if not finished:
+            return
+        notified_jobs.update(job["id"] for job in finished)
+
+        failed = [job for job in finished if job["status"] == "failed"]
+        if failed:
+            ui.modal_show(ui.modal(
+                ui.tags.div(*[ui.p(f"{', '.join(job['filenames'])}: {job['error']}") for job in failed]),
+                title="Upload failed",
+                easy_close=True,
+                footer=None,
+            ))
+        else:
+            show_upload_complete_modal()
 
 
     # Handle search queries when 'send_button' is clicked
@@ -414,7 +685,21 @@ def server(input, output, session):
         ui.modal_remove()
 
 www_dir = Path(__file__).parent / "www"
-app = App(app_ui, server, static_assets=www_dir)
+shiny_app = App(app_ui, server, static_assets=www_dir)
+
+# p50/p95/p99 per search and ingestion stage, and cache hit/miss counters; a plain
+# function, so Starlette runs it on a worker thread while the cache stats read sqlite
+def metrics(request):
+    caches = {"query_embedding": query_embedding_cache.stats(), "summary": summary_cache.stats()}
+    return PlainTextResponse(render_metrics() + render_cache_metrics(caches))
+
+app = Starlette(routes=[
+    Route("/metrics", metrics),
+    Mount("/", app=shiny_app),
+])
+
+# optionally log the same summary every METRICS_LOG_INTERVAL seconds
+start_periodic_summary()
 
 if __name__ == "__main__":
-    app.run()
+    shiny_app.run()
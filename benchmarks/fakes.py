@@ -0,0 +1,206 @@
+import re
+import json
+import time
+import asyncio
+import hashlib
+import random
+import threading
+from collections import deque
+from types import SimpleNamespace
+
+import httpx
+import numpy as np
+import openai
+import orjson
+
+class FakeEmbeddings:
+    """Embedding model returning a deterministic unit vector per text, with optional per-request latency.
+
+    With tokens_per_minute set, requests beyond that quota over the last minute fail with a 429,
+    as the embeddings API does. Tokens are estimated at four characters each.
+    """
+
+    def __init__(self, dim=1536, latency=0.0, model="fake-embedding", tokens_per_minute=None):
+        self.dim = dim
+        self.latency = latency
+        self.model = model
+        self.tokens_per_minute = tokens_per_minute
+        self.requests = 0
+        self.rate_limited = 0
+        self._window = deque()
+        self._lock = threading.Lock()
+
+    def _check_quota(self, texts):
+        if not self.tokens_per_minute:
+            return
+        tokens = sum(len(text) // 4 + 1 for text in texts)
+        with self._lock:
+            now = time.monotonic()
+            while self._window and self._window[0][0] <= now - 60:
+                self._window.popleft()
+            used = sum(spent for _, spent in self._window)
+            if used + tokens > self.tokens_per_minute:
+                self.rate_limited += 1
+                retry_after = self._window[0][0] + 60 - now if self._window else 1.0
+                request = httpx.Request("POST", "https://api.openai.com/v1/embeddings")
+                response = httpx.Response(429, request=request, headers={"retry-after": f"{retry_after:.2f}"})
+                raise openai.RateLimitError("Rate limit reached for tokens per min", response=response, body=None)
+            self._window.append((now, tokens))
+
+    def _vector(self, text):
+        seed = int.from_bytes(hashlib.sha256(text.encode("utf-8")).digest()[:8], "little")
+        vector = np.random.default_rng(seed).standard_normal(self.dim).astype(np.float32)
+        return (vector / np.linalg.norm(vector)).tolist()
+
+    def embed_documents(self, texts):
+        self.requests += 1
+        self._check_quota(texts)
+        if self.latency:
+            time.sleep(self.latency)
+        return [self._vector(text) for text in texts]
+
+    def embed_query(self, text):
+        return self.embed_documents([text])[0]
+
+    async def aembed_documents(self, texts):
+        self.requests += 1
+        self._check_quota(texts)
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        return [self._vector(text) for text in texts]
+
+    async def aembed_query(self, text):
+        return (await self.aembed_documents([text]))[0]
+
+class LockedClient:
+    """Serializes every call to a client that is not thread-safe, such as Qdrant's ":memory:" mode.
+
+    Ingestion workers and search threads share one in-process store, so their calls have
+    to take turns.
+    """
+
+    def __init__(self, client):
+        self._client = client
+        self._lock = threading.RLock()
+
+    def __getattr__(self, name):
+        attribute = getattr(self._client, name)
+        if not callable(attribute):
+            return attribute
+
+        def call(*args, **kwargs):
+            with self._lock:
+                return attribute(*args, **kwargs)
+        return call
+
+class AsyncQdrantAdapter:
+    """Stands in for AsyncQdrantClient by running a synchronous client's calls on worker threads.
+
+    The in-process ":memory:" mode keeps a separate store per client, so search has to go
+    through the same client ingestion writes to. Wrap that client in a LockedClient, since
+    the worker threads call it concurrently.
+    """
+
+    def __init__(self, client):
+        self._client = client
+
+    def __getattr__(self, name):
+        method = getattr(self._client, name)
+
+        async def call(*args, **kwargs):
+            return await asyncio.to_thread(method, *args, **kwargs)
+        return call
+
+def _completion(content):
+    return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=content))])
+
+def _stream_chunk(content):
+    return SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=content))])
+
+class StubLLM:
+    """Drop-in for the OpenAI / AsyncOpenAI clients whose chat completions sleep for a fixed latency.
+
+    Installed with clients.set_client, one stub records every request made during a benchmark.
+    Calling the instance returns itself, so it can also stand in for the client classes.
+    """
+
+    def __init__(self, latency=0.5):
+        self.latency = latency
+        self.requests = 0
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self._create))
+
+    def __call__(self, *args, **kwargs):
+        return self
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+    async def _create(self, messages, stream=False, response_format=None, **kwargs):
+        self.requests += 1
+        content = f"Stub summary of {len(messages[-1]['content'])} characters of context."
+        if response_format:
+            # batched request: one summary per document id in the prompt
+            ids = re.findall(r"^Document (doc\d+):", messages[-1]["content"], flags=re.MULTILINE)
+            content = json.dumps({"summaries": [{"id": doc_id, "summary": f"Stub summary of {doc_id}."} for doc_id in ids]})
+        if stream:
+            return _StubStream(self._stream(content))
+        await asyncio.sleep(self.latency)
+        return _completion(content)
+
+    async def _stream(self, content):
+        # the first token arrives after a fifth of the latency, the rest are spread over the remainder
+        words = content.split(" ")
+        await asyncio.sleep(self.latency / 5)
+        for i, word in enumerate(words):
+            if i:
+                await asyncio.sleep(self.latency * 4 / 5 / (len(words) - 1))
+            yield _stream_chunk(word if i == 0 else " " + word)
+
+class _StubStream:
+    """Wraps the stub's token generator like openai.AsyncStream: iterable, and closable with async with."""
+
+    def __init__(self, chunks):
+        self._chunks = chunks
+
+    def __aiter__(self):
+        return self._chunks
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self._chunks.aclose()
+        return False
+
+WORDS = (
+    "research project language children cognition analysis data model results study team "
+    "experience python java budget quarter revenue policy design system customer report "
+    "meeting schedule contract invoice review update proposal network server storage"
+).split()
+
+def write_synthetic_corpus(directory, total_chunks, chunks_per_file=100, seed=0):
+    """Writes partition .json files that chunk_by_title turns into roughly total_chunks chunks.
+
+    Each chunk is a Title element followed by a ~700 character NarrativeText element, so
+    every title starts a new chunk and no text is combined across them.
+
+    Returns:
+        The names of the source documents the files stand in for.
+    """
+    rng = random.Random(seed)
+    filenames = []
+    for file_index in range(0, total_chunks, chunks_per_file):
+        filename = f"synthetic_{file_index // chunks_per_file:05d}.pdf"
+        elements = []
+        for chunk_index in range(min(chunks_per_file, total_chunks - file_index)):
+            metadata = {"filename": filename, "filetype": "application/pdf", "page_number": chunk_index // 4 + 1}
+            elements.append({"type": "Title", "element_id": f"{filename}-{chunk_index}-t", "text": f"Section {chunk_index}", "metadata": metadata})
+            text = " ".join(rng.choice(WORDS) for _ in range(100))
+            elements.append({"type": "NarrativeText", "element_id": f"{filename}-{chunk_index}-n", "text": text, "metadata": metadata})
+        with open(f"{directory}/{filename}.json", "wb") as f:
+            f.write(orjson.dumps(elements))
+        filenames.append(filename)
+    return filenames
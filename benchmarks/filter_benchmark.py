@@ -0,0 +1,188 @@
+import os
+import sys
+import json
+import time
+import random
+import argparse
+from datetime import datetime, timedelta
+
+import numpy as np
+
+# the benchmarks drive the app's own modules
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from benchmarks.run_benchmarks import RESULTS_DIR, git_commit, percentiles
+
+COLLECTION = "filter_benchmark_collection"
+
+FILETYPES = [
+    "application/pdf",
+    "application/vnd.openxmlformats-officedocument.wordprocessingml.document",
+    "application/vnd.openxmlformats-officedocument.presentationml.presentation",
+    "text/plain",
+]
+
+def load_points(client, args):
+    """Fills the benchmark collection with random vectors and app-shaped metadata.
+
+    Returns:
+        The filenames used, for filename filters.
+    """
+    from qdrant_client import models
+
+    rng = np.random.default_rng(0)
+    start = datetime(2024, 1, 1)
+    filenames = [f"document-{i}.pdf" for i in range(max(1, args.points // args.chunks_per_file))]
+    for offset in range(0, args.points, 1000):
+        count = min(1000, args.points - offset)
+        vectors = rng.standard_normal((count, args.dim), dtype=np.float32)
+        client.upsert(
+            collection_name=COLLECTION,
+            points=[
+                models.PointStruct(
+                    id=offset + i,
+                    vector=vectors[i].tolist(),
+                    payload={
+                        "content": f"chunk {offset + i}",
+                        "metadata": {
+                            "filename": filenames[(offset + i) // args.chunks_per_file % len(filenames)],
+                            # skewed so some document types are rare, as in a real repository
+                            "filetype": FILETYPES[min(len(FILETYPES) - 1, int(rng.exponential(0.7)))],
+                            "date_added": (start + timedelta(minutes=int(rng.integers(0, 60 * 24 * 365)))).isoformat(),
+                            # whole files belong to one tenant
+                            "tenant": f"tenant-{(offset + i) // args.chunks_per_file % args.tenants}",
+                        },
+                    },
+                )
+                for i in range(count)
+            ],
+        )
+    return filenames
+
+def query_filters(filenames):
+    """The filters the app issues: document type, date range, both, a single filename, and a tenant."""
+    from qdrant_client import models
+    from qdrant_setup import tenant_condition
+
+    doc_type = models.FieldCondition(key="metadata.filetype", match=models.MatchAny(any=[FILETYPES[-1]]))
+    date_range = models.FieldCondition(
+        key="metadata.date_added",
+        range=models.DatetimeRange(gte="2024-03-01T00:00:00", lte="2024-03-07T23:59:59"),
+    )
+    filename = models.FieldCondition(key="metadata.filename", match=models.MatchValue(value=random.choice(filenames)))
+    return {
+        "filetype": models.Filter(must=[doc_type]),
+        "date_range": models.Filter(must=[date_range]),
+        "filetype_and_date": models.Filter(must=[doc_type, date_range]),
+        "filename": models.Filter(must=[filename]),
+        "tenant": models.Filter(must=[tenant_condition("tenant-0")]),
+    }
+
+def wait_until_green(client, timeout):
+    """Waits for the collection's optimizers and index builds to finish, so timings measure the finished collection."""
+    from qdrant_client import models
+
+    deadline = time.monotonic() + timeout
+    while client.get_collection(COLLECTION).status != models.CollectionStatus.GREEN:
+        if time.monotonic() > deadline:
+            raise TimeoutError(f"{COLLECTION} did not reach green within {timeout:.0f}s")
+        time.sleep(1)
+
+def time_filtered_queries(client, filters, filenames, args):
+    """Runs each filtered search args.queries times and returns latency percentiles per filter.
+
+    Also times args.queries exact counts of random files' points, as deleting a document does.
+    """
+    from qdrant_client import models
+    from qdrant_setup import search_params
+
+    rng = np.random.default_rng(1)
+    results = {}
+    for name, query_filter in filters.items():
+        latencies = []
+        for _ in range(args.queries):
+            vector = rng.standard_normal(args.dim, dtype=np.float32).tolist()
+            start = time.perf_counter()
+            client.search(
+                collection_name=COLLECTION,
+                query_vector=vector,
+                limit=15,
+                search_params=search_params("default"),
+                query_filter=query_filter,
+                with_payload=False,
+            )
+            latencies.append(time.perf_counter() - start)
+        results[name] = percentiles(latencies)
+
+    # deleting a document selects its points by filename
+    latencies = []
+    for _ in range(args.queries):
+        count_filter = models.Filter(must=[
+            models.FieldCondition(key="metadata.filename", match=models.MatchValue(value=random.choice(filenames))),
+        ])
+        start = time.perf_counter()
+        client.count(COLLECTION, count_filter=count_filter, exact=True)
+        latencies.append(time.perf_counter() - start)
+    results["filename_count"] = percentiles(latencies)
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description="Filtered-search latency before and after adding payload indexes.")
+    parser.add_argument("--url", default=os.getenv("QDRANT_URL", "http://localhost:6333"),
+                        help="Qdrant server to benchmark against (the in-process mode ignores payload indexes)")
+    parser.add_argument("--prefer-grpc", action="store_true", help="talk to Qdrant over gRPC instead of REST")
+    parser.add_argument("--points", type=int, default=200_000)
+    parser.add_argument("--chunks-per-file", type=int, default=50)
+    parser.add_argument("--dim", type=int, default=1536)
+    parser.add_argument("--tenants", type=int, default=10, help="tenants the files are spread over")
+    parser.add_argument("--queries", type=int, default=200, help="searches timed per filter")
+    parser.add_argument("--green-timeout", type=float, default=1800, help="seconds to wait for indexing to finish before each phase")
+    parser.add_argument("--output", help="result file (default: benchmarks/results/filters-<commit>.json)")
+    args = parser.parse_args()
+
+    from qdrant_client import QdrantClient, models
+    import clients
+    import qdrant_setup
+
+    client = QdrantClient(location=args.url, api_key=os.getenv("QDRANT_API_KEY"), prefer_grpc=args.prefer_grpc, timeout=120)
+    if client.collection_exists(COLLECTION):
+        client.delete_collection(COLLECTION)
+    client.create_collection(
+        collection_name=COLLECTION,
+        vectors_config=models.VectorParams(size=args.dim, distance=models.Distance.COSINE),
+    )
+
+    print(f"Loading {args.points} points into {args.url} ...")
+    filenames = load_points(client, args)
+    filters = query_filters(filenames)
+
+    # both phases start once the optimizers have finished, so only the payload indexes differ
+    wait_until_green(client, args.green_timeout)
+    before = time_filtered_queries(client, filters, filenames, args)
+    clients.set_client("qdrant", client)
+    qdrant_setup.create_payload_indexes(COLLECTION)
+    wait_until_green(client, args.green_timeout)
+    after = time_filtered_queries(client, filters, filenames, args)
+    client.delete_collection(COLLECTION)
+
+    for name in before:
+        print(f"{name:>18}: p50 {before[name]['p50'] * 1000:7.1f} ms -> {after[name]['p50'] * 1000:7.1f} ms, "
+              f"p99 {before[name]['p99'] * 1000:7.1f} ms -> {after[name]['p99'] * 1000:7.1f} ms")
+
+    commit = git_commit()
+    report = {
+        "commit": commit,
+        "timestamp": datetime.now().isoformat(),
+        "parameters": vars(args),
+        "without_indexes": before,
+        "with_indexes": after,
+    }
+    output = args.output or os.path.join(RESULTS_DIR, f"filters-{commit}.json")
+    os.makedirs(os.path.dirname(output), exist_ok=True)
+    with open(output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"Results written to {output}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,329 @@
+import os
+import sys
+import json
+import time
+import uuid
+import re
+import random
+import asyncio
+import argparse
+import tempfile
+import threading
+from datetime import datetime
+
+import numpy as np
+
+# the load test drives the app's own modules
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from benchmarks.run_benchmarks import RESULTS_DIR, git_commit, percentiles
+
+# outputs the simulated browser reports as visible, so the server renders them
+VISIBLE_OUTPUTS = ["search_results_section", "query_results", "ingestion_status"]
+
+class LoopMonitor:
+    """Measures how long the server's event loop is blocked.
+
+    A heartbeat task sleeps for a fixed interval; any extra time it takes to wake up is
+    time the loop spent running something else without yielding.
+    """
+
+    def __init__(self, interval=0.01):
+        self.interval = interval
+        self.reset()
+
+    def reset(self):
+        self.lags = []
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            start = loop.time()
+            await asyncio.sleep(self.interval)
+            self.lags.append(max(0.0, loop.time() - start - self.interval))
+
+    def summary(self, wall_seconds):
+        blocked = sum(self.lags)
+        return {
+            "max_lag_seconds": max(self.lags, default=0.0),
+            "p99_lag_seconds": float(np.percentile(self.lags, 99)) if self.lags else 0.0,
+            "blocked_seconds": blocked,
+            "blocked_fraction": blocked / wall_seconds if wall_seconds else 0.0,
+        }
+
+def install_stand_ins(args, workdir):
+    """Points the app at an in-process Qdrant, fake embeddings, a stub LLM and a fake partitioner.
+
+    Returns:
+        The imported app module and the chunk texts used as search queries.
+    """
+    from qdrant_client import QdrantClient, models
+    from caches import QueryEmbeddingCache, SummaryCache
+    from embedding_store import EmbeddingStore
+    from lexical_index import LexicalIndex
+    from benchmarks.fakes import AsyncQdrantAdapter, FakeEmbeddings, LockedClient, StubLLM, write_synthetic_corpus
+
+    # app.py creates its upload/output directories relative to the working directory
+    os.chdir(workdir)
+    import app
+    import clients
+    import search_engine
+    import unstructured_processing
+
+    # ingestion threads and search threads share the in-process store
+    qdrant = LockedClient(QdrantClient(":memory:"))
+    qdrant.create_collection(
+        collection_name=app.COLLECTION,
+        vectors_config=models.VectorParams(size=args.dim, distance=models.Distance.COSINE),
+    )
+    embeddings = FakeEmbeddings(dim=args.dim, latency=args.embedding_latency)
+
+    clients.set_client("qdrant", qdrant)
+    clients.set_client("async_qdrant", AsyncQdrantAdapter(qdrant))
+    clients.set_client("async_embeddings", embeddings)
+    clients.set_client("ingestion_embeddings", embeddings)
+    clients.set_client("async_openai", StubLLM(latency=args.llm_latency))
+    search_engine.query_embedding_cache = QueryEmbeddingCache()
+    search_engine.summary_cache = SummaryCache()
+    unstructured_processing.embedding_store = EmbeddingStore(os.path.join(workdir, "embedding_store"))
+    index = LexicalIndex(os.path.join(workdir, "lexical_index"))
+    unstructured_processing.lexical_index = index
+    search_engine.lexical_index = index
+
+    # stand-in for Unstructured: sleep, then write synthetic partition JSON for each document
+    def fake_preprocess(input_dir, output_dir, files=None, backend=None, reprocess=False):
+        time.sleep(args.partition_latency)
+        for name in files or os.listdir(input_dir):
+            corpus_dir = tempfile.mkdtemp(dir=workdir)
+            write_synthetic_corpus(corpus_dir, args.upload_chunks, chunks_per_file=args.upload_chunks, seed=hash(name))
+            with open(os.path.join(corpus_dir, os.listdir(corpus_dir)[0])) as f:
+                elements = json.load(f)
+            for element in elements:
+                element["metadata"]["filename"] = name
+            with open(unstructured_processing.partition_output_path(output_dir, name), "w") as f:
+                json.dump(elements, f)
+        return True
+
+    unstructured_processing.preprocess_documents = fake_preprocess
+
+    # seed the collection the searches run against
+    corpus_dir = os.path.join(workdir, "seed")
+    os.makedirs(corpus_dir)
+    filenames = write_synthetic_corpus(corpus_dir, args.corpus_chunks)
+    docs = unstructured_processing.iter_documents(unstructured_processing.iter_chunks(corpus_dir))
+    docs = unstructured_processing.tag_file_hashes(docs, {name: f"hash-{name}" for name in filenames})
+    unstructured_processing.store_chunks(docs, embeddings, qdrant, app.COLLECTION)
+
+    records, _ = qdrant.scroll(app.COLLECTION, limit=args.corpus_chunks, with_payload=["content"])
+    return app, [record.payload["content"] for record in records]
+
+def start_server(asgi_app, port, monitor):
+    """Serves the app with uvicorn on a background thread and starts the loop monitor on its loop."""
+    import uvicorn
+
+    server = uvicorn.Server(uvicorn.Config(asgi_app, host="127.0.0.1", port=port, log_level="warning", ws_max_size=64 * 1024 * 1024))
+    loop = asyncio.new_event_loop()
+    thread = threading.Thread(target=loop.run_until_complete, args=(server.serve(),), daemon=True)
+    thread.start()
+    while not server.started:
+        time.sleep(0.05)
+    asyncio.run_coroutine_threadsafe(monitor.run(), loop)
+    return server
+
+class SimulatedSession:
+    """One browser session speaking Shiny's websocket protocol."""
+
+    def __init__(self, base_url, queries):
+        self.base_url = base_url
+        self.queries = queries
+        self.clicks = {"send_button": 0, "upload_button": 0}
+        self.tag = 0
+        self.ws = None
+
+    async def connect(self):
+        import websockets
+
+        self.ws = await websockets.connect(self.base_url.replace("http", "ws") + "/websocket/", max_size=None)
+        inputs = {"question_input": "", "send_button:shiny.action": 0, "upload_button:shiny.action": 0}
+        inputs.update({f".clientdata_output_{name}_hidden": False for name in VISIBLE_OUTPUTS})
+        await self.ws.send(json.dumps({"method": "init", "data": inputs}))
+        await self._receive_until(lambda message: "config" in message)
+
+    async def close(self):
+        await self.ws.close()
+
+    async def search(self, visible_cards):
+        """Runs one search and waits for the summaries of the first visible_cards cards.
+
+        Returns:
+            The seconds until the result cards arrived and until their visible summaries did.
+        """
+        start = time.perf_counter()
+        self.clicks["send_button"] += 1
+        await self.ws.send(json.dumps({"method": "update", "data": {
+            "question_input": random.choice(self.queries),
+            "send_button:shiny.action": self.clicks["send_button"],
+        }}))
+        # the output is empty (None) until the session's first search
+        message = await self._receive_until(lambda message: message.get("values", {}).get("query_results") is not None)
+        first_result = time.perf_counter() - start
+
+        # report the cards' summary outputs as shown, and the top ones as scrolled into view
+        card_ids = list(dict.fromkeys(re.findall(r'id=.(summary_\d+_\d+).', str(message["values"]["query_results"]))))
+        visible = card_ids[:visible_cards]
+        data = {f".clientdata_output_{card_id}_hidden": False for card_id in card_ids}
+        if visible:
+            data["visible_cards"] = visible
+        await self.ws.send(json.dumps({"method": "update", "data": data}))
+
+        pending = set(visible)
+        while pending:
+            message = await self._receive_until(lambda message: pending.intersection(message.get("values", {})))
+            for card_id in pending.intersection(message["values"]):
+                html = json.dumps(message["values"][card_id])
+                if "summary-pending" not in html and "summary-streaming" not in html:
+                    pending.discard(card_id)
+        return first_result, time.perf_counter() - start
+
+    async def upload(self, http):
+        name = f"load-test-{uuid.uuid4().hex}.pdf"
+        body = b"%PDF-1.4 load test"
+        job = await self._call("uploadInit", [[{"name": name, "size": len(body), "type": "application/pdf"}]])
+        response = await http.post(f"{self.base_url}/{job['uploadUrl']}", content=body)
+        response.raise_for_status()
+        await self._call("uploadEnd", [job["jobId"], "doc_upload"])
+
+        self.clicks["upload_button"] += 1
+        await self.ws.send(json.dumps({"method": "update", "data": {"upload_button:shiny.action": self.clicks["upload_button"]}}))
+
+        # the session shows a modal once its background ingestion job has finished
+        await self._receive_until(lambda message: "Upload" in json.dumps(message.get("modal", {})) and message["modal"].get("type") == "show")
+
+    async def _call(self, method, args):
+        self.tag += 1
+        tag = self.tag
+        await self.ws.send(json.dumps({"method": method, "args": args, "tag": tag}))
+        message = await self._receive_until(lambda message: message.get("response", {}).get("tag") == tag)
+        return message["response"].get("value")
+
+    async def _receive_until(self, predicate):
+        while True:
+            message = json.loads(await self.ws.recv())
+            if predicate(message):
+                return message
+
+async def run_level(concurrency, args, base_url, queries, monitor):
+    """Runs `concurrency` sessions for args.duration seconds and summarizes what they saw."""
+    import httpx
+
+    search_latencies = []
+    first_result_latencies = []
+    upload_latencies = []
+    errors = 0
+    closed_sessions = 0
+    deadline = time.perf_counter() + args.duration
+
+    async def session_loop(http):
+        import websockets
+
+        nonlocal errors, closed_sessions
+        session = SimulatedSession(base_url, queries)
+        await session.connect()
+        try:
+            while time.perf_counter() < deadline:
+                is_upload = random.random() < args.upload_fraction
+                start = time.perf_counter()
+                try:
+                    if is_upload:
+                        await asyncio.wait_for(session.upload(http), args.timeout)
+                        upload_latencies.append(time.perf_counter() - start)
+                    else:
+                        first_result, summaries = await asyncio.wait_for(session.search(args.visible_cards), args.timeout)
+                        first_result_latencies.append(first_result)
+                        search_latencies.append(summaries)
+                except websockets.ConnectionClosed:
+                    # the server ended the session; count it once and carry on in a new one,
+                    # as a user reloading the page would
+                    errors += 1
+                    closed_sessions += 1
+                    session = SimulatedSession(base_url, queries)
+                    await session.connect()
+                except Exception:
+                    errors += 1
+        finally:
+            await session.close()
+
+    monitor.reset()
+    start = time.perf_counter()
+    async with httpx.AsyncClient(timeout=args.timeout) as http:
+        await asyncio.gather(*(session_loop(http) for _ in range(concurrency)))
+    wall = time.perf_counter() - start
+
+    return {
+        "concurrency": concurrency,
+        "wall_seconds": wall,
+        "searches": len(search_latencies),
+        "uploads": len(upload_latencies),
+        "errors": errors,
+        "closed_sessions": closed_sessions,
+        "searches_per_sec": len(search_latencies) / wall,
+        "first_result_latency_seconds": percentiles(first_result_latencies),
+        "search_latency_seconds": percentiles(search_latencies),
+        "upload_latency_seconds": percentiles(upload_latencies),
+        "event_loop": monitor.summary(wall),
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Concurrent-session load test of the Shiny app against local stand-ins.")
+    parser.add_argument("--levels", default="1,2,4,8,16", help="comma-separated numbers of concurrent sessions")
+    parser.add_argument("--duration", type=float, default=20, help="seconds each concurrency level runs for")
+    parser.add_argument("--upload-fraction", type=float, default=0.05, help="share of operations that are uploads")
+    parser.add_argument("--corpus-chunks", type=int, default=2000, help="chunks seeded into the collection")
+    parser.add_argument("--visible-cards", type=int, default=3, help="result cards each session scrolls into view")
+    parser.add_argument("--upload-chunks", type=int, default=20, help="chunks produced per uploaded document")
+    parser.add_argument("--dim", type=int, default=1536)
+    parser.add_argument("--embedding-latency", type=float, default=0.1, help="seconds per fake embeddings request")
+    parser.add_argument("--llm-latency", type=float, default=0.8, help="seconds per stub LLM request")
+    parser.add_argument("--partition-latency", type=float, default=2.0, help="seconds the fake partitioner takes per run")
+    parser.add_argument("--timeout", type=float, default=60, help="seconds before an operation counts as an error")
+    parser.add_argument("--port", type=int, default=8899)
+    parser.add_argument("--output", help="result file (default: benchmarks/results/load-<commit>.json)")
+    args = parser.parse_args()
+
+    os.environ.setdefault("LOG_LEVEL", "WARNING")
+    commit = git_commit()
+    workdir = tempfile.mkdtemp(prefix="rag-load-")
+    app, queries = install_stand_ins(args, workdir)
+
+    monitor = LoopMonitor()
+    server = start_server(app.app, args.port, monitor)
+    base_url = f"http://127.0.0.1:{args.port}"
+
+    results = []
+    for concurrency in [int(level) for level in args.levels.split(",")]:
+        result = asyncio.run(run_level(concurrency, args, base_url, queries, monitor))
+        results.append(result)
+        print(
+            f"{concurrency:>4} sessions: {result['searches_per_sec']:.2f} searches/s, "
+            f"first result p50 {result['first_result_latency_seconds']['p50']:.2f}s, "
+            f"summaries p50 {result['search_latency_seconds']['p50']:.2f}s p99 {result['search_latency_seconds']['p99']:.2f}s, "
+            f"uploads {result['uploads']}, errors {result['errors']} ({result['closed_sessions']} sessions closed), "
+            f"loop blocked {result['event_loop']['blocked_fraction'] * 100:.0f}% (max {result['event_loop']['max_lag_seconds']:.2f}s)"
+        )
+    server.should_exit = True
+
+    report = {
+        "commit": commit,
+        "timestamp": datetime.now().isoformat(),
+        "parameters": vars(args),
+        "results": results,
+    }
+    output = args.output or os.path.join(RESULTS_DIR, f"load-{commit}.json")
+    os.makedirs(os.path.dirname(output), exist_ok=True)
+    with open(output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"Results written to {output}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,186 @@
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import platform
+import resource
+import tempfile
+import subprocess
+import multiprocessing
+from datetime import datetime
+
+import numpy as np
+
+# the benchmarks drive the app's own modules
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+RESULTS_DIR = os.path.join(ROOT, "benchmarks", "results")
+COLLECTION = "benchmark_collection"
+
+def percentiles(samples):
+    p50, p95, p99 = np.percentile(samples, [50, 95, 99]) if samples else (0.0, 0.0, 0.0)
+    return {"p50": float(p50), "p95": float(p95), "p99": float(p99), "mean": float(np.mean(samples)) if samples else 0.0}
+
+def run_corpus_benchmark(total_chunks, args):
+    """Ingests a synthetic corpus into an in-process Qdrant and times queries against it.
+
+    Runs in its own process so peak memory is measured per corpus size.
+    """
+    from qdrant_client import QdrantClient, models
+    import clients
+    import search_engine
+    import unstructured_processing
+    import telemetry
+    from caches import QueryEmbeddingCache, SummaryCache
+    from embedding_store import EmbeddingStore
+    from embedding_scheduler import EmbeddingScheduler
+    from lexical_index import LexicalIndex
+    from benchmarks.fakes import AsyncQdrantAdapter, FakeEmbeddings, LockedClient, StubLLM, write_synthetic_corpus
+
+    workdir = tempfile.mkdtemp(prefix="rag-bench-")
+    corpus_dir = os.path.join(workdir, "output")
+    os.makedirs(corpus_dir)
+    filenames = write_synthetic_corpus(corpus_dir, total_chunks, chunks_per_file=args.chunks_per_file)
+
+    # ingestion threads and search threads share the in-process store
+    qdrant = LockedClient(QdrantClient(":memory:"))
+    qdrant.create_collection(
+        collection_name=COLLECTION,
+        vectors_config=models.VectorParams(size=args.dim, distance=models.Distance.COSINE),
+    )
+    embeddings = FakeEmbeddings(dim=args.dim, latency=args.embedding_latency, tokens_per_minute=args.embedding_quota)
+    llm = StubLLM(latency=args.llm_latency)
+
+    # point the app modules at the local stand-ins, with empty caches
+    unstructured_processing.embedding_store = EmbeddingStore(os.path.join(workdir, "embedding_store"))
+    unstructured_processing.embedding_scheduler = EmbeddingScheduler(
+        max_concurrency=unstructured_processing.EMBED_MAX_CONCURRENCY,
+        max_batch_size=unstructured_processing.EMBED_BATCH_SIZE,
+    )
+    index = LexicalIndex(os.path.join(workdir, "lexical_index"))
+    unstructured_processing.lexical_index = index
+    search_engine.lexical_index = index
+    clients.set_client("qdrant", qdrant)
+    clients.set_client("async_qdrant", AsyncQdrantAdapter(qdrant))
+    clients.set_client("async_embeddings", embeddings)
+    clients.set_client("async_openai", llm)
+    search_engine.query_embedding_cache = QueryEmbeddingCache()
+    search_engine.summary_cache = SummaryCache()
+
+    # ingestion: partition JSON -> chunks -> documents -> embeddings -> upserts
+    start = time.perf_counter()
+    docs = unstructured_processing.iter_documents(unstructured_processing.iter_chunks(corpus_dir))
+    docs = unstructured_processing.tag_file_hashes(docs, {name: f"hash-{name}" for name in filenames})
+    unstructured_processing.store_chunks(docs, embeddings, qdrant, COLLECTION)
+    ingest_seconds = time.perf_counter() - start
+    stored = qdrant.count(COLLECTION).count
+
+    # queries: the text of random stored chunks, so every query has matches
+    rng = random.Random(1)
+    records, _ = qdrant.scroll(COLLECTION, limit=min(stored, 1000), with_payload=["content"])
+    queries = [rng.choice(records).payload["content"][:200] for _ in range(args.queries)]
+    latencies = []
+    for query in queries:
+        start = time.perf_counter()
+        search_engine.search_qdrant(query, COLLECTION, min_score=args.min_score)
+        latencies.append(time.perf_counter() - start)
+
+    return {
+        "chunks": stored,
+        "ingest_seconds": ingest_seconds,
+        "ingest_chunks_per_sec": stored / ingest_seconds if ingest_seconds else 0.0,
+        "embedding_requests": embeddings.requests,
+        "embedding_rate_limited": embeddings.rate_limited,
+        "llm_requests": llm.requests,
+        "query_latency_seconds": percentiles(latencies),
+        "stages": telemetry.metrics_summary(),
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    }
+
+def _child(total_chunks, args, queue):
+    queue.put(run_corpus_benchmark(total_chunks, args))
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, text=True).strip()
+    except Exception:
+        return "unknown"
+
+def compare(old_path, new_path):
+    """Prints the relative change of the headline numbers between two result files."""
+    with open(old_path) as f:
+        old = json.load(f)
+    with open(new_path) as f:
+        new = json.load(f)
+
+    for size, result in new["results"].items():
+        previous = old["results"].get(size)
+        if previous is None:
+            continue
+        rows = [
+            ("ingest chunks/sec", previous["ingest_chunks_per_sec"], result["ingest_chunks_per_sec"]),
+            ("peak RSS MB", previous["peak_rss_mb"], result["peak_rss_mb"]),
+        ] + [
+            (f"query {quantile}", previous["query_latency_seconds"][quantile], result["query_latency_seconds"][quantile])
+            for quantile in ("p50", "p95", "p99")
+        ]
+        print(f"{size} chunks ({old['commit']} -> {new['commit']}):")
+        for name, before, after in rows:
+            change = (after - before) / before * 100 if before else 0.0
+            print(f"  {name:18} {before:12.4f} -> {after:12.4f} ({change:+.1f}%)")
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline ingestion and query benchmarks.")
+    parser.add_argument("--sizes", default="1000,10000,100000", help="comma-separated corpus sizes in chunks")
+    parser.add_argument("--queries", type=int, default=50, help="queries timed per corpus size")
+    parser.add_argument("--dim", type=int, default=1536, help="embedding dimension")
+    parser.add_argument("--chunks-per-file", type=int, default=100)
+    parser.add_argument("--embedding-latency", type=float, default=0.0, help="seconds per fake embeddings request")
+    parser.add_argument("--embedding-quota", type=int, help="tokens per minute the fake embeddings API allows before returning 429s")
+    parser.add_argument("--llm-latency", type=float, default=0.5, help="seconds per stub LLM request")
+    parser.add_argument("--min-score", type=float, default=0.0, help="min_score passed to search_qdrant")
+    parser.add_argument("--output", help="result file (default: benchmarks/results/<commit>.json)")
+    parser.add_argument("--compare", nargs=2, metavar=("OLD", "NEW"), help="compare two result files and exit")
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        return
+
+    os.environ.setdefault("LOG_LEVEL", "WARNING")
+    context = multiprocessing.get_context("spawn")
+    results = {}
+    for size in [int(size) for size in args.sizes.split(",")]:
+        queue = context.Queue()
+        process = context.Process(target=_child, args=(size, args, queue))
+        process.start()
+        results[str(size)] = queue.get()
+        process.join()
+        result = results[str(size)]
+        print(
+            f"{size:>7} chunks: ingest {result['ingest_chunks_per_sec']:.0f} chunks/s, "
+            f"peak RSS {result['peak_rss_mb']:.0f} MB, "
+            f"query p50 {result['query_latency_seconds']['p50'] * 1000:.0f} ms "
+            f"p95 {result['query_latency_seconds']['p95'] * 1000:.0f} ms "
+            f"p99 {result['query_latency_seconds']['p99'] * 1000:.0f} ms"
+        )
+
+    commit = git_commit()
+    report = {
+        "commit": commit,
+        "timestamp": datetime.now().isoformat(),
+        "python": platform.python_version(),
+        "parameters": vars(args),
+        "results": results,
+    }
+    output = args.output or os.path.join(RESULTS_DIR, f"{commit}.json")
+    os.makedirs(os.path.dirname(output), exist_ok=True)
+    with open(output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"Results written to {output}")
+
+if __name__ == "__main__":
+    main()
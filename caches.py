@@ -0,0 +1,221 @@
+import os
+import re
+import json
+import time
+import hashlib
+import sqlite3
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+def normalize_query(query: str) -> str:
+    """Normalizes a query so trivially different spellings share a cache entry."""
+    return re.sub(r"\s+", " ", query).strip().lower()
+
+class QueryEmbeddingCache:
+    """LRU cache of query embeddings with an optional sqlite tier that survives restarts.
+
+    Entries are keyed by the embedding model name and the normalized query text.
+    Vectors are kept as float32 both in memory and on disk. The two tiers have separate
+    locks, so memory lookups never wait on a disk write.
+
+    Args:
+        max_entries: The number of embeddings kept in memory before the least recently used is evicted.
+        path: The sqlite file used as the on-disk tier, or None to keep the cache in memory only.
+        max_disk_entries: The number of embeddings kept on disk before the oldest are pruned.
+        prune_interval: The number of disk writes between prunes; the disk tier may hold up
+            to this many entries more than max_disk_entries in between.
+    """
+
+    def __init__(self, max_entries=1024, path=None, max_disk_entries=100_000, prune_interval=100):
+        self.max_entries = max_entries
+        self.max_disk_entries = max_disk_entries
+        self.prune_interval = prune_interval
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._db = None
+        self._db_lock = threading.Lock()
+        self._writes = 0
+
+        if path:
+            self._db = sqlite3.connect(path, check_same_thread=False)
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS query_embeddings ("
+                "model TEXT NOT NULL, query TEXT NOT NULL, vector BLOB NOT NULL, "
+                "PRIMARY KEY (model, query))"
+            )
+            self._db.commit()
+
+    @property
+    def persistent(self):
+        """Whether the cache has an on-disk tier."""
+        return self._db is not None
+
+    def get(self, model: str, query: str, disk=True):
+        """Returns the cached embedding for the query, or None on a miss.
+
+        Args:
+            disk: Whether to fall back to the disk tier. With disk=False a miss is not
+                counted if there is a disk tier, since the caller is expected to check
+                it next (e.g. off the event loop) with disk=True.
+        """
+        key = (model, normalize_query(query))
+        with self._lock:
+            vector = self._entries.get(key)
+            if vector is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return vector.tolist()
+            if self._db is None:
+                self.misses += 1
+                return None
+            if not disk:
+                return None
+
+        with self._db_lock:
+            row = self._db.execute(
+                "SELECT vector FROM query_embeddings WHERE model = ? AND query = ?", key
+            ).fetchone()
+
+        with self._lock:
+            if row is None:
+                self.misses += 1
+                return None
+            vector = np.frombuffer(row[0], dtype=np.float32)
+            self._remember(key, vector)
+            self.disk_hits += 1
+            return vector.tolist()
+
+    def put(self, model: str, query: str, vector):
+        """Stores the embedding for the query in memory and, if enabled, on disk.
+
+        The disk tier is pruned back to max_disk_entries every prune_interval writes.
+        """
+        key = (model, normalize_query(query))
+        vector = np.asarray(vector, dtype=np.float32)
+        with self._lock:
+            self._remember(key, vector)
+
+        if self._db is None:
+            return
+        with self._db_lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO query_embeddings (model, query, vector) VALUES (?, ?, ?)",
+                (*key, vector.tobytes()),
+            )
+            self._writes += 1
+            if self._writes % self.prune_interval == 0:
+                self._db.execute(
+                    "DELETE FROM query_embeddings WHERE rowid IN ("
+                    "SELECT rowid FROM query_embeddings ORDER BY rowid DESC LIMIT -1 OFFSET ?)",
+                    (self.max_disk_entries,),
+                )
+            self._db.commit()
+
+    def stats(self):
+        """Returns hit/miss counters and the current size of each tier."""
+        disk_entries = None
+        if self._db is not None:
+            with self._db_lock:
+                disk_entries = self._db.execute("SELECT COUNT(*) FROM query_embeddings").fetchone()[0]
+        with self._lock:
+            lookups = self.hits + self.disk_hits + self.misses
+            return {
+                "hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "hit_rate": (self.hits + self.disk_hits) / lookups if lookups else 0.0,
+                "entries": len(self._entries),
+                "disk_entries": disk_entries,
+            }
+
+    def _remember(self, key, vector):
+        self._entries[key] = vector
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+class SummaryCache:
+    """TTL + LRU cache of LLM summaries, indexed by tenant and source document for invalidation.
+
+    Entries are keyed by the normalized query plus a stable hash of the chunk IDs and
+    contents given to the model, so a summary is only reused for exactly the same input.
+
+    Args:
+        max_entries: The number of summaries kept before the least recently used is evicted.
+        ttl: The number of seconds a summary stays valid.
+    """
+
+    def __init__(self, max_entries=2048, ttl=24 * 60 * 60):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()  # key -> ((tenant, source), expires_at, summary)
+        self._keys_by_source = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def make_key(query: str, chunk_ids, chunks):
+        """Builds a cache key from the query and the exact chunks fed to the model."""
+        digest = hashlib.sha256()
+        for chunk_id, chunk in zip(chunk_ids, chunks):
+            digest.update(json.dumps([str(chunk_id), chunk], sort_keys=True, default=str).encode("utf-8"))
+        return (normalize_query(query), digest.hexdigest())
+
+    def get(self, key):
+        """Returns the cached summary for the key, or None if missing or expired."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[1] > time.monotonic():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[2]
+
+            if entry is not None:
+                self._discard(key)
+            self.misses += 1
+            return None
+
+    def put(self, key, tenant: str, source: str, summary: str):
+        """Stores a summary generated from a tenant's source document."""
+        source = (tenant, source)
+        with self._lock:
+            if key in self._entries:
+                self._discard(key)
+            self._entries[key] = (source, time.monotonic() + self.ttl, summary)
+            self._keys_by_source.setdefault(source, set()).add(key)
+            while len(self._entries) > self.max_entries:
+                self._discard(next(iter(self._entries)))
+
+    def invalidate_source(self, tenant: str, source: str):
+        """Evicts every summary generated from a tenant's source document.
+
+        Other tenants' documents with the same filename keep their summaries.
+        """
+        with self._lock:
+            for key in list(self._keys_by_source.get((tenant, source), ())):
+                self._discard(key)
+
+    def stats(self):
+        """Returns hit/miss counters and the current number of entries."""
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "entries": len(self._entries)}
+
+    def _discard(self, key):
+        source = self._entries.pop(key)[0]
+        keys = self._keys_by_source.get(source)
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self._keys_by_source[source]
+
+# shared by search (fills it) and ingestion/deletion (invalidates it)
+summary_cache = SummaryCache(
+    max_entries=int(os.getenv("SUMMARY_CACHE_SIZE", 2048)),
+    ttl=float(os.getenv("SUMMARY_CACHE_TTL", 24 * 60 * 60)),
+)
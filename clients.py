@@ -0,0 +1,130 @@
+import os
+import asyncio
+import threading
+import weakref
+
+from dotenv import load_dotenv
+from telemetry import get_logger
+
+# load API keys
+load_dotenv()
+
+logger = get_logger(__name__)
+
+# Qdrant server holding the collections
+QDRANT_URL = os.getenv("QDRANT_URL", "https://67be5618-eb3c-4be8-af45-490d7595393d.europe-west3-0.gcp.cloud.qdrant.io")
+# send point operations over gRPC (port 6334) instead of REST
+QDRANT_PREFER_GRPC = os.getenv("QDRANT_PREFER_GRPC", "false").lower() in ("1", "true", "yes")
+# seconds before a Qdrant request times out
+QDRANT_TIMEOUT = int(os.getenv("QDRANT_TIMEOUT", 30))
+
+# the clients every module shares, created on first use
+_clients = {}
+# async clients are bound to the event loop that created them, so there is one per loop
+_async_clients = weakref.WeakKeyDictionary()
+_lock = threading.Lock()
+
+def _shared(name, factory):
+    client = _clients.get(name)
+    if client is None:
+        with _lock:
+            client = _clients.get(name)
+            if client is None:
+                client = _clients[name] = factory()
+                logger.info("Created the shared %s client.", name)
+    return client
+
+def _shared_async(name, factory):
+    # a client installed with set_client is used on every loop
+    if name in _clients:
+        return _clients[name]
+    loop = asyncio.get_running_loop()
+    with _lock:
+        clients = _async_clients.setdefault(loop, {})
+        if name not in clients:
+            clients[name] = factory()
+        return clients[name]
+
+def set_client(name, client):
+    """Replaces a shared client, e.g. with a local stand-in in the benchmarks.
+
+    Args:
+        name: One of "qdrant", "async_qdrant", "async_embeddings", "ingestion_embeddings",
+            "openai" or "async_openai".
+        client: The client returned from then on.
+    """
+    with _lock:
+        _clients[name] = client
+
+def get_qdrant_client():
+    """Returns the shared Qdrant client, connecting to QDRANT_URL on first use."""
+    def connect():
+        from qdrant_client import QdrantClient
+        return QdrantClient(
+            url=QDRANT_URL,
+            api_key=os.getenv("QDRANT_API_KEY"),
+            prefer_grpc=QDRANT_PREFER_GRPC,
+            timeout=QDRANT_TIMEOUT,
+        )
+    return _shared("qdrant", connect)
+
+def get_async_qdrant_client():
+    """Returns the AsyncQdrantClient of the running event loop, used by search."""
+    def connect():
+        from qdrant_client import AsyncQdrantClient
+        return AsyncQdrantClient(
+            url=QDRANT_URL,
+            api_key=os.getenv("QDRANT_API_KEY"),
+            prefer_grpc=QDRANT_PREFER_GRPC,
+            timeout=QDRANT_TIMEOUT,
+        )
+    return _shared_async("async_qdrant", connect)
+
+def get_async_embedding_model():
+    """Returns the OpenAI embeddings model of the running event loop, used to embed queries with aembed_documents."""
+    def connect():
+        from langchain_openai import OpenAIEmbeddings
+        return OpenAIEmbeddings(openai_api_key=os.getenv("OPENAI_API_KEY"))
+    return _shared_async("async_embeddings", connect)
+
+def get_ingestion_embedding_model():
+    """Returns the shared OpenAI embeddings model used by ingestion.
+
+    It does not retry on its own; the embedding scheduler retries with backoff across all requests.
+    """
+    def connect():
+        from langchain_openai import OpenAIEmbeddings
+        return OpenAIEmbeddings(openai_api_key=os.getenv("OPENAI_API_KEY"), max_retries=0)
+    return _shared("ingestion_embeddings", connect)
+
+def get_openai_client():
+    """Returns the shared synchronous OpenAI client."""
+    def connect():
+        from openai import OpenAI
+        return OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+    return _shared("openai", connect)
+
+def get_async_openai_client():
+    """Returns the AsyncOpenAI client of the running event loop, keeping its connections open between requests."""
+    def connect():
+        from openai import AsyncOpenAI
+        return AsyncOpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+    return _shared_async("async_openai", connect)
+
+async def close_async_clients():
+    """Closes the async clients created on the running event loop, before the loop ends.
+
+    Clients installed with set_client are shared by every loop and stay open.
+    """
+    with _lock:
+        clients = _async_clients.pop(asyncio.get_running_loop(), {})
+    for name, client in clients.items():
+        try:
+            if name == "async_embeddings":
+                # OpenAIEmbeddings holds an OpenAI and an AsyncOpenAI client, each with its own pool
+                client.client._client.close()
+                await client.async_client._client.close()
+            else:
+                await client.close()
+        except Exception:
+            logger.warning("Could not close the %s client.", name, exc_info=True)
@@ -0,0 +1,235 @@
+import os
+import time
+import random
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import openai
+import tiktoken
+from dotenv import load_dotenv
+from telemetry import get_logger, observe, span
+
+# load API keys
+load_dotenv()
+
+logger = get_logger(__name__)
+
+# the embeddings quota of the OpenAI account, shared by every ingestion job in the process
+EMBED_TOKENS_PER_MINUTE = int(os.getenv("EMBED_TOKENS_PER_MINUTE", 1_000_000))
+EMBED_REQUESTS_PER_MINUTE = int(os.getenv("EMBED_REQUESTS_PER_MINUTE", 3_000))
+# the most tokens packed into a single embeddings request (the API allows 300k)
+EMBED_MAX_REQUEST_TOKENS = int(os.getenv("EMBED_MAX_REQUEST_TOKENS", 250_000))
+# number of times a rate-limited or failed request is retried
+EMBED_MAX_RETRIES = int(os.getenv("EMBED_MAX_RETRIES", 8))
+# longest backoff, in seconds, between retries
+EMBED_MAX_BACKOFF = float(os.getenv("EMBED_MAX_BACKOFF", 60))
+
+# errors worth retrying; anything else is raised straight away
+RETRYABLE_ERRORS = (openai.RateLimitError, openai.APITimeoutError, openai.APIConnectionError, openai.InternalServerError)
+
+_encodings = {}
+_encodings_lock = threading.Lock()
+
+def count_tokens(texts, model_name):
+    """Counts the tokens of each text with the model's tiktoken encoding.
+
+    Falls back to an estimate of four characters per token if the encoding cannot be loaded.
+    """
+    with _encodings_lock:
+        if model_name not in _encodings:
+            try:
+                try:
+                    _encodings[model_name] = tiktoken.encoding_for_model(model_name)
+                except KeyError:
+                    _encodings[model_name] = tiktoken.get_encoding("cl100k_base")
+            except Exception as e:
+                logger.warning("Could not load the tiktoken encoding for %s, estimating token counts: %r", model_name, e)
+                _encodings[model_name] = None
+        encoding = _encodings[model_name]
+
+    if encoding is None:
+        return [len(text) // 4 + 1 for text in texts]
+    return [len(tokens) for tokens in encoding.encode_batch(texts)]
+
+def pack_batches(token_counts, max_batch_size, max_request_tokens):
+    """Groups consecutive texts into requests of at most max_batch_size texts and max_request_tokens tokens.
+
+    Returns:
+        A list of (start, end) index ranges, in order.
+    """
+    batches = []
+    start = 0
+    tokens = 0
+    for i, count in enumerate(token_counts):
+        if i > start and (i - start >= max_batch_size or tokens + count > max_request_tokens):
+            batches.append((start, i))
+            start = i
+            tokens = 0
+        tokens += count
+    if start < len(token_counts):
+        batches.append((start, len(token_counts)))
+    return batches
+
+class _Budget:
+    """A per-minute quota, refilled continuously, that requests draw from before they are sent."""
+
+    def __init__(self, per_minute):
+        self.capacity = per_minute
+        self.available = float(per_minute)
+        self.updated = time.monotonic()
+
+    def wait_time(self, amount, now):
+        """Returns how many seconds until amount can be drawn; requests larger than the whole quota wait for a full bucket."""
+        self.available = min(self.capacity, self.available + (now - self.updated) * self.capacity / 60)
+        self.updated = now
+        amount = min(amount, self.capacity)
+        return 0.0 if self.available >= amount else (amount - self.available) * 60 / self.capacity
+
+    def take(self, amount):
+        self.available -= amount
+
+class EmbeddingScheduler:
+    """Paces embeddings requests to the account's rate limits.
+
+    Texts are packed into requests by their tiktoken size. Before it is sent, every request
+    draws its tokens from a tokens-per-minute budget and one request from a
+    requests-per-minute budget. When a 429 arrives, the number of requests in flight is
+    halved and all workers pause. It then grows back by one for each round of successful
+    requests (additive increase, multiplicative decrease). Failed requests are retried with
+    jittered exponential backoff. Results always come back in input order.
+
+    One scheduler is shared by every ingestion job in the process, since they draw on the same quota.
+
+    Args:
+        tokens_per_minute: The account's embeddings token quota.
+        requests_per_minute: The account's embeddings request quota.
+        max_concurrency: The most requests in flight at once.
+        max_batch_size: The most texts in a single request.
+        max_request_tokens: The most tokens in a single request.
+        max_retries: The number of times a failed request is retried.
+    """
+
+    def __init__(self, tokens_per_minute=EMBED_TOKENS_PER_MINUTE, requests_per_minute=EMBED_REQUESTS_PER_MINUTE, max_concurrency=4, max_batch_size=64, max_request_tokens=EMBED_MAX_REQUEST_TOKENS, max_retries=EMBED_MAX_RETRIES):
+        self.max_concurrency = max_concurrency
+        self.max_batch_size = max_batch_size
+        self.max_request_tokens = max_request_tokens
+        self.max_retries = max_retries
+
+        self.concurrency_limit = max_concurrency
+        self._in_flight = 0
+        self._successes = 0
+        self._resume_at = 0.0
+        self._tokens = _Budget(tokens_per_minute)
+        self._requests = _Budget(requests_per_minute)
+        self._condition = threading.Condition()
+        self.rate_limited = 0
+
+    def embed(self, texts: list[str], embedding_model):
+        """Embeds texts within the rate limits.
+
+        Args:
+            texts: The texts to embed.
+            embedding_model: The embedding model used to convert the texts into vectors.
+
+        Returns:
+            A list of vectors in the same order as the given texts.
+
+        Raises:
+            Exception: The last error of a request that still failed after max_retries retries,
+                or the first error that is not worth retrying.
+        """
+        if not texts:
+            return []
+
+        model_name = getattr(embedding_model, "model", type(embedding_model).__name__)
+        token_counts = count_tokens(texts, model_name)
+        batches = pack_batches(token_counts, self.max_batch_size, self.max_request_tokens)
+
+        def embed_batch(batch):
+            start, end = batch
+            return self._send(embedding_model, texts[start:end], sum(token_counts[start:end]))
+
+        # executor.map yields results in submission order, so vectors line up with texts
+        with ThreadPoolExecutor(max_workers=min(self.max_concurrency, len(batches))) as executor:
+            return [vector for vectors in executor.map(embed_batch, batches) for vector in vectors]
+
+    def stats(self):
+        with self._condition:
+            return {
+                "concurrency_limit": self.concurrency_limit,
+                "in_flight": self._in_flight,
+                "rate_limited": self.rate_limited,
+                "available_tokens": int(self._tokens.available),
+                "available_requests": int(self._requests.available),
+            }
+
+    def _send(self, embedding_model, texts, tokens):
+        for attempt in range(self.max_retries + 1):
+            self._acquire(tokens)
+            try:
+                with span("embedding_batch", size=len(texts), tokens=tokens):
+                    vectors = embedding_model.embed_documents(texts)
+            except RETRYABLE_ERRORS as e:
+                self._release(rate_limited=isinstance(e, openai.RateLimitError))
+                if attempt == self.max_retries:
+                    raise
+                delay = self._backoff(e, attempt)
+                logger.warning("Embeddings request failed (%s), retrying in %.1fs", type(e).__name__, delay)
+                observe("embedding_backoff", delay)
+                time.sleep(delay)
+            except Exception:
+                self._release()
+                raise
+            else:
+                self._release(succeeded=True)
+                return vectors
+
+    def _backoff(self, error, attempt):
+        """Full-jitter exponential backoff, at least as long as any Retry-After the API sent."""
+        delay = random.uniform(0, min(EMBED_MAX_BACKOFF, 2 ** attempt))
+        response = getattr(error, "response", None)
+        retry_after = response.headers.get("retry-after") if response is not None else None
+        try:
+            delay = max(delay, float(retry_after))
+        except (TypeError, ValueError):
+            pass
+        if isinstance(error, openai.RateLimitError):
+            # hold back every worker, not just this one
+            with self._condition:
+                self._resume_at = max(self._resume_at, time.monotonic() + delay)
+        return delay
+
+    def _acquire(self, tokens):
+        with self._condition:
+            while True:
+                now = time.monotonic()
+                if self._in_flight >= self.concurrency_limit:
+                    self._condition.wait()
+                    continue
+                wait = max(
+                    self._resume_at - now,
+                    self._tokens.wait_time(tokens, now),
+                    self._requests.wait_time(1, now),
+                )
+                if wait <= 0:
+                    self._tokens.take(tokens)
+                    self._requests.take(1)
+                    self._in_flight += 1
+                    return
+                self._condition.wait(wait)
+
+    def _release(self, succeeded=False, rate_limited=False):
+        with self._condition:
+            self._in_flight -= 1
+            if rate_limited:
+                self.rate_limited += 1
+                self.concurrency_limit = max(1, self.concurrency_limit // 2)
+                self._successes = 0
+                logger.info("Rate limited; embeddings concurrency lowered to %d", self.concurrency_limit)
+            elif succeeded:
+                # one more request in flight after a full round of successes
+                self._successes += 1
+                if self._successes >= self.concurrency_limit and self.concurrency_limit < self.max_concurrency:
+                    self.concurrency_limit += 1
+                    self._successes = 0
+            self._condition.notify_all()
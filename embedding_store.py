@@ -0,0 +1,229 @@
+import os
+import sys
+import json
+import hashlib
+import sqlite3
+import threading
+
+import numpy as np
+from dotenv import load_dotenv
+from telemetry import get_logger
+
+# load API keys
+load_dotenv()
+
+logger = get_logger(__name__)
+
+# where the local embedding store keeps its vector matrices and index files
+EMBEDDING_STORE_DIR = os.getenv("EMBEDDING_STORE_DIR", "embedding_store")
+# the number of vectors kept per model before the least recently used are evicted
+EMBEDDING_STORE_MAX_ENTRIES = int(os.getenv("EMBEDDING_STORE_MAX_ENTRIES", 200_000))
+
+def text_sha256(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+class EmbeddingStore:
+    """Content-addressed store of embeddings keyed by (model, sha256(text)).
+
+    Each model gets a directory holding a memory-mapped float32 matrix (vectors.f32)
+    and an index file (index.sqlite) mapping text hashes to matrix rows. Rows freed by
+    eviction are reused by later inserts; compact() rewrites the matrix without them.
+
+    Args:
+        directory: The directory the store is kept in.
+        max_entries: The number of vectors kept per model before the least recently used are evicted.
+    """
+
+    def __init__(self, directory=EMBEDDING_STORE_DIR, max_entries=EMBEDDING_STORE_MAX_ENTRIES):
+        self.directory = directory
+        self.max_entries = max_entries
+        self._models = {}
+        self._lock = threading.Lock()
+
+    def get_many(self, model: str, texts: list[str]):
+        """Looks up stored vectors for the given texts.
+
+        Returns:
+            A list aligned with texts holding each stored vector, or None where the text is not stored.
+        """
+        with self._lock:
+            table = self._load(model)
+            vectors = []
+            for text in texts:
+                row = table.touch(text_sha256(text))
+                vectors.append(None if row is None else table.matrix[row].tolist())
+            table.save()
+            return vectors
+
+    def put_many(self, model: str, texts: list[str], vectors):
+        """Stores vectors for the given texts, evicting the least recently used past the size cap."""
+        if not texts:
+            return
+        with self._lock:
+            table = self._load(model)
+            for text, vector in zip(texts, vectors):
+                table.insert(text_sha256(text), np.asarray(vector, dtype=np.float32))
+            table.evict(self.max_entries)
+            table.save()
+
+    def compact(self, model: str = None):
+        """Rewrites the vector matrices so they hold only live rows.
+
+        Args:
+            model: The model whose matrix is compacted, or None to compact every model in the store.
+        """
+        with self._lock:
+            models = [model] if model else self._stored_models()
+            for name in models:
+                table = self._load(name)
+                table.compact()
+                logger.info("Compacted embedding store for %s: %d vectors.", name, len(table))
+
+    def stats(self):
+        with self._lock:
+            return {
+                name: {"entries": len(table), "capacity": table.capacity, "free_rows": table.free_row_count()}
+                for name, table in ((name, self._load(name)) for name in self._stored_models())
+            }
+
+    def _stored_models(self):
+        models = set(self._models)
+        if os.path.isdir(self.directory):
+            for entry in os.listdir(self.directory):
+                index_path = os.path.join(self.directory, entry, "index.sqlite")
+                if os.path.isfile(index_path):
+                    with sqlite3.connect(index_path) as db:
+                        row = db.execute("SELECT value FROM meta WHERE key = 'model'").fetchone()
+                    if row:
+                        models.add(row[0])
+        return sorted(models)
+
+    def _load(self, model):
+        table = self._models.get(model)
+        if table is None:
+            table = _ModelTable(os.path.join(self.directory, text_sha256(model)[:16]), model)
+            self._models[model] = table
+        return table
+
+class _ModelTable:
+    """The vectors and index of a single embedding model."""
+
+    def __init__(self, directory, model):
+        os.makedirs(directory, exist_ok=True)
+        self.model = model
+        self.matrix_path = os.path.join(directory, "vectors.f32")
+        self.db = sqlite3.connect(os.path.join(directory, "index.sqlite"), check_same_thread=False)
+        self.db.executescript(
+            "CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);"
+            "CREATE TABLE IF NOT EXISTS entries (hash TEXT PRIMARY KEY, row INTEGER NOT NULL, last_used INTEGER NOT NULL);"
+            "CREATE INDEX IF NOT EXISTS entries_last_used ON entries (last_used);"
+            "CREATE TABLE IF NOT EXISTS free_rows (row INTEGER PRIMARY KEY);"
+        )
+        self.db.execute("INSERT OR IGNORE INTO meta VALUES ('model', ?)", (model,))
+        self.db.commit()
+
+        meta = dict(self.db.execute("SELECT key, value FROM meta"))
+        self.dim = int(meta["dim"]) if "dim" in meta else None
+        self.capacity = int(meta.get("capacity", 0))
+        self.clock = int(meta.get("clock", 0))
+        self.matrix = None
+        if self.capacity:
+            self.matrix = np.memmap(self.matrix_path, dtype=np.float32, mode="r+", shape=(self.capacity, self.dim))
+
+    def __len__(self):
+        return self.db.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+
+    def free_row_count(self):
+        return self.db.execute("SELECT COUNT(*) FROM free_rows").fetchone()[0]
+
+    def touch(self, key):
+        row = self.db.execute("SELECT row FROM entries WHERE hash = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        self.clock += 1
+        self.db.execute("UPDATE entries SET last_used = ? WHERE hash = ?", (self.clock, key))
+        return row[0]
+
+    def insert(self, key, vector):
+        if self.dim is None:
+            self.dim = len(vector)
+        self.clock += 1
+
+        if self.db.execute("SELECT 1 FROM entries WHERE hash = ?", (key,)).fetchone():
+            self.db.execute("UPDATE entries SET last_used = ? WHERE hash = ?", (self.clock, key))
+            return
+
+        free = self.db.execute("SELECT row FROM free_rows ORDER BY row LIMIT 1").fetchone()
+        if free is None:
+            self._grow(max(1024, self.capacity * 2))
+            free = self.db.execute("SELECT row FROM free_rows ORDER BY row LIMIT 1").fetchone()
+        row = free[0]
+        self.db.execute("DELETE FROM free_rows WHERE row = ?", (row,))
+        self.matrix[row] = vector
+        self.db.execute("INSERT INTO entries VALUES (?, ?, ?)", (key, row, self.clock))
+
+    def evict(self, max_entries):
+        overflow = len(self) - max_entries
+        if overflow <= 0:
+            return
+        evicted = self.db.execute(
+            "SELECT hash, row FROM entries ORDER BY last_used LIMIT ?", (overflow,)
+        ).fetchall()
+        self.db.executemany("DELETE FROM entries WHERE hash = ?", [(key,) for key, _ in evicted])
+        self.db.executemany("INSERT INTO free_rows VALUES (?)", [(row,) for _, row in evicted])
+
+    def compact(self):
+        if self.matrix is None:
+            return
+        live = self.db.execute("SELECT hash, row FROM entries ORDER BY row").fetchall()
+        vectors = np.array(self.matrix[[row for _, row in live]], dtype=np.float32)
+        del self.matrix
+
+        # write the compacted matrix beside the old one and swap it in
+        tmp_path = self.matrix_path + ".tmp"
+        self.capacity = len(live)
+        if self.capacity:
+            compacted = np.memmap(tmp_path, dtype=np.float32, mode="w+", shape=(self.capacity, self.dim))
+            compacted[:] = vectors
+            compacted.flush()
+            del compacted
+        else:
+            open(tmp_path, "wb").close()
+        os.replace(tmp_path, self.matrix_path)
+
+        self.db.execute("DELETE FROM free_rows")
+        self.db.executemany("UPDATE entries SET row = ? WHERE hash = ?", [(row, key) for row, (key, _) in enumerate(live)])
+        self.matrix = None
+        if self.capacity:
+            self.matrix = np.memmap(self.matrix_path, dtype=np.float32, mode="r+", shape=(self.capacity, self.dim))
+        self.save()
+
+    def save(self):
+        if self.matrix is not None:
+            self.matrix.flush()
+        self.db.executemany(
+            "INSERT OR REPLACE INTO meta VALUES (?, ?)",
+            [("dim", str(self.dim)), ("capacity", str(self.capacity)), ("clock", str(self.clock))],
+        )
+        self.db.commit()
+
+    def _grow(self, capacity):
+        if self.matrix is not None:
+            self.matrix.flush()
+            del self.matrix
+        # extend the file in place; existing rows keep their offsets
+        with open(self.matrix_path, "ab") as f:
+            f.truncate(capacity * self.dim * 4)
+        self.matrix = np.memmap(self.matrix_path, dtype=np.float32, mode="r+", shape=(capacity, self.dim))
+        self.db.executemany("INSERT INTO free_rows VALUES (?)", [(row,) for row in range(self.capacity, capacity)])
+        self.capacity = capacity
+
+if __name__ == "__main__":
+    # usage: python embedding_store.py compact [model] | stats
+    command = sys.argv[1] if len(sys.argv) > 1 else "stats"
+    store = EmbeddingStore()
+
+    if command == "compact":
+        store.compact(sys.argv[2] if len(sys.argv) > 2 else None)
+    else:
+        print(json.dumps(store.stats(), indent=2))
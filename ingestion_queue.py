@@ -0,0 +1,118 @@
+import os
+import uuid
+import threading
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+
+from telemetry import get_logger
+
+logger = get_logger(__name__)
+
+# number of ingestion jobs processed in parallel
+INGEST_WORKERS = int(os.getenv("INGEST_WORKERS", 2))
+
+# job statuses in the order a successful job moves through them
+JOB_STAGES = ["queued", "partitioning", "embedding", "upserting", "done"]
+FINISHED_STATUSES = ("done", "failed")
+# number of finished jobs kept around for status display
+MAX_FINISHED_JOBS = 500
+
+class IngestionJob:
+    """The status and per-stage progress of one background ingestion run.
+
+    Args:
+        filenames: The names of the files processed by the job.
+    """
+
+    def __init__(self, filenames):
+        self.id = uuid.uuid4().hex
+        self.filenames = list(filenames)
+        self.status = "queued"
+        self.progress = {}  # stage -> [done, total]
+        self.error = None
+        self.created_at = datetime.now()
+        self.finished_at = None
+        self._lock = threading.Lock()
+
+    @property
+    def finished(self):
+        return self.status in FINISHED_STATUSES
+
+    def report(self, stage, done=None, total=None):
+        """Records that the job reached a stage and, optionally, how far through it is.
+
+        Passed to the ingestion pipeline as its progress callback, so it is called from worker threads.
+        """
+        with self._lock:
+            self.status = stage
+            if total is not None:
+                self.progress[stage] = [done or 0, total]
+
+    def snapshot(self):
+        """Returns a consistent copy of the job's state for display."""
+        with self._lock:
+            return {
+                "id": self.id,
+                "filenames": self.filenames,
+                "status": self.status,
+                "progress": {stage: list(counts) for stage, counts in self.progress.items()},
+                "error": self.error,
+                "created_at": self.created_at,
+                "finished_at": self.finished_at,
+            }
+
+    def _finish(self, error=None):
+        with self._lock:
+            self.status = "failed" if error else "done"
+            self.error = error
+            self.finished_at = datetime.now()
+
+class IngestionQueue:
+    """A pool of worker threads that runs ingestion jobs outside the Shiny session.
+
+    Args:
+        max_workers: The number of jobs processed in parallel.
+    """
+
+    def __init__(self, max_workers=INGEST_WORKERS):
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="ingest")
+        self._jobs = {}
+        self._lock = threading.Lock()
+
+    def submit(self, filenames, run):
+        """Queues an ingestion job.
+
+        Args:
+            filenames: The names of the files processed by the job, for display.
+            run: Called on a worker thread with the job's progress callback; does the actual ingestion.
+
+        Returns:
+            The queued IngestionJob.
+        """
+        job = IngestionJob(filenames)
+        with self._lock:
+            # forget the oldest finished jobs; dicts keep insertion order
+            finished = [job_id for job_id, queued in self._jobs.items() if queued.finished]
+            for job_id in finished[:max(0, len(finished) - MAX_FINISHED_JOBS)]:
+                del self._jobs[job_id]
+            self._jobs[job.id] = job
+        self._executor.submit(self._run, job, run)
+        return job
+
+    def get(self, job_id):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def jobs(self):
+        with self._lock:
+            return list(self._jobs.values())
+
+    def _run(self, job, run):
+        try:
+            run(job.report)
+            job._finish()
+        except Exception as e:
+            logger.exception("Ingestion job %s failed", job.id)
+            job._finish(error=str(e) or type(e).__name__)
+        finally:
+            logger.info("Ingestion job %s %s: %s", job.id, job.status, ", ".join(job.filenames))
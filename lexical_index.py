@@ -0,0 +1,306 @@
+import os
+import re
+import sys
+import math
+import sqlite3
+import threading
+from collections import Counter
+
+from dotenv import load_dotenv
+from qdrant_setup import DEFAULT_TENANT
+from telemetry import get_logger, span
+
+# load API keys
+load_dotenv()
+
+logger = get_logger(__name__)
+
+# where the BM25 index files are kept, one sqlite file per collection
+LEXICAL_INDEX_DIR = os.getenv("LEXICAL_INDEX_DIR", "lexical_index")
+# BM25 term frequency saturation and document length normalization
+BM25_K1 = float(os.getenv("BM25_K1", 1.2))
+BM25_B = float(os.getenv("BM25_B", 0.75))
+# terms found in more than this share of the chunks are skipped like stopwords, once the index is large
+LEXICAL_MAX_DF_RATIO = float(os.getenv("LEXICAL_MAX_DF_RATIO", 0.2))
+# the most postings read per query term, highest term frequency first
+LEXICAL_MAX_POSTINGS = int(os.getenv("LEXICAL_MAX_POSTINGS", 1000))
+
+# runs of letters/digits, optionally joined by . _ @ + - so emails, IDs and filenames stay whole
+TOKEN_PATTERN = re.compile(r"\w+(?:[.@+\-]\w+)*")
+WORD_PATTERN = re.compile(r"[^\W_]+")
+
+def tokenize(text: str) -> list[str]:
+    """Splits text into lowercase terms for the BM25 index.
+
+    Compound tokens such as "jane.doe@example.com" or "INV-2024-001" are kept whole and
+    their word parts are added as well, so both exact and partial lookups match.
+    """
+    terms = []
+    for token in TOKEN_PATTERN.findall(text.lower()):
+        terms.append(token)
+        parts = WORD_PATTERN.findall(token)
+        if len(parts) > 1 or (parts and parts[0] != token):
+            terms.extend(parts)
+    return terms
+
+class _IndexFile:
+    """One index's sqlite connection, the lock serializing its use, and its cached corpus statistics."""
+
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.executescript(
+            "CREATE TABLE IF NOT EXISTS documents (point_id TEXT PRIMARY KEY, filename TEXT, length INTEGER NOT NULL);"
+            "CREATE INDEX IF NOT EXISTS documents_filename ON documents (filename);"
+            "CREATE TABLE IF NOT EXISTS postings (term TEXT NOT NULL, point_id TEXT NOT NULL, tf INTEGER NOT NULL, "
+            "PRIMARY KEY (term, point_id)) WITHOUT ROWID;"
+            "CREATE INDEX IF NOT EXISTS postings_point_id ON postings (point_id);"
+            "CREATE INDEX IF NOT EXISTS postings_term_tf ON postings (term, tf DESC);"
+            "CREATE TABLE IF NOT EXISTS terms (term TEXT PRIMARY KEY, df INTEGER NOT NULL) WITHOUT ROWID;"
+        )
+        # index files written before document frequencies were stored get them once
+        if self.db.execute("SELECT NOT EXISTS (SELECT 1 FROM terms) AND EXISTS (SELECT 1 FROM postings)").fetchone()[0]:
+            self.db.execute("INSERT INTO terms SELECT term, COUNT(*) FROM postings GROUP BY term")
+        self.db.commit()
+        # (chunk count, average chunk length), or None after a write
+        self.totals = None
+
+    def corpus_totals(self):
+        if self.totals is None:
+            self.totals = self.db.execute("SELECT COUNT(*), AVG(length) FROM documents").fetchone()
+        return self.totals
+
+    def remove(self, condition, args):
+        """Deletes the postings and documents of the points selected by a condition on documents."""
+        self.db.execute(
+            f"UPDATE terms SET df = df - (SELECT COUNT(*) FROM postings p JOIN documents d USING (point_id) "
+            f"WHERE p.term = terms.term AND {condition}) "
+            f"WHERE term IN (SELECT p.term FROM postings p JOIN documents d USING (point_id) WHERE {condition})",
+            args * 2,
+        )
+        self.db.execute("DELETE FROM terms WHERE df <= 0")
+        self.db.execute(f"DELETE FROM postings WHERE point_id IN (SELECT point_id FROM documents d WHERE {condition})", args)
+        self.db.execute(f"DELETE FROM documents AS d WHERE {condition}", args)
+        self.totals = None
+
+class LexicalIndex:
+    """Inverted BM25 index over the chunk text stored in each Qdrant collection.
+
+    Postings are kept in a sqlite file per collection and updated alongside the Qdrant
+    upserts and deletes, so keyword lookups need neither Qdrant nor the embeddings API.
+    Each file has its own lock, so lookups in one index never wait on writes to another.
+
+    Args:
+        directory: The directory the index files are kept in.
+    """
+
+    def __init__(self, directory=LEXICAL_INDEX_DIR):
+        self.directory = directory
+        self._collections = {}
+        self._lock = threading.Lock()
+
+    def add(self, collection: str, points):
+        """Indexes chunks, replacing any earlier postings of the same point IDs.
+
+        Args:
+            collection: The collection the points were upserted to.
+            points: (point ID, filename, text) triples.
+        """
+        points = list(points)
+        if not points:
+            return
+        index = self._load(collection)
+        with index.lock, span("lexical_index", size=len(points)):
+            # only points indexed before have postings to replace
+            ids = [str(point_id) for point_id, _, _ in points]
+            placeholders = ",".join("?" * len(ids))
+            for (point_id,) in index.db.execute(f"SELECT point_id FROM documents WHERE point_id IN ({placeholders})", ids).fetchall():
+                index.remove("d.point_id = ?", (point_id,))
+            documents = []
+            postings = []
+            frequencies = Counter()
+            for point_id, filename, text in points:
+                terms = Counter(tokenize(text))
+                documents.append((str(point_id), filename, sum(terms.values())))
+                postings.extend((term, str(point_id), count) for term, count in terms.items())
+                frequencies.update(terms.keys())
+            index.db.executemany("INSERT INTO documents VALUES (?, ?, ?)", documents)
+            index.db.executemany("INSERT INTO postings VALUES (?, ?, ?)", postings)
+            index.db.executemany(
+                "INSERT INTO terms VALUES (?, ?) ON CONFLICT (term) DO UPDATE SET df = df + excluded.df",
+                frequencies.items(),
+            )
+            index.db.commit()
+
+    def delete(self, collection: str, point_ids):
+        """Removes the given points from the index."""
+        ids = [str(point_id) for point_id in point_ids]
+        if not ids:
+            return
+        index = self._load(collection)
+        with index.lock:
+            for point_id in ids:
+                index.remove("d.point_id = ?", (point_id,))
+            index.db.commit()
+
+    def delete_file(self, collection: str, filename: str):
+        """Removes every point of a source document from the index."""
+        index = self._load(collection)
+        with index.lock:
+            index.remove("d.filename = ?", (filename,))
+            index.db.commit()
+
+    def clear(self, collection: str):
+        index = self._load(collection)
+        with index.lock:
+            index.db.execute("DELETE FROM postings")
+            index.db.execute("DELETE FROM documents")
+            index.db.execute("DELETE FROM terms")
+            index.db.commit()
+            index.totals = None
+
+    def search(self, collection: str, query: str, limit: int = 15):
+        """Ranks the indexed chunks against a query with BM25.
+
+        Terms found in more than LEXICAL_MAX_DF_RATIO of the chunks (and in more than
+        LEXICAL_MAX_POSTINGS chunks) are skipped like stopwords; if every term is that
+        common, only the rarest one is scored. Each scored term reads at most
+        LEXICAL_MAX_POSTINGS postings, highest term frequency first, so a lookup's cost
+        does not grow with the size of the index.
+
+        Args:
+            collection: The collection to search.
+            query: The user's query.
+            limit: The maximum number of hits returned.
+
+        Returns:
+            A list of (point ID, score, matched term count) tuples, best first, and the
+            number of query terms a chunk must match to contain the whole query, not
+            counting skipped common terms. When only the rarest of several common terms
+            was scored, no chunk can reach that number.
+        """
+        terms = list(dict.fromkeys(tokenize(query)))
+        if not terms:
+            return [], 0
+
+        index = self._load(collection)
+        with index.lock, span("lexical_search"):
+            total, average_length = index.corpus_totals()
+            if not total:
+                return [], len(terms)
+
+            placeholders = ",".join("?" * len(terms))
+            frequencies = dict(index.db.execute(f"SELECT term, df FROM terms WHERE term IN ({placeholders})", terms))
+            if not frequencies:
+                return [], len(terms)
+            limit_df = max(LEXICAL_MAX_DF_RATIO * total, LEXICAL_MAX_POSTINGS)
+            scored = [term for term in frequencies if frequencies[term] <= limit_df]
+            term_count = len(terms) - (len(frequencies) - len(scored))
+            if not scored:
+                scored = [min(frequencies, key=frequencies.get)]
+                term_count = len(terms)
+
+            postings = []
+            for term in scored:
+                postings.extend(
+                    (term, point_id, tf, length)
+                    for point_id, tf, length in index.db.execute(
+                        "SELECT p.point_id, p.tf, d.length FROM postings p JOIN documents d USING (point_id) "
+                        "WHERE p.term = ? ORDER BY p.tf DESC LIMIT ?",
+                        (term, LEXICAL_MAX_POSTINGS),
+                    )
+                )
+
+        scores = Counter()
+        matched = Counter()
+        for term, point_id, tf, length in postings:
+            df = frequencies[term]
+            idf = math.log(1 + (total - df + 0.5) / (df + 0.5))
+            norm = tf + BM25_K1 * (1 - BM25_B + BM25_B * length / (average_length or 1))
+            scores[point_id] += idf * tf * (BM25_K1 + 1) / norm
+            matched[point_id] += 1
+
+        return [(point_id, score, matched[point_id]) for point_id, score in scores.most_common(limit)], term_count
+
+    def stats(self):
+        stats = {}
+        for collection in self._stored_collections():
+            index = self._load(collection)
+            with index.lock:
+                documents = index.db.execute("SELECT COUNT(*) FROM documents").fetchone()[0]
+                terms = index.db.execute("SELECT COUNT(*) FROM terms").fetchone()[0]
+            stats[collection] = {"chunks": documents, "terms": terms}
+        return stats
+
+    def _stored_collections(self):
+        collections = set(self._collections)
+        if os.path.isdir(self.directory):
+            collections.update(name[:-len(".sqlite")] for name in os.listdir(self.directory) if name.endswith(".sqlite"))
+        return sorted(collections)
+
+    def _load(self, collection):
+        index = self._collections.get(collection)
+        if index is None:
+            with self._lock:
+                index = self._collections.get(collection)
+                if index is None:
+                    os.makedirs(self.directory, exist_ok=True)
+                    index = self._collections[collection] = _IndexFile(os.path.join(self.directory, f"{collection}.sqlite"))
+        return index
+
+# the index shared by ingestion and search
+lexical_index = LexicalIndex()
+
+def index_name(collection, tenant=DEFAULT_TENANT):
+    """Returns the name of the index holding one tenant's chunks of a collection.
+
+    Each tenant has its own index, so BM25 statistics and lookups only cover its own
+    documents. The default tenant keeps the collection's index from before tenants existed.
+    """
+    return collection if tenant == DEFAULT_TENANT else f"{collection}.{tenant}"
+
+def rebuild(qdrant_store, collection, index=lexical_index):
+    """Rebuilds a collection's per-tenant indexes from the chunk text stored in Qdrant.
+
+    Used to index collections that were populated before the lexical index existed.
+    Points without a tenant are indexed for the default tenant.
+    """
+    index.clear(collection)
+    cleared = {collection}
+    offset = None
+    indexed = 0
+    while True:
+        records, offset = qdrant_store.scroll(
+            collection_name=collection,
+            limit=256,
+            offset=offset,
+            with_payload=["content", "metadata.filename", "metadata.tenant"],
+            with_vectors=False,
+        )
+        by_index = {}
+        for record in records:
+            metadata = record.payload.get("metadata") or {}
+            name = index_name(collection, metadata.get("tenant", DEFAULT_TENANT))
+            by_index.setdefault(name, []).append((record.id, metadata.get("filename"), record.payload.get("content", "")))
+        for name, points in by_index.items():
+            # each index is emptied the first time it is reached
+            if name not in cleared:
+                index.clear(name)
+                cleared.add(name)
+            index.add(name, points)
+        indexed += len(records)
+        if offset is None:
+            logger.info("Rebuilt lexical index for %s: %d chunks.", collection, indexed)
+            return indexed
+
+if __name__ == "__main__":
+    # usage: python lexical_index.py rebuild [collection] | stats
+    command = sys.argv[1] if len(sys.argv) > 1 else "stats"
+
+    if command == "rebuild":
+        from clients import get_qdrant_client
+        from qdrant_setup import collection_name
+        rebuild(get_qdrant_client(), sys.argv[2] if len(sys.argv) > 2 else collection_name)
+    else:
+        import json
+        print(json.dumps(lexical_index.stats(), indent=2))
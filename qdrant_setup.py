@@ -1,48 +1,293 @@
-from qdrant_client import QdrantClient, models
+from qdrant_client import models
 import os
+import re
+import sys
 from dotenv import load_dotenv
+from clients import get_qdrant_client
+from telemetry import get_logger
 
 # load API keys
 load_dotenv()
 
-# Initialize Qdrant client
-qdrant_client = QdrantClient(
-    url='https://67be5618-eb3c-4be8-af45-490d7595393d.europe-west3-0.gcp.cloud.qdrant.io', 
-    api_key=os.getenv("QDRANT_API_KEY"))  # Adjust URL as needed
+logger = get_logger(__name__)
 
 # Define the collection name
 collection_name = "test_collection"
 
-def setup_qdrant_collection():
+# size of the OpenAI embeddings stored in the collection
+VECTOR_SIZE = 1536
+
+# storage layout of the collection, one of COLLECTION_PROFILES
+COLLECTION_PROFILE = os.getenv("COLLECTION_PROFILE", "default")
+
+# "default" keeps float32 vectors and payloads in RAM. "int8" and "binary" keep a quantized
+# copy of the vectors in RAM for the HNSW search, leave the float32 originals and the payloads
+# on disk, and rescore an oversampled candidate set against the originals.
+# int8 uses about a quarter of the vector RAM, binary about a thirty-second.
+COLLECTION_PROFILES = {
+    "default": {"quantization": None, "on_disk": False, "m": 16, "ef_construct": 100, "oversampling": None},
+    "int8": {"quantization": "scalar", "on_disk": True, "m": 16, "ef_construct": 200, "oversampling": 2.0},
+    "binary": {"quantization": "binary", "on_disk": True, "m": 32, "ef_construct": 256, "oversampling": 3.0},
+}
+
+# payload field holding the tenant (team) a point belongs to
+TENANT_FIELD = "metadata.tenant"
+# tenant used when none is given, e.g. by the command line tools
+DEFAULT_TENANT = os.getenv("DEFAULT_TENANT", "default")
+# place each tenant's points in its own shard, keyed by the tenant; needs a distributed Qdrant cluster
+TENANT_SHARDING = os.getenv("TENANT_SHARDING", "false").lower() in ("1", "true", "yes")
+# build HNSW graphs per tenant only, with no global graph; every search must then filter by tenant
+TENANT_HNSW = os.getenv("TENANT_HNSW", "false").lower() in ("1", "true", "yes")
+
+# tenant names are used in shard keys and index file names
+TENANT_PATTERN = re.compile(r"[A-Za-z0-9_-]{1,64}")
+
+# payload fields filtered on by search and deletion, and the index type each needs.
+# The tenant index is marked is_tenant, so Qdrant stores each tenant's points together.
+PAYLOAD_INDEXES = {
+    "metadata.filename": models.PayloadSchemaType.KEYWORD,
+    "metadata.filetype": models.PayloadSchemaType.KEYWORD,
+    "metadata.date_added": models.PayloadSchemaType.DATETIME,
+    TENANT_FIELD: models.KeywordIndexParams(type=models.KeywordIndexType.KEYWORD, is_tenant=True),
+}
+
+def collection_config(profile=COLLECTION_PROFILE):
+    """Returns the create_collection arguments for a collection profile.
+
+    Raises:
+        ValueError: If the profile is not one of COLLECTION_PROFILES.
+    """
+    if profile not in COLLECTION_PROFILES:
+        raise ValueError(f"Unknown collection profile {profile!r}, expected one of {', '.join(COLLECTION_PROFILES)}.")
+    settings = COLLECTION_PROFILES[profile]
+
+    quantization_config = None
+    if settings["quantization"] == "scalar":
+        quantization_config = models.ScalarQuantization(
+            scalar=models.ScalarQuantizationConfig(type=models.ScalarType.INT8, quantile=0.99, always_ram=True),
+        )
+    elif settings["quantization"] == "binary":
+        quantization_config = models.BinaryQuantization(
+            binary=models.BinaryQuantizationConfig(always_ram=True),
+        )
+
+    return {
+        "vectors_config": models.VectorParams(
+            size=VECTOR_SIZE,  # Adjust size based on the embedding model
+            distance=models.Distance.COSINE,
+            on_disk=settings["on_disk"],
+        ),
+        "hnsw_config": (
+            models.HnswConfigDiff(m=0, payload_m=settings["m"], ef_construct=settings["ef_construct"])
+            if TENANT_HNSW else
+            models.HnswConfigDiff(m=settings["m"], ef_construct=settings["ef_construct"])
+        ),
+        "quantization_config": quantization_config,
+        "on_disk_payload": settings["on_disk"],
+        "sharding_method": models.ShardingMethod.CUSTOM if TENANT_SHARDING else None,
+    }
+
+def search_params(profile=COLLECTION_PROFILE, hnsw_ef=128):
+    """Returns the search parameters matching a collection profile.
+
+    Quantized profiles search the in-RAM quantized vectors, then rescore oversampling
+    times as many candidates against the original vectors.
+    """
+    oversampling = COLLECTION_PROFILES[profile]["oversampling"]
+    quantization = None
+    if oversampling:
+        quantization = models.QuantizationSearchParams(ignore=False, rescore=True, oversampling=oversampling)
+    return models.SearchParams(hnsw_ef=hnsw_ef, exact=False, quantization=quantization)
+
+def validate_tenant(tenant):
+    """Returns the tenant name if it is valid.
+
+    Raises:
+        ValueError: If the name is not 1 to 64 letters, digits, dashes or underscores.
+    """
+    if not isinstance(tenant, str) or not TENANT_PATTERN.fullmatch(tenant):
+        raise ValueError(f"Invalid tenant {tenant!r}: use 1 to 64 letters, digits, '-' or '_'.")
+    return tenant
+
+def tenant_condition(tenant):
+    """Returns the filter condition restricting a request to one tenant's points.
+
+    Points stored before tenants existed have no tenant and belong to the default tenant,
+    so its condition matches them too.
+    """
+    condition = models.FieldCondition(key=TENANT_FIELD, match=models.MatchValue(value=tenant))
+    if tenant != DEFAULT_TENANT:
+        return condition
+    return models.Filter(should=[condition, models.IsEmptyCondition(is_empty=models.PayloadField(key=TENANT_FIELD))])
+
+def shard_key(tenant):
+    """Returns the shard key selector of a tenant, or None when tenants are not sharded."""
+    return tenant if TENANT_SHARDING else None
+
+_tenant_shards = set()
+
+def ensure_tenant_shard(name, tenant):
+    """Creates the tenant's shard key in the collection the first time the tenant writes to it.
+
+    Does nothing unless TENANT_SHARDING is set.
+    """
+    if not TENANT_SHARDING or (name, tenant) in _tenant_shards:
+        return
+    try:
+        get_qdrant_client().create_shard_key(name, tenant)
+        logger.info("Created shard key '%s' in '%s'.", tenant, name)
+    except Exception as e:
+        # the key usually exists already, from an earlier run
+        logger.debug("Shard key '%s' not created in '%s': %s", tenant, name, e)
+    _tenant_shards.add((name, tenant))
+
+def collection_exists(name):
+    """Checks whether a collection or an alias with the given name exists."""
+    qdrant_client = get_qdrant_client()
+    collections = [c.name for c in qdrant_client.get_collections().collections]
+    aliases = [a.alias_name for a in qdrant_client.get_aliases().aliases]
+    return name in collections or name in aliases
+
+def create_payload_indexes(name=collection_name):
+    """Creates the payload indexes in PAYLOAD_INDEXES that the collection does not have yet.
+
+    Without them, filters on these fields scan every point and filtered HNSW searches degrade.
+    """
+    qdrant_client = get_qdrant_client()
+    existing = qdrant_client.get_collection(name).payload_schema
+    for field, schema in PAYLOAD_INDEXES.items():
+        if field in existing:
+            continue
+        qdrant_client.create_payload_index(collection_name=name, field_name=field, field_schema=schema, wait=True)
+        logger.info("Created %s payload index on '%s' in '%s'.", getattr(schema, "value", None) or schema.type.value, field, name)
+
+def setup_qdrant_collection(profile=COLLECTION_PROFILE):
+    qdrant_client = get_qdrant_client()
     try:
         # Check if the collection exists
-        collections = qdrant_client.get_collections()
-        existing_collections = [c.name for c in collections.collections]
-        
-        if collection_name not in existing_collections:
+        if not collection_exists(collection_name):
             # Create the collection if it doesn't exist
             qdrant_client.create_collection(
                 collection_name=collection_name,
-                vectors_config=models.VectorParams(
-                    size=1536,  # Adjust size based on the embedding model
-                    distance=models.Distance.COSINE
-                )
+                **collection_config(profile),
             )
-            print(f"Collection '{collection_name}' created.")
+            logger.info("Collection '%s' created with the %s profile.", collection_name, profile)
         else:
-            print(f"Collection '{collection_name}' already exists.")
+            logger.info("Collection '%s' already exists.", collection_name)
+        create_payload_indexes(collection_name)
     except Exception as e:
-        print(f"Error setting up Qdrant collection: {e}")
+        logger.error("Error setting up Qdrant collection: %s", e)
 
 def clear_qdrant_collection():
+    qdrant_client = get_qdrant_client()
     try:
-        # Delete the collection if it exists
-        qdrant_client.delete_collection(collection_name=collection_name)
-        print(f"Collection '{collection_name}' deleted.")
+        # Delete the collection if it exists, including one the name is an alias of after a migration
+        aliases = {a.alias_name: a.collection_name for a in qdrant_client.get_aliases().aliases}
+        qdrant_client.delete_collection(collection_name=aliases.get(collection_name, collection_name))
+        logger.info("Collection '%s' deleted.", collection_name)
     except Exception as e:
-        print(f"Error clearing Qdrant collection: {e}")
+        logger.error("Error clearing Qdrant collection: %s", e)
+
+def migrate_collection(name=collection_name, profile=COLLECTION_PROFILE, batch_size=256):
+    """Rebuilds a collection under a new profile, keeping its points, IDs and name.
+
+    The points are copied into a new collection named "<name>_<profile>", and `name`
+    becomes an alias of it, so searches and uploads keep using the same name. The old
+    collection is deleted once the copy is complete. Uploads made while the copy runs
+    may be missed, so ingestion should be paused during a migration. Points without a
+    tenant are assigned DEFAULT_TENANT, and with TENANT_SHARDING each tenant's points are
+    copied into its own shard.
+
+    Args:
+        name: The collection (or alias) to migrate.
+        profile: The profile the new collection is created with.
+        batch_size: The number of points copied per request.
+
+    Returns:
+        The name of the new collection.
+    """
+    qdrant_client = get_qdrant_client()
+    aliases = {a.alias_name: a.collection_name for a in qdrant_client.get_aliases().aliases}
+    source = aliases.get(name, name)
+    target = f"{name}_{profile}"
+    if target == source:
+        raise ValueError(f"'{name}' already uses the {profile} profile.")
+
+    if qdrant_client.collection_exists(target):
+        qdrant_client.delete_collection(target)
+    qdrant_client.create_collection(collection_name=target, **collection_config(profile))
+    create_payload_indexes(target)
+
+    copied = 0
+    offset = None
+    while True:
+        records, offset = qdrant_client.scroll(
+            collection_name=source,
+            limit=batch_size,
+            offset=offset,
+            with_payload=True,
+            with_vectors=True,
+        )
+        by_tenant = {}
+        for r in records:
+            metadata = r.payload.setdefault("metadata", {})
+            tenant = metadata.setdefault("tenant", DEFAULT_TENANT)
+            by_tenant.setdefault(tenant, []).append(models.PointStruct(id=r.id, vector=r.vector, payload=r.payload))
+        for tenant, points in by_tenant.items():
+            ensure_tenant_shard(target, tenant)
+            qdrant_client.upsert(collection_name=target, points=points, shard_key_selector=shard_key(tenant))
+        copied += len(records)
+        logger.info("Copied %d points from '%s' to '%s'.", copied, source, target)
+        if offset is None:
+            break
+
+    source_count = qdrant_client.count(source, exact=True).count
+    if source_count != copied:
+        raise RuntimeError(f"Copied {copied} of {source_count} points from '{source}'; the migration was not applied.")
+
+    # point the name at the new collection
+    if name in aliases:
+        qdrant_client.update_collection_aliases(change_aliases_operations=[
+            models.DeleteAliasOperation(delete_alias=models.DeleteAlias(alias_name=name)),
+            models.CreateAliasOperation(create_alias=models.CreateAlias(collection_name=target, alias_name=name)),
+        ])
+        qdrant_client.delete_collection(source)
+    else:
+        qdrant_client.delete_collection(source)
+        qdrant_client.update_collection_aliases(change_aliases_operations=[
+            models.CreateAliasOperation(create_alias=models.CreateAlias(collection_name=target, alias_name=name)),
+        ])
+    logger.info("Collection '%s' now uses the %s profile (%d points).", name, profile, copied)
+    return target
+
+def assign_tenant(name=collection_name, tenant=DEFAULT_TENANT):
+    """Assigns a tenant to the points stored before collections were tenant-aware.
+
+    Until then they belong to the default tenant. Points that already have a tenant are
+    left as they are.
+    """
+    qdrant_client = get_qdrant_client()
+    validate_tenant(tenant)
+    qdrant_client.set_payload(
+        collection_name=name,
+        payload={"tenant": tenant},
+        key="metadata",
+        points=models.Filter(must=[models.IsEmptyCondition(is_empty=models.PayloadField(key=TENANT_FIELD))]),
+        wait=True,
+    )
+    logger.info("Points of '%s' without a tenant now belong to '%s'.", name, tenant)
 
 if __name__ == "__main__":
-    # Clear and set up the collection
-    clear_qdrant_collection()
-    setup_qdrant_collection()
+    # usage: python qdrant_setup.py [migrate [profile] | index | tenant [tenant]]
+    if len(sys.argv) > 1 and sys.argv[1] == "migrate":
+        migrate_collection(profile=sys.argv[2] if len(sys.argv) > 2 else COLLECTION_PROFILE)
+    elif len(sys.argv) > 1 and sys.argv[1] == "index":
+        # add the payload indexes to an existing collection in place
+        create_payload_indexes()
+    elif len(sys.argv) > 1 and sys.argv[1] == "tenant":
+        # give points stored before tenants existed a tenant; until then they belong to the default tenant
+        assign_tenant(tenant=sys.argv[2] if len(sys.argv) > 2 else DEFAULT_TENANT)
+    else:
+        # Clear and set up the collection
+        clear_qdrant_collection()
+        setup_qdrant_collection()
@@ -1,19 +1,50 @@
 import os
-import openai
-from qdrant_client import QdrantClient, models
-from langchain_openai import OpenAIEmbeddings
+import html
+import json
+import time
+import asyncio
+import logging
+import contextlib
+from qdrant_client import models
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
+from clients import close_async_clients, get_async_embedding_model, get_async_openai_client, get_async_qdrant_client, get_openai_client
+from caches import QueryEmbeddingCache, SummaryCache, summary_cache
+from embedding_scheduler import count_tokens
+from lexical_index import index_name, lexical_index
+from qdrant_setup import COLLECTION_PROFILE, DEFAULT_TENANT, search_params, shard_key, tenant_condition
+from telemetry import get_logger, observe, span
 
 # load API keys
 load_dotenv()
 
-# Initialize Qdrant client
-qdrant_client = QdrantClient(url='https://67be5618-eb3c-4be8-af45-490d7595393d.europe-west3-0.gcp.cloud.qdrant.io', 
-    api_key=os.getenv("QDRANT_API_KEY"))  # Adjust URL as needed
-
-# Initialize OpenAI Embeddings
-embedding_model = OpenAIEmbeddings(openai_api_key=os.getenv("OPENAI_API_KEY"))
+logger = get_logger(__name__)
+
+# Cache query embeddings so repeated questions skip the embeddings API;
+# set QUERY_EMBEDDING_CACHE_PATH to keep them across restarts
+query_embedding_cache = QueryEmbeddingCache(
+    max_entries=int(os.getenv("QUERY_EMBEDDING_CACHE_SIZE", 1024)),
+    path=os.getenv("QUERY_EMBEDDING_CACHE_PATH"),
+)
+
+# "dense" searches by embedding only, "hybrid" fuses BM25 and dense rankings, and
+# "lexical_first" answers from BM25 alone when its best match is confident
+RETRIEVAL_MODE = os.getenv("RETRIEVAL_MODE", "dense")
+# reciprocal rank fusion constant
+RRF_K = int(os.getenv("RRF_K", 60))
+# number of relevant chunks ordered by date when sorting by "Date Added"
+DATE_SORT_CANDIDATES = int(os.getenv("DATE_SORT_CANDIDATES", 100))
+# most pages fetched for one "Load more" while skipping pages of documents already shown
+PAGE_LOOKAHEAD_LIMIT = int(os.getenv("PAGE_LOOKAHEAD_LIMIT", 5))
+# labels of the scores shown on result cards
+SIMILARITY_SCORE = "Similarity Score"
+KEYWORD_SCORE = "Keyword Score"
+# how many times the best lexical hit must outscore the best hit from any other document to be confident
+LEXICAL_CONFIDENCE_MARGIN = float(os.getenv("LEXICAL_CONFIDENCE_MARGIN", 1.5))
+
+# runs BM25 lookups alongside the dense search, and the query embedding cache's disk tier
+retrieval_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="lexical")
 
 mime_type_mapping = {
     "application/pdf": "PDF",
@@ -31,11 +62,37 @@ mime_type_mapping = {
     "application/zip": "ZIP",
 }
 
-def search_qdrant(query: str, collection_name: str, top_k: int = 15, min_score: float = 0.8, sort_order="Relevance", start_date=None, end_date=None, enable_date_filter=False, selected_doc_types=None):
-    # Generate embedding for the query
-    query_embedding = embedding_model.embed_documents([query])[0]
-    print(f"Query embedding: {query_embedding}")
+# payload fields read when rendering results, fetched inline with the search
+RESULT_PAYLOAD_FIELDS = [
+    "content",
+    "metadata.filename",
+    "metadata.filetype",
+    "metadata.page_number",
+    "metadata.date_added",
+]
+
+async def embed_query(query: str):
+    """Embeds a search query, reusing the cached vector when the query was seen before."""
+    embedding_model = get_async_embedding_model()
+    model_name = getattr(embedding_model, "model", type(embedding_model).__name__)
+
+    # the sqlite tier is read and written on the executor, off the event loop
+    loop = asyncio.get_running_loop()
+    query_embedding = query_embedding_cache.get(model_name, query, disk=False)
+    if query_embedding is None and query_embedding_cache.persistent:
+        query_embedding = await loop.run_in_executor(retrieval_executor, query_embedding_cache.get, model_name, query)
+    if query_embedding is None:
+        with span("query_embedding"):
+            query_embedding = (await embedding_model.aembed_documents([query]))[0]
+        if query_embedding_cache.persistent:
+            await loop.run_in_executor(retrieval_executor, query_embedding_cache.put, model_name, query, query_embedding)
+        else:
+            query_embedding_cache.put(model_name, query, query_embedding)
+
+    return query_embedding
 
+def build_filter(start_date=None, end_date=None, enable_date_filter=False, selected_doc_types=None):
+    """Builds the Qdrant filter for the date range and document type settings, or None if nothing is filtered."""
     # Prepare filter conditions based on date range and document type
     must_conditions = []
 
@@ -75,167 +132,548 @@ def search_qdrant(query: str, collection_name: str, top_k: int = 15, min_score:
             )
 
     # Debug: Check if conditions are correctly added
-    print(f"Filter conditions: {must_conditions}")
+    logger.debug("Filter conditions: %s", must_conditions)
 
     # Construct the filter if there are any conditions
-    filter_condition = models.Filter(must=must_conditions) if must_conditions else None
+    return models.Filter(must=must_conditions) if must_conditions else None
+
+def tenant_filter(filter_condition, tenant):
+    """Adds the tenant condition to a filter, so a request only sees that tenant's points."""
+    if filter_condition is None:
+        return models.Filter(must=[tenant_condition(tenant)])
+    return models.Filter(
+        must=[tenant_condition(tenant), *(filter_condition.must or [])],
+        should=filter_condition.should,
+        must_not=filter_condition.must_not,
+    )
+
+async def dense_search(query: str, collection_name: str, top_k: int, min_score: float, filter_condition=None, tenant=DEFAULT_TENANT, query_embedding=None, offset=0):
+    """Runs a vector search over the tenant's points, dropping hits below min_score on the server.
+
+    The query is embedded unless its embedding is passed in. The first offset hits are skipped.
+    """
+    # Generate embedding for the query
+    if query_embedding is None:
+        query_embedding = await embed_query(query)
+    logger.debug("Query embedding: %s", query_embedding)
 
-    # Perform search in Qdrant with filters
-    results = qdrant_client.search(
+    # Perform search in Qdrant with filters, returning the needed payload fields inline
+    with span("qdrant_search"):
+        return await get_async_qdrant_client().search(
+            collection_name=collection_name,
+            query_vector=query_embedding,
+            limit=top_k,
+            offset=offset,
+            search_params=search_params(COLLECTION_PROFILE),  # rescores quantized candidates where the profile uses quantization
+            query_filter=tenant_filter(filter_condition, tenant),  # Correctly pass the filter to the search function
+            score_threshold=min_score,
+            with_payload=models.PayloadSelectorInclude(include=RESULT_PAYLOAD_FIELDS),
+            shard_key_selector=shard_key(tenant),
+        )
+
+async def lexical_ranking(query: str, collection_name: str, top_k: int, tenant=DEFAULT_TENANT):
+    """Looks the query up in the tenant's BM25 index.
+
+    Returns:
+        (point ID, BM25 score, matched term count) tuples, best first, and the number of
+        terms a chunk must match to contain the whole query.
+    """
+    # sqlite lookups block, so they run on the retrieval executor
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(retrieval_executor, lexical_index.search, index_name(collection_name, tenant), query, top_k)
+
+async def lexical_search(ranking, collection_name: str, min_score: float, filter_condition=None, tenant=DEFAULT_TENANT, query_embedding=None):
+    """Fetches the points of a BM25 ranking that pass the filter, in BM25 order.
+
+    BM25 scores are not comparable with similarity scores. Given the query embedding, the
+    hits are scored by their similarity to the query like dense hits, and those below
+    min_score are dropped. Without it, only chunks containing every query term are kept,
+    scored by BM25 relative to the best of them.
+
+    Args:
+        ranking: The ranking returned by lexical_ranking.
+
+    Returns:
+        The hits as ScoredPoints, and whether the top hit is confident enough to answer on
+        its own (only judged without a query embedding).
+    """
+    ranked, term_count = ranking
+    if query_embedding is None:
+        ranked = [(point_id, score, matched) for point_id, score, matched in ranked if matched == term_count]
+    if not ranked:
+        return [], False
+
+    # apply the tenant, date and document type filter and read the payloads in one request
+    query_filter = tenant_filter(filter_condition, tenant)
+    query_filter.must.append(models.HasIdCondition(has_id=[point_id for point_id, _, _ in ranked]))
+    if query_embedding is not None:
+        points = await get_async_qdrant_client().search(
+            collection_name=collection_name,
+            query_vector=query_embedding,
+            limit=len(ranked),
+            search_params=search_params(COLLECTION_PROFILE),
+            query_filter=query_filter,
+            score_threshold=min_score,
+            with_payload=models.PayloadSelectorInclude(include=RESULT_PAYLOAD_FIELDS),
+            shard_key_selector=shard_key(tenant),
+        )
+        points = {str(point.id): point for point in points}
+        return [points[point_id] for point_id, _, _ in ranked if point_id in points], False
+
+    records, _ = await get_async_qdrant_client().scroll(
         collection_name=collection_name,
-        query_vector=query_embedding,
-        limit=top_k,
-        search_params=models.SearchParams(hnsw_ef=128, exact=False),
-        query_filter=filter_condition  # Correctly pass the filter to the search function
+        scroll_filter=query_filter,
+        limit=len(ranked),
+        with_payload=models.PayloadSelectorInclude(include=RESULT_PAYLOAD_FIELDS),
+        with_vectors=False,
+        shard_key_selector=shard_key(tenant),
     )
-    
+    records = {str(record.id): record for record in records}
+
+    ranked = [(point_id, score) for point_id, score, _ in ranked if point_id in records]
+    if not ranked:
+        return [], False
+    hits = [
+        models.ScoredPoint(id=records[point_id].id, version=0, score=score / ranked[0][1], payload=records[point_id].payload)
+        for point_id, score in ranked
+    ]
+
+    # confident: the best chunk clearly beats every other document
+    top_source = (hits[0].payload.get("metadata") or {}).get("filename")
+    runner_up = next((hit.score for hit in hits if (hit.payload.get("metadata") or {}).get("filename") != top_source), 0.0)
+    return hits, hits[0].score >= LEXICAL_CONFIDENCE_MARGIN * runner_up
+
+def fuse_rankings(rankings, top_k: int, k: int = RRF_K):
+    """Merges ranked hit lists with reciprocal rank fusion.
+
+    Args:
+        rankings: Lists of ScoredPoints, each best first.
+        top_k: The number of fused hits returned.
+        k: The RRF constant; larger values flatten the advantage of top ranks.
+
+    Returns:
+        The top_k hits by fused rank. A point found by several lists keeps its score from
+        the first list it appears in.
+    """
+    fused = {}
+    points = {}
+    for ranking in rankings:
+        for rank, point in enumerate(ranking, start=1):
+            fused[point.id] = fused.get(point.id, 0.0) + 1 / (k + rank)
+            points.setdefault(point.id, point)
+    return [points[point_id] for point_id in sorted(fused, key=fused.get, reverse=True)[:top_k]]
+
+async def retrieve(query: str, collection_name: str, top_k: int, min_score: float, filter_condition=None, mode=RETRIEVAL_MODE, tenant=DEFAULT_TENANT):
+    """Finds the chunks most relevant to a query using the given retrieval mode.
+
+    Args:
+        mode: "dense" for vector search only, "hybrid" to run BM25 and vector search in
+            parallel and fuse them, or "lexical_first" to answer from BM25 alone when its
+            top hit is confident and fall back to hybrid otherwise.
+
+    Returns:
+        A list of ScoredPoints, best first, and what their scores are: SIMILARITY_SCORE,
+        or KEYWORD_SCORE for a lexical_first answer scored by BM25. Every hit that is
+        scored by similarity scores at least min_score.
+    """
+    if mode == "dense":
+        return await dense_search(query, collection_name, top_k, min_score, filter_condition, tenant), SIMILARITY_SCORE
+
+    if mode == "lexical_first":
+        ranking = await lexical_ranking(query, collection_name, top_k, tenant)
+        lexical_hits, confident = await lexical_search(ranking, collection_name, min_score, filter_condition, tenant)
+        if confident:
+            logger.debug("Confident lexical match, skipping dense retrieval")
+            return lexical_hits, KEYWORD_SCORE
+        query_embedding = await embed_query(query)
+    else:
+        query_embedding, ranking = await asyncio.gather(
+            embed_query(query),
+            lexical_ranking(query, collection_name, top_k, tenant),
+            return_exceptions=True,
+        )
+        if isinstance(query_embedding, BaseException):
+            raise query_embedding
+        if isinstance(ranking, BaseException):
+            logger.warning("Lexical search failed, using dense results only: %s", ranking)
+            ranking = ([], 0)
+
+    # keyword hits are rescored against the query embedding, so both lists share one score scale and cutoff
+    dense_hits, lexical_result = await asyncio.gather(
+        dense_search(query, collection_name, top_k, min_score, filter_condition, tenant, query_embedding),
+        lexical_search(ranking, collection_name, min_score, filter_condition, tenant, query_embedding),
+        return_exceptions=True,
+    )
+    if isinstance(dense_hits, BaseException):
+        raise dense_hits
+    if isinstance(lexical_result, BaseException):
+        logger.warning("Lexical search failed, using dense results only: %s", lexical_result)
+        lexical_hits = []
+    else:
+        lexical_hits, _ = lexical_result
+
+    return fuse_rankings([dense_hits, lexical_hits], top_k), SIMILARITY_SCORE
+
+async def relevance_page(query: str, collection_name: str, cursor, top_k: int, min_score: float, filter_condition=None, tenant=DEFAULT_TENANT):
+    """Fetches the next top_k hits in relevance order.
+
+    Returns:
+        The hits, the cursor of the following page, or None if there are no more hits,
+        and the label of the hits' scores.
+    """
+    offset = cursor.get("offset", 0)
+    # one hit past the page tells whether there is a next page
+    if RETRIEVAL_MODE == "dense":
+        # Qdrant skips the earlier pages itself
+        hits = await dense_search(query, collection_name, top_k + 1, min_score, filter_condition, tenant, offset=offset)
+        score_label = SIMILARITY_SCORE
+    else:
+        # fused rankings cannot be offset on the server, so the earlier pages are retrieved
+        # again; the query embedding is cached, so this only repeats the searches
+        hits, score_label = await retrieve(query, collection_name, offset + top_k + 1, min_score, filter_condition, mode=RETRIEVAL_MODE, tenant=tenant)
+        hits = hits[offset:]
+    next_cursor = {"offset": offset + top_k} if len(hits) > top_k else None
+    return hits[:top_k], next_cursor, score_label
+
+async def date_ordered_page(query: str, collection_name: str, cursor, top_k: int, min_score: float, filter_condition=None, tenant=DEFAULT_TENANT):
+    """Fetches the next top_k relevant hits, newest first.
+
+    The first page retrieves up to DATE_SORT_CANDIDATES relevant chunks; every page then
+    scrolls that candidate set with Qdrant's order_by on the indexed metadata.date_added,
+    starting from the date the previous page ended at.
+
+    Returns:
+        The hits, scored with their relevance score, the cursor of the following page, or
+        None if there are no more hits, and the label of the hits' scores.
+    """
+    candidates = cursor.get("candidates")
+    score_label = cursor.get("score_label")
+    if candidates is None:
+        hits, score_label = await retrieve(query, collection_name, DATE_SORT_CANDIDATES, min_score, filter_condition, mode=RETRIEVAL_MODE, tenant=tenant)
+        candidates = {str(hit.id): hit.score for hit in hits}
+    if not candidates:
+        return [], None, score_label
+
+    # points already shown are excluded, since start_from includes ties with the last date
+    shown = cursor.get("shown", [])
+    with span("qdrant_scroll"):
+        records, _ = await get_async_qdrant_client().scroll(
+            collection_name=collection_name,
+            scroll_filter=models.Filter(
+                must=[tenant_condition(tenant), models.HasIdCondition(has_id=list(candidates))],
+                must_not=[models.HasIdCondition(has_id=shown)] if shown else None,
+            ),
+            # one record past the page tells whether there is a next page
+            limit=top_k + 1,
+            order_by=models.OrderBy(
+                key="metadata.date_added",
+                direction=models.Direction.DESC,
+                start_from=cursor.get("start_from"),
+            ),
+            with_payload=models.PayloadSelectorInclude(include=RESULT_PAYLOAD_FIELDS),
+            with_vectors=False,
+            shard_key_selector=shard_key(tenant),
+        )
+
+    has_more = len(records) > top_k
+    records = records[:top_k]
+    hits = [models.ScoredPoint(id=record.id, version=0, score=candidates[str(record.id)], payload=record.payload) for record in records]
+    next_cursor = None
+    if has_more:
+        next_cursor = {
+            "candidates": candidates,
+            "score_label": score_label,
+            "start_from": datetime.fromisoformat(records[-1].payload["metadata"]["date_added"]),
+            "shown": shown + [str(record.id) for record in records],
+        }
+    return hits, next_cursor, score_label
+
+def search_qdrant(query: str, collection_name: str, top_k: int = 15, min_score: float = 0.8, sort_order="Relevance", start_date=None, end_date=None, enable_date_filter=False, selected_doc_types=None, tenant=DEFAULT_TENANT):
+    """Searches the collection and returns the first page of summarized results, or a "no information" message.
+
+    Synchronous wrapper around search_qdrant_async.
+    """
+    return run_async(search_qdrant_async(query, collection_name, top_k=top_k, min_score=min_score, sort_order=sort_order, start_date=start_date, end_date=end_date, enable_date_filter=enable_date_filter, selected_doc_types=selected_doc_types, tenant=tenant))
+
+async def search_qdrant_async(query: str, collection_name: str, top_k: int = 15, min_score: float = 0.8, sort_order="Relevance", start_date=None, end_date=None, enable_date_filter=False, selected_doc_types=None, tenant=DEFAULT_TENANT):
+    """Searches the collection and returns the first page of summarized results, or a "no information" message.
+
+    The embedding, Qdrant and summary requests are awaited, so concurrent searches overlap their network waits.
+    """
+    results, _ = await search_qdrant_page_async(query, collection_name, top_k=top_k, min_score=min_score, sort_order=sort_order, start_date=start_date, end_date=end_date, enable_date_filter=enable_date_filter, selected_doc_types=selected_doc_types, tenant=tenant)
+    return results or ["No information found in the knowledge base."]
+
+def result_source(result):
+    """Returns the filename of the document a hit belongs to."""
+    return (result.payload or {}).get("metadata", {}).get("filename")
+
+async def fetch_new_page(fetch_page, query: str, collection_name: str, cursor, top_k: int, min_score: float, filter_condition, tenant, seen_sources):
+    """Fetches pages from the cursor on until one holds a hit from a document not in seen_sources.
+
+    A page fetched ahead by the previous call is taken from the cursor instead of being
+    fetched again. At most PAGE_LOOKAHEAD_LIMIT pages are fetched.
+
+    Returns:
+        The hits of that page, the cursor of the page after it, or None if there are no
+        more hits, and the label of the hits' scores. If the limit is reached first, no
+        hits and the cursor to carry on from.
+    """
+    score_label = SIMILARITY_SCORE
+    for _ in range(PAGE_LOOKAHEAD_LIMIT):
+        if "page" in cursor:
+            hits, next_cursor, score_label = cursor["page"]
+        else:
+            hits, next_cursor, score_label = await fetch_page(query, collection_name, cursor, top_k, min_score, filter_condition, tenant)
+        if next_cursor is None or any(result_source(hit) not in seen_sources for hit in hits):
+            return hits, next_cursor, score_label
+        cursor = next_cursor
+    return [], cursor, score_label
+
+async def retrieve_page(query: str, collection_name: str, cursor=None, top_k: int = 15, min_score: float = 0.8, sort_order="Relevance", start_date=None, end_date=None, enable_date_filter=False, selected_doc_types=None, tenant=DEFAULT_TENANT):
+    """Searches the collection and groups one page of hits into result cards, one per document.
+
+    Args:
+        query: The user's query.
+        collection_name: The collection to search.
+        cursor: The cursor returned with the previous page, or None for the first page.
+        top_k: The number of chunks fetched per page.
+        min_score: The minimum similarity of a hit to the query.
+        sort_order: "Relevance", or "Date Added" for newest documents first.
+        tenant: The tenant whose documents are searched; no other tenant's points are read.
+
+    Returns:
+        A list of cards, one per document not shown on an earlier page, in result order,
+        and the cursor of the next page, or None if no other document is left to show.
+        A cursor is also returned, possibly leading to no cards, when PAGE_LOOKAHEAD_LIMIT
+        pages of shown documents were skipped without reaching the end.
+        Each card is a
+        dict with the document's source and tenant, best score and its label, top chunk
+        content, metadata, and the chunks and chunk IDs that matched.
+    """
+    cursor = cursor or {}
+    filter_condition = build_filter(start_date, end_date, enable_date_filter, selected_doc_types)
+    fetch_page = date_ordered_page if sort_order == "Date Added" else relevance_page
+
+    # documents already shown on an earlier page are not summarized again
+    seen_sources = set(cursor.get("seen_sources", ()))
+    results, next_cursor, score_label = await fetch_new_page(fetch_page, query, collection_name, cursor, top_k, min_score, filter_condition, tenant, seen_sources)
+    results = [result for result in results if result_source(result) not in seen_sources]
+
     # Debug: Print raw search results
-    print("Raw search results:", results)
+    logger.debug("Raw search results: %s", results)
 
     # Process results to avoid duplicates and summarize
     unique_sources = {}
     chunks_by_doc = {}
+    chunk_ids_by_doc = {}
 
     for result in results:
-        print(f"Processing result: ID={result.id}, Score={result.score}")
-        if result.score < min_score:
-            continue
-
-        # Retrieve the document using the ID
-        retrieve_result = qdrant_client.retrieve(
-            collection_name=collection_name,
-            ids=[result.id]
-        )
-        
-        # Debug: Print the retrieved result
-        print("Retrieve result:", retrieve_result)
-
-        if retrieve_result and isinstance(retrieve_result, list) and len(retrieve_result) > 0:
-            payload = retrieve_result[0].payload
-            content = payload.get("content", "")
-            metadata = payload.get("metadata", {})
-            source = metadata.get("filename", "")
-            filetype = metadata.get("filetype", "")
-
-            # Process the content and add to chunks_by_doc
-            if source and content:
-                print(f"Content: {content}\n")
-                print(f"Source{source}\n\n")
-                # for word... :(
-                if not (filetype.endswith("pdf") or filetype.endswith("pptx")):
-                    if source not in chunks_by_doc:
-                        chunks_by_doc[source] = [{
-                            'content': content,
-                            'page_number': 'not available',
-                        }]
-                    else:
-                        chunks_by_doc[source].append({
-                            'content': content,
-                            'page_number': 'not available',
-                        })
-                # for non-word
+        logger.debug("Processing result: ID=%s, Score=%s", result.id, result.score)
+
+        payload = result.payload or {}
+        content = payload.get("content", "")
+        metadata = payload.get("metadata", {})
+        source = metadata.get("filename", "")
+        filetype = metadata.get("filetype", "")
+
+        # Process the content and add to chunks_by_doc
+        if source and content:
+            logger.debug("Source: %s\nContent: %s", source, content)
+            # for word... :(
+            if not (filetype.endswith("pdf") or filetype.endswith("pptx")):
+                if source not in chunks_by_doc:
+                    chunks_by_doc[source] = [{
+                        'content': content,
+                        'page_number': 'not available',
+                    }]
                 else:
-                    if source not in chunks_by_doc:
-                        chunks_by_doc[source] = [{
-                            'content': content,
-                            'page_number': metadata['page_number'],
-                        }]
-                    else:
-                        chunks_by_doc[source].append({
-                            'content': content,
-                            'page_number': metadata['page_number'],
-                        })
-                    
-                # Only add to unique_sources if not already present
-                if source not in unique_sources:
-                    unique_sources[source] = {
-                        'score': result.score,
+                    chunks_by_doc[source].append({
                         'content': content,
-                        'metadata': metadata
-                    }
-    for key in chunks_by_doc.keys():
-        print(key)
-        for chunk in chunks_by_doc[key]:
-            print(f"Chunk: {chunk}")
-
-    # Check if no results were found
-    if not unique_sources:
-        print("No information found in the knowledge base.")
-        return ["No information found in the knowledge base."]
-
-    # Create summaries with hyperlinks
-    final_results = []
-
-    for source, data in unique_sources.items():
-        chunks = []
-        for chunk in chunks_by_doc[source]:
-            chunks.append(chunk)
-        summary = get_openai_summary(query, chunks)
-        # Ensure summary is a string
-        summary_str = summary if isinstance(summary, str) else str(summary)
-        # Extract the file type from the metadata
-        file_type = data['metadata'].get('filetype', '')
-
-        # Extract the file type display name using the mapping
-        file_type_display = mime_type_mapping.get(file_type, file_type.split('/')[-1].upper())
-    
-        # Format result text with Source, Summary, Content, and Score
-
-        # Extract and format the "date added"
-        date_added = data['metadata'].get('date_added', '')
-        if date_added:
-            try:
-                date_obj = datetime.fromisoformat(date_added)
-                formatted_date = date_obj.strftime('%b %d, %Y')
-            except ValueError:
-                formatted_date = '<b>Content Extract: </b>'
-            date_class = "date-added"  # Class for styled date
+                        'page_number': 'not available',
+                    })
+            # for non-word
+            else:
+                if source not in chunks_by_doc:
+                    chunks_by_doc[source] = [{
+                        'content': content,
+                        'page_number': metadata['page_number'],
+                    }]
+                else:
+                    chunks_by_doc[source].append({
+                        'content': content,
+                        'page_number': metadata['page_number'],
+                    })
+                
+            chunk_ids_by_doc.setdefault(source, []).append(result.id)
+
+            # Only add to unique_sources if not already present
+            if source not in unique_sources:
+                unique_sources[source] = {
+                    'score': result.score,
+                    'content': content,
+                    'metadata': metadata
+                }
+    if logger.isEnabledFor(logging.DEBUG):
+        for key in chunks_by_doc.keys():
+            logger.debug("%s chunks: %s", key, chunks_by_doc[key])
+
+    # look ahead past pages whose hits all belong to documents shown by now, so a cursor
+    # is only returned when another document is left; the page found is kept in the
+    # cursor, so the next call does not fetch it again
+    seen_sources.update(unique_sources)
+    if next_cursor is not None:
+        hits, following_cursor, following_label = await fetch_new_page(fetch_page, query, collection_name, next_cursor, top_k, min_score, filter_condition, tenant, seen_sources)
+        if any(result_source(hit) not in seen_sources for hit in hits):
+            next_cursor = {"page": (hits, following_cursor, following_label)}
         else:
-            formatted_date = '<b>Content Extract: </b>'
-            date_class = "date-not-available"  # Class for non-styled date
-        
-        content_preview = data['content']
-        if len(content_preview) > 200:
-            truncated_content = content_preview[:200].rsplit(' ', 1)[0]  # Truncate to the last complete word within 200 characters
-            content_preview = truncated_content + '...'
-        
-        # Extract and format the "page number"
-        page_numbers = set()
-        for chunk in chunks_by_doc[source]:
-            if chunk['page_number']:
-                page_numbers.add(chunk['page_number'])
-            
-        if not page_numbers:
-            page_numbers = "not available"
+            next_cursor = following_cursor
+    if next_cursor is not None:
+        next_cursor = {**next_cursor, "seen_sources": sorted(seen_sources)}
 
+    cards = [
+        {**data, "source": source, "tenant": tenant, "score_label": score_label, "chunks": chunks_by_doc[source], "chunk_ids": chunk_ids_by_doc[source]}
+        for source, data in unique_sources.items()
+    ]
+    return cards, next_cursor
 
-        result_text = (f"<b>Source:</b> {source}, <span class='{date_class}'>{formatted_date}</span><br>"
-                    #   <a href={source}>{source}</a>
-                       f"<b>Page(s):</b> {page_numbers}<br><br>"
-                    #    f"<span class='{date_class}'>{formatted_date}</span>"
-                    #    f"<span class='content-preview'>{content_preview}</span><br><br>"
-                       f"<b>Summary:</b> {summary_str} <br><br>"
-                       f"<b>Similarity Score: {round(data['score'], 3)}</b>"
-                       f"<span class='filetype-label'>{file_type_display}</span>"
-                       )
-        final_results.append(result_text)
+def search_qdrant_page(query: str, collection_name: str, cursor=None, top_k: int = 15, min_score: float = 0.8, sort_order="Relevance", start_date=None, end_date=None, enable_date_filter=False, selected_doc_types=None, tenant=DEFAULT_TENANT):
+    """Synchronous wrapper around search_qdrant_page_async."""
+    return run_async(search_qdrant_page_async(query, collection_name, cursor=cursor, top_k=top_k, min_score=min_score, sort_order=sort_order, start_date=start_date, end_date=end_date, enable_date_filter=enable_date_filter, selected_doc_types=selected_doc_types, tenant=tenant))
 
-    return final_results
+async def search_qdrant_page_async(query: str, collection_name: str, cursor=None, top_k: int = 15, min_score: float = 0.8, sort_order="Relevance", start_date=None, end_date=None, enable_date_filter=False, selected_doc_types=None, tenant=DEFAULT_TENANT):
+    """Searches the collection and summarizes one page of results.
 
+    Takes the same arguments as retrieve_page.
 
+    Returns:
+        A list of result HTML strings, one per document not shown on an earlier page, and
+        the cursor of the next page, or None if this was the last page.
+    """
+    cards, next_cursor = await retrieve_page(query, collection_name, cursor=cursor, top_k=top_k, min_score=min_score, sort_order=sort_order, start_date=start_date, end_date=end_date, enable_date_filter=enable_date_filter, selected_doc_types=selected_doc_types, tenant=tenant)
 
-from openai import OpenAI
+    # Check if no results were found
+    if not cards:
+        logger.info("No information found in the knowledge base.")
+        return [], next_cursor
+
+    summaries = await summarize_cards(query, cards)
+    return [render_result(card, format_summary(card, summary)) for card, summary in zip(cards, summaries)], next_cursor
+
+async def summarize_cards(query: str, cards):
+    """Summarizes result cards, reusing cached summaries for identical (query, chunks) inputs.
+
+    Returns:
+        A list of summaries aligned with cards, with None where a summary failed or timed out.
+    """
+    cache_keys = [SummaryCache.make_key(query, card["chunk_ids"], card["chunks"]) for card in cards]
+    summaries = [summary_cache.get(key) for key in cache_keys]
+    missing = [i for i, summary in enumerate(summaries) if summary is None]
+
+    # Generate the remaining summaries concurrently; results come back in relevance order
+    if missing:
+        summarize = summarize_sources_batched if SUMMARY_MODE == "batched" else summarize_sources
+        generated = await summarize(query, [cards[i]["chunks"] for i in missing])
+        for i, summary in zip(missing, generated):
+            summaries[i] = summary
+            if summary is not None:
+                summary_cache.put(cache_keys[i], cards[i]["tenant"], cards[i]["source"], summary)
+    return summaries
+
+def content_preview(card):
+    """Returns the start of the card's top chunk, cut at the last complete word within 200 characters."""
+    content_preview = card['content']
+    if len(content_preview) > 200:
+        truncated_content = content_preview[:200].rsplit(' ', 1)[0]  # Truncate to the last complete word within 200 characters
+        content_preview = truncated_content + '...'
+    return content_preview
+
+def format_summary(card, summary):
+    """Returns the summary HTML of a card, falling back to the content excerpt if the summary failed or timed out.
+
+    Both are escaped: they come from uploaded documents, which may hold markup of their own.
+    """
+    if summary is None:
+        return f"<span class='content-preview'>{html.escape(content_preview(card))}</span>"
+    # Ensure summary is a string
+    return html.escape(summary if isinstance(summary, str) else str(summary))
+
+def render_result(card, summary_html):
+    """Formats a result card as HTML with the source, date, pages, summary, score and file type."""
+    source = html.escape(card['source'])
+    # Extract the file type from the metadata
+    file_type = card['metadata'].get('filetype', '')
+
+    # Extract the file type display name using the mapping
+    file_type_display = mime_type_mapping.get(file_type, file_type.split('/')[-1].upper())
+
+    # Format result text with Source, Summary, Content, and Score
+
+    # Extract and format the "date added"
+    date_added = card['metadata'].get('date_added', '')
+    if date_added:
+        try:
+            date_obj = datetime.fromisoformat(date_added)
+            formatted_date = date_obj.strftime('%b %d, %Y')
+        except ValueError:
+            formatted_date = '<b>Content Extract: </b>'
+        date_class = "date-added"  # Class for styled date
+    else:
+        formatted_date = '<b>Content Extract: </b>'
+        date_class = "date-not-available"  # Class for non-styled date
+    
+    # Extract and format the "page number"
+    page_numbers = set()
+    for chunk in card['chunks']:
+        if chunk['page_number']:
+            page_numbers.add(chunk['page_number'])
+        
+    if not page_numbers:
+        page_numbers = "not available"
+
+
+    result_text = (f"<b>Source:</b> {source}, <span class='{date_class}'>{formatted_date}</span><br>"
+                #   <a href={source}>{source}</a>
+                   f"<b>Page(s):</b> {page_numbers}<br><br>"
+                #    f"<span class='{date_class}'>{formatted_date}</span>"
+                #    f"<span class='content-preview'>{content_preview}</span><br><br>"
+                   f"<b>Summary:</b> {summary_html} <br><br>"
+                   f"<b>{card.get('score_label', SIMILARITY_SCORE)}: {round(card['score'], 3)}</b>"
+                   f"<span class='filetype-label'>{file_type_display}</span>"
+                   )
+    return result_text
+
+
+
+# maximum number of summary requests in flight for a single query
+SUMMARY_MAX_CONCURRENCY = int(os.getenv("SUMMARY_MAX_CONCURRENCY", 8))
+# seconds to wait for a single summary before falling back to the content excerpt
+SUMMARY_TIMEOUT = float(os.getenv("SUMMARY_TIMEOUT", 15))
+# "per_document" sends one summary request per source; "batched" packs every source into a
+# single request with JSON output, falling back to per-document requests when over budget
+SUMMARY_MODE = os.getenv("SUMMARY_MODE", "per_document")
+# prompt tokens a batched summary request may use
+SUMMARY_BATCH_TOKEN_BUDGET = int(os.getenv("SUMMARY_BATCH_TOKEN_BUDGET", 12000))
+
+def summary_messages(query, content):
+    return [
+        {"role": "system", "content": "You are an assistant whose goal is to help the user search for documents in your information database that are most relevant to the topic or question they ask you."},
+        {"role": "user", "content": f"I will give you some excerpts from a document in the form of a list. Here is the user's query: {query}. Please respond to the query by providing a one to three sentence summary using information from the following content:\n\n{content}."}
+    ]
 
-client = OpenAI(
-    api_key=os.environ.get("OPENAI_API_KEY"),
+def get_openai_summary(query, content):
+    response = get_openai_client().chat.completions.create(
+        messages=summary_messages(query, content),
+        model="gpt-3.5-turbo",
+        max_tokens=100
     )
 
-def get_openai_summary(query, content):
-    response = client.chat.completions.create(
-        messages=[
-            {"role": "system", "content": "You are an assistant whose goal is to help the user search for documents in your information database that are most relevant to the topic or question they ask you."},
-            {"role": "user", "content": f"I will give you some excerpts from a document in the form of a list. Here is the user's query: {query}. Please respond to the query by providing a one to three sentence summary using information from the following content:\n\n{content}."}
-        ],
+    # Extract summary from the response
+    summary = response.choices[0].message.content
+    return summary
+
+async def get_openai_summary_async(async_client, query, content):
+    response = await async_client.chat.completions.create(
+        messages=summary_messages(query, content),
         model="gpt-3.5-turbo",
         max_tokens=100
     )
@@ -244,4 +682,203 @@ def get_openai_summary(query, content):
     summary = response.choices[0].message.content
     return summary
 
+async def stream_openai_summary(async_client, query, content):
+    """Streams a summary from the chat completions API, yielding tokens as they arrive.
+
+    The time until the first token is recorded as the llm_first_token stage.
+    """
+    start = time.perf_counter()
+    stream = await async_client.chat.completions.create(
+        messages=summary_messages(query, content),
+        model="gpt-3.5-turbo",
+        max_tokens=100,
+        stream=True,
+    )
+
+    first_token = True
+    # closing the stream hands its connection back to the shared client, also when abandoned early
+    async with stream:
+        async for chunk in stream:
+            token = chunk.choices[0].delta.content if chunk.choices else None
+            if not token:
+                continue
+            if first_token:
+                observe("llm_first_token", time.perf_counter() - start)
+                first_token = False
+            yield token
+
+async def stream_card_summary(query, card, timeout=SUMMARY_TIMEOUT, semaphore=None):
+    """Streams the summary of a result card, yielding the text generated so far as tokens arrive.
+
+    A cached summary is yielded whole, and a completed summary is added to the cache.
+    If the summary fails or takes longer than timeout seconds, a warning is logged and
+    the stream ends early with whatever text was generated.
+
+    Args:
+        semaphore: Optionally an asyncio.Semaphore shared by several streams, held while
+            this stream's request is in flight, so at most its value stream at once. The
+            timeout starts once it is acquired.
+    """
+    cache_key = SummaryCache.make_key(query, card["chunk_ids"], card["chunks"])
+    cached = summary_cache.get(cache_key)
+    if cached is not None:
+        yield cached
+        return
+
+    # the slot is held until the stream ends, including while the consumer handles each text
+    async with semaphore or contextlib.nullcontext():
+        text = ""
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        try:
+            tokens = stream_openai_summary(get_async_openai_client(), query, card["chunks"])
+            try:
+                with span("llm_summary"):
+                    while True:
+                        try:
+                            token = await asyncio.wait_for(anext(tokens), deadline - loop.time())
+                        except StopAsyncIteration:
+                            break
+                        text += token
+                        yield text
+            finally:
+                await tokens.aclose()
+        except Exception as e:
+            logger.warning("Error streaming summary: %r", e)
+            return
+
+    if text:
+        summary_cache.put(cache_key, card["tenant"], card["source"], text)
+
+async def summarize_sources(query, chunk_lists, max_concurrency=SUMMARY_MAX_CONCURRENCY, timeout=SUMMARY_TIMEOUT):
+    """Summarizes several documents' chunks concurrently.
+
+    Args:
+        query: The user's query.
+        chunk_lists: One list of chunks per document, in relevance order.
+        max_concurrency: The maximum number of summary requests in flight at once.
+        timeout: The number of seconds to wait for a single summary.
+
+    Returns:
+        A list of summaries in the same order as chunk_lists, with None for any
+        summary that failed or timed out.
+    """
+    semaphore = asyncio.Semaphore(max_concurrency)
+    async_client = get_async_openai_client()
+
+    async def summarize(chunks):
+        async with semaphore:
+            try:
+                with span("llm_summary"):
+                    return await asyncio.wait_for(get_openai_summary_async(async_client, query, chunks), timeout)
+            except Exception as e:
+                logger.warning("Error generating summary: %r", e)
+                return None
+
+    return await asyncio.gather(*(summarize(chunks) for chunks in chunk_lists))
+
+def count_message_tokens(messages):
+    """Counts the prompt tokens of chat messages, including the few tokens of formatting each message carries.
+
+    The encoding is loaded once; if it cannot be loaded, that is remembered too and the
+    counts are estimated from the text length.
+    """
+    return sum(count + 4 for count in count_tokens([message["content"] for message in messages], "gpt-3.5-turbo")) + 3
+
+def batch_summary_messages(query, chunk_lists):
+    documents = "\n\n".join(f"Document doc{i}:\n{chunks}" for i, chunks in enumerate(chunk_lists, start=1))
+    return [
+        {"role": "system", "content": "You are an assistant whose goal is to help the user search for documents in your information database that are most relevant to the topic or question they ask you."},
+        {"role": "user", "content": f"I will give you excerpts from {len(chunk_lists)} documents, each in the form of a list. Here is the user's query: {query}. For each document, respond to the query by providing a one to three sentence summary using only that document's excerpts. Reply with a JSON object of the form {{\"summaries\": [{{\"id\": \"doc1\", \"summary\": \"...\"}}]}} with one entry per document.\n\n{documents}"}
+    ]
+
+async def get_openai_batch_summary(async_client, messages, count):
+    """Requests summaries of several documents in one JSON-mode completion.
+
+    Returns:
+        A list of count summaries in document order, with None for any document the
+        response left out.
+    """
+    response = await async_client.chat.completions.create(
+        messages=messages,
+        model="gpt-3.5-turbo",
+        # room for each document's summary plus the JSON around it
+        max_tokens=120 * count,
+        response_format={"type": "json_object"},
+    )
+
+    summaries = [None] * count
+    for entry in json.loads(response.choices[0].message.content).get("summaries", []):
+        # malformed entries are left out, like missing ones
+        if not isinstance(entry, dict) or not isinstance(entry.get("summary"), str) or not entry["summary"]:
+            continue
+        index = str(entry.get("id", "")).removeprefix("doc")
+        if index.isdigit() and 1 <= int(index) <= count:
+            summaries[int(index) - 1] = entry["summary"]
+    return summaries
+
+async def summarize_sources_batched(query, chunk_lists, budget=SUMMARY_BATCH_TOKEN_BUDGET, timeout=SUMMARY_TIMEOUT):
+    """Summarizes several documents' chunks with a single request.
+
+    Falls back to summarize_sources when the packed prompt is over budget or cannot be
+    measured, and for any document the batched response fails to summarize.
+
+    Args:
+        query: The user's query.
+        chunk_lists: One list of chunks per document, in relevance order.
+        budget: The maximum number of prompt tokens of the batched request.
+        timeout: The number of seconds to wait for the batched request.
+
+    Returns:
+        A list of summaries in the same order as chunk_lists, with None for any
+        summary that failed or timed out.
+    """
+    if len(chunk_lists) < 2:
+        return await summarize_sources(query, chunk_lists, timeout=timeout)
+
+    messages = batch_summary_messages(query, chunk_lists)
+    try:
+        prompt_tokens = count_message_tokens(messages)
+    except Exception as e:
+        logger.warning("Could not count summary prompt tokens, summarizing per document: %r", e)
+        return await summarize_sources(query, chunk_lists, timeout=timeout)
+    if prompt_tokens > budget:
+        logger.info("Batched summary prompt is %d tokens, over the %d budget; summarizing per document.", prompt_tokens, budget)
+        return await summarize_sources(query, chunk_lists, timeout=timeout)
+
+    try:
+        with span("llm_batch_summary", documents=len(chunk_lists), tokens=prompt_tokens):
+            summaries = await asyncio.wait_for(get_openai_batch_summary(get_async_openai_client(), messages, len(chunk_lists)), timeout)
+    except Exception as e:
+        logger.warning("Error generating batched summary: %r", e)
+        summaries = [None] * len(chunk_lists)
+
+    missing = [i for i, summary in enumerate(summaries) if summary is None]
+    if missing:
+        generated = await summarize_sources(query, [chunk_lists[i] for i in missing], timeout=timeout)
+        for i, summary in zip(missing, generated):
+            summaries[i] = summary
+    return summaries
+
+def run_async(coro):
+    """Runs a coroutine to completion from synchronous code.
+
+    Inside a running event loop asyncio.run() is not allowed, so there the coroutine
+    gets a fresh loop on a worker thread; async callers should await it directly.
+    The async clients created on the new loop are closed before it ends.
+    """
+    async def run_and_close():
+        try:
+            return await coro
+        finally:
+            await close_async_clients()
+
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.run(run_and_close())
+
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        return executor.submit(asyncio.run, run_and_close()).result()
+
 # search_qdrant("What activities does Athena Deng enjoy?", "test_collection")
\ No newline at end of file
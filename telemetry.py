@@ -0,0 +1,141 @@
+import os
+import time
+import logging
+import threading
+from collections import deque
+from contextlib import contextmanager
+
+import numpy as np
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# DEBUG turns on verbose dumps (query vectors, raw search results, chunk text)
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+# number of most recent samples per stage used for percentiles
+METRICS_RESERVOIR_SIZE = int(os.getenv("METRICS_RESERVOIR_SIZE", 2048))
+# seconds between logged metric summaries; 0 turns the periodic summary off
+METRICS_LOG_INTERVAL = float(os.getenv("METRICS_LOG_INTERVAL", 0))
+
+logging.basicConfig(
+    level=LOG_LEVEL,
+    format="%(asctime)s %(levelname)s %(name)s: %(message)s",
+)
+
+def get_logger(name):
+    return logging.getLogger(name)
+
+logger = get_logger(__name__)
+
+class Histogram:
+    """Durations of one pipeline stage: total count and sum plus a window of recent samples."""
+
+    def __init__(self, reservoir_size=METRICS_RESERVOIR_SIZE):
+        self.count = 0
+        self.total = 0.0
+        self.samples = deque(maxlen=reservoir_size)
+
+    def observe(self, value):
+        self.count += 1
+        self.total += value
+        self.samples.append(value)
+
+    def summary(self):
+        p50, p95, p99 = np.percentile(self.samples, [50, 95, 99]) if self.samples else (0.0, 0.0, 0.0)
+        return {
+            "count": self.count,
+            "mean": self.total / self.count if self.count else 0.0,
+            "p50": float(p50),
+            "p95": float(p95),
+            "p99": float(p99),
+        }
+
+_histograms = {}
+_lock = threading.Lock()
+
+def observe(stage, seconds):
+    """Records one duration, in seconds, for a pipeline stage."""
+    with _lock:
+        histogram = _histograms.get(stage)
+        if histogram is None:
+            histogram = _histograms[stage] = Histogram()
+        histogram.observe(seconds)
+
+@contextmanager
+def span(stage, **attributes):
+    """Times the enclosed block and records it under the given stage.
+
+    Works in both synchronous and async code. Attributes are only used for the debug log line.
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        observe(stage, elapsed)
+        if logger.isEnabledFor(logging.DEBUG):
+            details = " ".join(f"{key}={value}" for key, value in attributes.items())
+            logger.debug("span %s took %.1f ms %s", stage, elapsed * 1000, details)
+
+def metrics_summary():
+    """Returns count, mean and p50/p95/p99 durations (seconds) for every recorded stage."""
+    with _lock:
+        return {stage: histogram.summary() for stage, histogram in sorted(_histograms.items())}
+
+def render_metrics():
+    """Renders the stage summaries in the Prometheus text exposition format."""
+    lines = [
+        "# HELP rag_stage_duration_seconds Duration of each search and ingestion stage.",
+        "# TYPE rag_stage_duration_seconds summary",
+    ]
+    for stage, summary in metrics_summary().items():
+        for quantile in ("p50", "p95", "p99"):
+            lines.append(f'rag_stage_duration_seconds{{stage="{stage}",quantile="0.{quantile[1:]}"}} {summary[quantile]:.6f}')
+        lines.append(f'rag_stage_duration_seconds_sum{{stage="{stage}"}} {summary["mean"] * summary["count"]:.6f}')
+        lines.append(f'rag_stage_duration_seconds_count{{stage="{stage}"}} {summary["count"]}')
+    return "\n".join(lines) + "\n"
+
+def render_cache_metrics(caches):
+    """Renders cache lookup counters and sizes in the Prometheus text exposition format.
+
+    Args:
+        caches: The stats() of each cache, keyed by cache name.
+    """
+    lines = [
+        "# HELP rag_cache_lookups_total Cache lookups by result.",
+        "# TYPE rag_cache_lookups_total counter",
+    ]
+    for name, stats in caches.items():
+        for field, result in (("hits", "hit"), ("disk_hits", "disk_hit"), ("misses", "miss")):
+            if field in stats:
+                lines.append(f'rag_cache_lookups_total{{cache="{name}",result="{result}"}} {stats[field]}')
+    lines += [
+        "# HELP rag_cache_entries Entries held by each cache tier.",
+        "# TYPE rag_cache_entries gauge",
+    ]
+    for name, stats in caches.items():
+        lines.append(f'rag_cache_entries{{cache="{name}",tier="memory"}} {stats["entries"]}')
+        if stats.get("disk_entries") is not None:
+            lines.append(f'rag_cache_entries{{cache="{name}",tier="disk"}} {stats["disk_entries"]}')
+    return "\n".join(lines) + "\n"
+
+def log_metrics_summary():
+    for stage, summary in metrics_summary().items():
+        logger.info(
+            "%s: count=%d p50=%.1fms p95=%.1fms p99=%.1fms",
+            stage, summary["count"], summary["p50"] * 1000, summary["p95"] * 1000, summary["p99"] * 1000,
+        )
+
+def start_periodic_summary(interval=METRICS_LOG_INTERVAL):
+    """Logs a metrics summary every interval seconds on a daemon thread, if interval is positive."""
+    if interval <= 0:
+        return None
+
+    def run():
+        while True:
+            time.sleep(interval)
+            log_metrics_summary()
+
+    thread = threading.Thread(target=run, name="metrics-summary", daemon=True)
+    thread.start()
+    return thread
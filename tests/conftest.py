@@ -0,0 +1,46 @@
+import pytest
+from qdrant_client import QdrantClient, models
+
+import clients
+import search_engine
+import unstructured_processing
+from benchmarks.fakes import AsyncQdrantAdapter, FakeEmbeddings, LockedClient, StubLLM
+from caches import QueryEmbeddingCache, SummaryCache
+from embedding_store import EmbeddingStore
+from lexical_index import LexicalIndex
+
+COLLECTION = "test_collection"
+DIM = 8
+
+@pytest.fixture
+def embeddings():
+    return FakeEmbeddings(dim=DIM)
+
+@pytest.fixture
+def llm():
+    return StubLLM(latency=0.0)
+
+@pytest.fixture
+def qdrant(tmp_path, monkeypatch, embeddings, llm):
+    """An in-process Qdrant collection shared by ingestion and search, with empty local stores and caches."""
+    qdrant = LockedClient(QdrantClient(":memory:"))
+    qdrant.create_collection(
+        collection_name=COLLECTION,
+        vectors_config=models.VectorParams(size=DIM, distance=models.Distance.COSINE),
+    )
+    monkeypatch.setattr(clients, "_clients", {
+        "qdrant": qdrant,
+        "async_qdrant": AsyncQdrantAdapter(qdrant),
+        "async_embeddings": embeddings,
+        "async_openai": llm,
+    })
+
+    index = LexicalIndex(tmp_path / "lexical_index")
+    summary_cache = SummaryCache()
+    monkeypatch.setattr(unstructured_processing, "embedding_store", EmbeddingStore(tmp_path / "embedding_store"))
+    monkeypatch.setattr(unstructured_processing, "lexical_index", index)
+    monkeypatch.setattr(unstructured_processing, "summary_cache", summary_cache)
+    monkeypatch.setattr(search_engine, "lexical_index", index)
+    monkeypatch.setattr(search_engine, "summary_cache", summary_cache)
+    monkeypatch.setattr(search_engine, "query_embedding_cache", QueryEmbeddingCache())
+    return qdrant
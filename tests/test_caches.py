@@ -0,0 +1,105 @@
+import asyncio
+import threading
+
+import caches
+import search_engine
+from caches import QueryEmbeddingCache, SummaryCache
+
+def test_query_embedding_cache_evicts_least_recently_used():
+    cache = QueryEmbeddingCache(max_entries=2)
+    cache.put("m", "first", [1.0])
+    cache.put("m", "second", [2.0])
+    cache.get("m", "first")
+    cache.put("m", "third", [3.0])
+
+    assert cache.get("m", "second") is None
+    assert cache.get("m", "  FIRST ") == [1.0]
+    assert cache.get("other", "first") is None
+    assert cache.stats()["hits"] == 2
+    assert cache.stats()["misses"] == 2
+
+def test_query_embedding_cache_disk_tier_survives_restarts(tmp_path):
+    path = tmp_path / "queries.sqlite"
+    QueryEmbeddingCache(path=path).put("m", "query", [0.5, 0.25])
+
+    cache = QueryEmbeddingCache(path=path)
+    # memory-only lookups leave the miss to the disk lookup that follows
+    assert cache.get("m", "query", disk=False) is None
+    assert cache.get("m", "query") == [0.5, 0.25]
+    assert cache.get("m", "query", disk=False) == [0.5, 0.25]
+    assert cache.get("m", "missing") is None
+
+    stats = cache.stats()
+    assert (stats["hits"], stats["disk_hits"], stats["misses"]) == (1, 1, 1)
+
+def test_query_embedding_cache_prunes_every_interval(tmp_path):
+    cache = QueryEmbeddingCache(path=tmp_path / "queries.sqlite", max_disk_entries=3, prune_interval=5)
+    for i in range(4):
+        cache.put("m", str(i), [float(i)])
+    assert cache.stats()["disk_entries"] == 4
+
+    cache.put("m", "4", [4.0])
+    assert cache.stats()["disk_entries"] == 3
+    # the newest entries are kept
+    assert QueryEmbeddingCache(path=tmp_path / "queries.sqlite").get("m", "4") == [4.0]
+    assert QueryEmbeddingCache(path=tmp_path / "queries.sqlite").get("m", "0") is None
+
+def test_embed_query_uses_the_disk_tier_off_the_event_loop(qdrant, embeddings, tmp_path, monkeypatch):
+    cache = QueryEmbeddingCache(path=tmp_path / "queries.sqlite")
+    monkeypatch.setattr(search_engine, "query_embedding_cache", cache)
+    lookups = []
+    get = cache.get
+
+    def record(*args, disk=True):
+        lookups.append((disk, threading.current_thread() is threading.main_thread()))
+        return get(*args, disk=disk)
+    monkeypatch.setattr(cache, "get", record)
+
+    vector = asyncio.run(search_engine.embed_query("budget"))
+    assert asyncio.run(search_engine.embed_query("Budget")) == vector
+    assert embeddings.requests == 1
+    # (disk tier, on the event loop's thread)
+    assert lookups == [(False, True), (True, False), (False, True)]
+    assert cache.stats()["disk_entries"] == 1
+
+def test_summary_key_depends_on_query_and_exact_chunks():
+    key = SummaryCache.make_key("Budget  report", ["1", "2"], ["a", "b"])
+
+    assert SummaryCache.make_key("budget report", ["1", "2"], ["a", "b"]) == key
+    assert SummaryCache.make_key("budget report", ["1", "2"], ["a", "changed"]) != key
+    assert SummaryCache.make_key("budget report", ["2", "1"], ["b", "a"]) != key
+    assert SummaryCache.make_key("budget", ["1", "2"], ["a", "b"]) != key
+
+def test_summary_cache_evicts_least_recently_used():
+    cache = SummaryCache(max_entries=2)
+    cache.put("first", "default", "a.pdf", "one")
+    cache.put("second", "default", "b.pdf", "two")
+    cache.get("first")
+    cache.put("third", "default", "c.pdf", "three")
+
+    assert cache.get("second") is None
+    assert cache.get("first") == "one"
+    assert cache.stats() == {"hits": 2, "misses": 1, "entries": 2}
+
+def test_summary_cache_expires_entries(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(caches.time, "monotonic", lambda: now[0])
+    cache = SummaryCache(ttl=60)
+    cache.put("key", "default", "a.pdf", "summary")
+
+    now[0] += 59
+    assert cache.get("key") == "summary"
+    now[0] += 2
+    assert cache.get("key") is None
+    assert cache.stats()["entries"] == 0
+
+def test_summary_cache_invalidates_by_tenant_and_source():
+    cache = SummaryCache()
+    cache.put("first", "default", "a.pdf", "one")
+    cache.put("second", "default", "a.pdf", "two")
+    cache.put("third", "default", "b.pdf", "three")
+    cache.put("fourth", "acme", "a.pdf", "four")
+
+    cache.invalidate_source("default", "a.pdf")
+
+    assert [cache.get(key) for key in ("first", "second", "third", "fourth")] == [None, None, "three", "four"]
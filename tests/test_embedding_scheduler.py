@@ -0,0 +1,87 @@
+import threading
+import time
+
+import httpx
+import openai
+import pytest
+
+import embedding_scheduler
+from embedding_scheduler import EmbeddingScheduler, pack_batches
+
+@pytest.mark.parametrize("token_counts, max_batch_size, max_request_tokens, expected", [
+    ([], 2, 100, []),
+    ([1, 1, 1, 1, 1], 2, 100, [(0, 2), (2, 4), (4, 5)]),
+    ([60, 30, 20, 90, 10], 10, 100, [(0, 2), (2, 3), (3, 5)]),
+    # a text larger than a whole request still goes out, on its own
+    ([10, 500, 10], 10, 100, [(0, 1), (1, 2), (2, 3)]),
+])
+def test_pack_batches(token_counts, max_batch_size, max_request_tokens, expected):
+    assert pack_batches(token_counts, max_batch_size, max_request_tokens) == expected
+
+class FlakyEmbeddings:
+    """Embeds each text as [its index], answering the first request of every batch with a 429.
+
+    Later batches answer sooner, so requests complete out of order.
+    """
+
+    model = "flaky-embedding"
+
+    def __init__(self):
+        self.seen = set()
+        self.lock = threading.Lock()
+
+    def embed_documents(self, texts):
+        with self.lock:
+            first_try = texts[0] not in self.seen
+            self.seen.add(texts[0])
+        if first_try:
+            request = httpx.Request("POST", "https://api.openai.com/v1/embeddings")
+            response = httpx.Response(429, request=request, headers={"retry-after": "0"})
+            raise openai.RateLimitError("rate limited", response=response, body=None)
+        time.sleep(0.05 / (1 + int(texts[0])))
+        return [[float(text)] for text in texts]
+
+def test_scheduler_keeps_order_under_rate_limits(monkeypatch):
+    monkeypatch.setattr(embedding_scheduler, "EMBED_MAX_BACKOFF", 0.01)
+    scheduler = EmbeddingScheduler(max_concurrency=4, max_batch_size=3)
+    texts = [str(i) for i in range(20)]
+
+    vectors = scheduler.embed(texts, FlakyEmbeddings())
+
+    assert vectors == [[float(i)] for i in range(20)]
+    assert scheduler.rate_limited == 7
+    assert scheduler.stats()["in_flight"] == 0
+
+def test_scheduler_gives_up_after_max_retries(monkeypatch):
+    monkeypatch.setattr(embedding_scheduler, "EMBED_MAX_BACKOFF", 0.01)
+    scheduler = EmbeddingScheduler(max_retries=0)
+
+    with pytest.raises(openai.RateLimitError):
+        scheduler.embed(["0"], FlakyEmbeddings())
+    assert scheduler.stats()["in_flight"] == 0
+
+def test_scheduler_does_not_retry_other_errors():
+    class BrokenEmbeddings:
+        model = "broken-embedding"
+        requests = 0
+
+        def embed_documents(self, texts):
+            self.requests += 1
+            raise ValueError("bad input")
+
+    scheduler = EmbeddingScheduler()
+    model = BrokenEmbeddings()
+
+    with pytest.raises(ValueError):
+        scheduler.embed(["0"], model)
+    assert model.requests == 1
+    assert scheduler.rate_limited == 0
+
+def test_rate_limit_halves_concurrency(monkeypatch):
+    monkeypatch.setattr(embedding_scheduler, "EMBED_MAX_BACKOFF", 0.01)
+    scheduler = EmbeddingScheduler(max_concurrency=8, max_batch_size=1)
+
+    # one batch, so no success afterwards grows the limit back
+    scheduler.embed(["0"], FlakyEmbeddings())
+
+    assert scheduler.concurrency_limit == 4
@@ -0,0 +1,50 @@
+from embedding_store import EmbeddingStore
+
+def vector(i, dim=4):
+    return [float(i)] * dim
+
+def test_store_evicts_least_recently_used(tmp_path):
+    store = EmbeddingStore(tmp_path, max_entries=3)
+    store.put_many("m", ["a", "b", "c"], [vector(1), vector(2), vector(3)])
+    # reading "a" makes "b" the least recently used
+    store.get_many("m", ["a"])
+    store.put_many("m", ["d"], [vector(4)])
+
+    assert store.get_many("m", ["a", "b", "c", "d"]) == [vector(1), None, vector(3), vector(4)]
+    assert store.stats()["m"]["entries"] == 3
+
+def test_store_reuses_evicted_rows(tmp_path):
+    store = EmbeddingStore(tmp_path, max_entries=2)
+    store.put_many("m", ["a", "b"], [vector(1), vector(2)])
+    capacity = store.stats()["m"]["capacity"]
+    for i in range(3, 10):
+        store.put_many("m", [str(i)], [vector(i)])
+
+    assert store.stats()["m"]["capacity"] == capacity
+    assert store.get_many("m", ["8", "9"]) == [vector(8), vector(9)]
+
+def test_store_survives_evict_compact_reopen(tmp_path):
+    texts = [f"text {i}" for i in range(10)]
+    store = EmbeddingStore(tmp_path, max_entries=6)
+    store.put_many("m", texts, [vector(i) for i in range(10)])
+    store.compact("m")
+
+    stats = store.stats()["m"]
+    assert stats == {"entries": 6, "capacity": 6, "free_rows": 0}
+
+    reopened = EmbeddingStore(tmp_path, max_entries=6)
+    assert reopened.stats()["m"] == stats
+    assert reopened.get_many("m", texts) == [None] * 4 + [vector(i) for i in range(4, 10)]
+
+    # the compacted matrix grows again on the next insert
+    reopened.put_many("m", ["new"], [vector(42)])
+    assert reopened.get_many("m", ["new", "text 9"]) == [vector(42), vector(9)]
+
+def test_store_keeps_models_apart(tmp_path):
+    store = EmbeddingStore(tmp_path)
+    store.put_many("small", ["a"], [vector(1, dim=2)])
+    store.put_many("large", ["a"], [vector(2, dim=8)])
+
+    reopened = EmbeddingStore(tmp_path)
+    assert reopened.get_many("small", ["a"]) == [vector(1, dim=2)]
+    assert reopened.get_many("large", ["a"]) == [vector(2, dim=8)]
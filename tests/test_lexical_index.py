@@ -0,0 +1,65 @@
+import lexical_index
+from lexical_index import LexicalIndex, tokenize
+
+def test_tokenize_keeps_compound_tokens_and_their_parts():
+    assert tokenize("Mail Jane.Doe@example.com about INV-2024-001") == [
+        "mail",
+        "jane.doe@example.com", "jane", "doe", "example", "com",
+        "about",
+        "inv-2024-001", "inv", "2024", "001",
+    ]
+
+def test_tokenize_splits_underscores_and_ignores_punctuation():
+    assert tokenize("snake_case, (quoted)!") == ["snake_case", "snake", "case", "quoted"]
+    assert tokenize("  ...  ") == []
+
+def test_search_ranks_by_bm25(tmp_path):
+    index = LexicalIndex(tmp_path)
+    index.add("c", [
+        ("1", "a.pdf", "invoice budget report"),
+        ("2", "a.pdf", "invoice invoice budget"),
+        ("3", "b.pdf", "meeting notes"),
+    ])
+
+    hits, term_count = index.search("c", "invoice budget")
+
+    assert term_count == 2
+    assert [(point_id, matched) for point_id, _, matched in hits] == [("2", 2), ("1", 2)]
+
+def test_unknown_terms_still_count_towards_the_whole_query(tmp_path):
+    index = LexicalIndex(tmp_path)
+    index.add("c", [("1", "a.pdf", "invoice")])
+
+    hits, term_count = index.search("c", "invoice INV-9")
+
+    # "invoice", "inv-9", "inv" and "9"
+    assert term_count == 4
+    assert [(point_id, matched) for point_id, _, matched in hits] == [("1", 1)]
+
+def test_common_terms_are_skipped(tmp_path, monkeypatch):
+    monkeypatch.setattr(lexical_index, "LEXICAL_MAX_POSTINGS", 2)
+    index = LexicalIndex(tmp_path)
+    index.add("c", [(str(i), "a.pdf", f"the report {i}") for i in range(10)] + [("rare", "b.pdf", "the budget")])
+
+    hits, term_count = index.search("c", "the budget")
+    assert term_count == 1
+    assert [(point_id, matched) for point_id, _, matched in hits] == [("rare", 1)]
+
+    # with every term that common, only the rarest is scored, and at most LEXICAL_MAX_POSTINGS chunks of it
+    hits, term_count = index.search("c", "the report")
+    assert term_count == 2
+    assert len(hits) == 2
+    assert all(matched == 1 for _, _, matched in hits)
+
+def test_add_replaces_and_delete_removes_postings(tmp_path):
+    index = LexicalIndex(tmp_path)
+    index.add("c", [("1", "a.pdf", "budget"), ("2", "b.pdf", "budget")])
+    index.add("c", [("1", "a.pdf", "invoice")])
+    assert [point_id for point_id, _, _ in index.search("c", "budget")[0]] == ["2"]
+
+    index.delete_file("c", "b.pdf")
+    assert index.search("c", "budget")[0] == []
+
+    reopened = LexicalIndex(tmp_path)
+    assert [point_id for point_id, _, _ in reopened.search("c", "invoice")[0]] == ["1"]
+    assert reopened.stats() == {"c": {"chunks": 1, "terms": 1}}
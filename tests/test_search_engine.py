@@ -0,0 +1,217 @@
+import json
+import asyncio
+import time
+from types import SimpleNamespace
+
+from langchain_core.documents import Document
+from qdrant_client import models
+
+import clients
+import search_engine
+from search_engine import format_summary, fuse_rankings, render_result
+from unstructured_processing import delete_points_by_source_document, store_chunks
+
+COLLECTION = "test_collection"
+
+def card(content="", source="report.pdf"):
+    return {"source": source, "content": content, "score": 0.9, "metadata": {}, "chunks": [{"page_number": 1}]}
+
+def test_excerpt_and_summary_are_escaped():
+    markup = "<img src=x onerror=alert(1)>"
+
+    assert "<img" not in format_summary(card(markup), None)
+    assert format_summary(card(), markup) == "&lt;img src=x onerror=alert(1)&gt;"
+    assert "<img" not in render_result(card(source=markup + ".pdf"), "")
+
+def point(point_id, score=0.0):
+    return models.ScoredPoint(id=point_id, version=0, score=score)
+
+def test_fuse_rankings_favours_points_found_by_both():
+    dense = [point("a", 0.9), point("b", 0.8), point("c", 0.7)]
+    lexical = [point("c", 12.0), point("d", 9.0), point("b", 3.0)]
+
+    fused = fuse_rankings([dense, lexical], top_k=4)
+
+    assert [hit.id for hit in fused] == ["c", "b", "a", "d"]
+    # points found by both lists keep the score of the first one
+    assert [hit.score for hit in fused[:2]] == [0.7, 0.8]
+
+def test_fuse_rankings_breaks_ties_by_first_seen_and_cuts_to_top_k():
+    fused = fuse_rankings([[point("a"), point("b")], [point("c"), point("d")]], top_k=3)
+
+    assert [hit.id for hit in fused] == ["a", "c", "b"]
+
+def test_fuse_rankings_of_one_list_keeps_its_order():
+    ranking = [point(i) for i in range(5)]
+
+    assert fuse_rankings([ranking], top_k=10) == ranking
+    assert fuse_rankings([], top_k=10) == []
+
+def ingest(qdrant, embeddings, files):
+    """Stores the given number of chunks mentioning "revenue" for each (filename, count), one file at a time."""
+    for filename, count in files:
+        chunks = [Document(page_content=f"{filename} part {i} revenue", metadata={"filename": filename, "filetype": "text/plain", "file_hash": "h"}) for i in range(count)]
+        store_chunks(chunks, embeddings, qdrant, COLLECTION)
+
+def all_pages(sort_order="Relevance", cursor=None, top_k=2):
+    """Loads pages from the cursor on until there are no more, returning the sources shown on each."""
+    pages = []
+    while True:
+        cards, cursor = asyncio.run(search_engine.retrieve_page("revenue", COLLECTION, cursor=cursor, top_k=top_k, min_score=-1.0, sort_order=sort_order))
+        pages.append([card["source"] for card in cards])
+        if cursor is None:
+            return pages
+
+def record_calls(monkeypatch, qdrant, name):
+    calls = []
+    method = getattr(qdrant, name)
+
+    def record(*args, **kwargs):
+        calls.append(kwargs)
+        return method(*args, **kwargs)
+    monkeypatch.setattr(qdrant, name, record)
+    return calls
+
+def test_pages_show_each_document_once(qdrant, embeddings, monkeypatch):
+    ingest(qdrant, embeddings, [("a.txt", 5), ("b.txt", 5), ("c.txt", 5)])
+    searches = record_calls(monkeypatch, qdrant, "search")
+
+    pages = all_pages()
+
+    assert sorted(source for page in pages for source in page) == ["a.txt", "b.txt", "c.txt"]
+    assert all(pages)
+    # dense pages are offset on the server, and no page is fetched twice
+    offsets = [call["offset"] for call in searches]
+    assert offsets == sorted(set(offsets))
+    assert all(call["limit"] == 3 for call in searches)
+
+def test_hybrid_pages_show_each_document_once(qdrant, embeddings, monkeypatch):
+    monkeypatch.setattr(search_engine, "RETRIEVAL_MODE", "hybrid")
+    ingest(qdrant, embeddings, [("a.txt", 5), ("b.txt", 5), ("c.txt", 5)])
+
+    pages = all_pages()
+
+    assert sorted(source for page in pages for source in page) == ["a.txt", "b.txt", "c.txt"]
+    assert all(pages)
+
+def test_lookahead_is_capped(qdrant, embeddings, monkeypatch):
+    monkeypatch.setattr(search_engine, "PAGE_LOOKAHEAD_LIMIT", 2)
+    ingest(qdrant, embeddings, [("a.txt", 1), ("b.txt", 12)])
+    searches = record_calls(monkeypatch, qdrant, "search")
+
+    cards, cursor = asyncio.run(search_engine.retrieve_page("revenue", COLLECTION, top_k=2, min_score=-1.0))
+
+    assert {card["source"] for card in cards} == {"a.txt", "b.txt"}
+    # the first page and at most two pages ahead
+    assert len(searches) == 3
+    assert cursor is not None
+
+    pages = [[card["source"] for card in cards]] + all_pages(cursor=cursor)
+    assert sorted(source for page in pages for source in page) == ["a.txt", "b.txt"]
+
+def test_date_ordered_pages_are_newest_first(qdrant, embeddings):
+    qdrant.create_payload_index(COLLECTION, "metadata.date_added", models.PayloadSchemaType.DATETIME)
+    for filename in ("old.txt", "middle.txt", "new.txt"):
+        ingest(qdrant, embeddings, [(filename, 3)])
+        time.sleep(0.01)
+
+    assert all_pages("Date Added") == [["new.txt"], ["middle.txt"], ["old.txt"]]
+
+def search_sources(tenant, sort_order="Relevance"):
+    cards, _ = asyncio.run(search_engine.retrieve_page("revenue", COLLECTION, top_k=10, min_score=-1.0, sort_order=sort_order, tenant=tenant))
+    return {card["source"]: card["chunk_ids"] for card in cards}
+
+def test_search_is_scoped_to_the_tenant(qdrant, embeddings):
+    for tenant in ("default", "acme"):
+        chunks = [Document(page_content=f"{tenant} report revenue", metadata={"filename": "report.pdf", "filetype": "text/plain", "file_hash": "h"})]
+        store_chunks(chunks, embeddings, qdrant, COLLECTION, tenant=tenant)
+
+    default, acme = search_sources("default"), search_sources("acme")
+
+    assert list(default) == list(acme) == ["report.pdf"]
+    assert set(default["report.pdf"]).isdisjoint(acme["report.pdf"])
+    assert search_sources("other") == {}
+
+def test_points_without_a_tenant_belong_to_the_default_tenant(qdrant, embeddings):
+    qdrant.create_payload_index(COLLECTION, "metadata.date_added", models.PayloadSchemaType.DATETIME)
+    qdrant.upsert(COLLECTION, points=[models.PointStruct(
+        id="6f1c0a3e-2b4d-4c8e-9a7f-0d5e3b2c1a90",
+        vector=embeddings.embed_query("legacy revenue"),
+        payload={"content": "legacy revenue", "metadata": {"filename": "legacy.txt", "filetype": "text/plain", "date_added": "2024-01-01T00:00:00"}},
+    )])
+
+    assert list(search_sources("default")) == ["legacy.txt"]
+    assert list(search_sources("default", "Date Added")) == ["legacy.txt"]
+    assert search_sources("acme") == {}
+
+    delete_points_by_source_document(None, COLLECTION, "legacy.txt", qdrant_only=True, tenant="acme")
+    assert qdrant.count(COLLECTION).count == 1
+    delete_points_by_source_document(None, COLLECTION, "legacy.txt", qdrant_only=True)
+    assert qdrant.count(COLLECTION).count == 0
+
+class ScriptedLLM:
+    """Answers batched requests with a fixed reply and single-document requests with "single"."""
+
+    def __init__(self, batch_reply):
+        self.batch_reply = batch_reply
+        self.batched = 0
+        self.single = 0
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self.create))
+
+    async def create(self, messages, response_format=None, **kwargs):
+        if response_format:
+            self.batched += 1
+            content = self.batch_reply
+        else:
+            self.single += 1
+            content = "single"
+        return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=content))])
+
+def summarize_batched(monkeypatch, reply, documents=3):
+    llm = ScriptedLLM(reply)
+    monkeypatch.setattr(clients, "_clients", {"async_openai": llm})
+    chunk_lists = [[{"content": f"document {i}", "page_number": 1}] for i in range(documents)]
+    return asyncio.run(search_engine.summarize_sources_batched("query", chunk_lists)), llm
+
+def test_batched_summaries_are_matched_by_id(monkeypatch):
+    reply = json.dumps({"summaries": [
+        {"id": "doc3", "summary": "third"},
+        {"id": "doc1", "summary": "first"},
+        {"id": "doc2", "summary": "second"},
+    ]})
+
+    summaries, llm = summarize_batched(monkeypatch, reply)
+
+    assert summaries == ["first", "second", "third"]
+    assert (llm.batched, llm.single) == (1, 0)
+
+def test_documents_the_batch_leaves_out_are_summarized_alone(monkeypatch):
+    reply = json.dumps({"summaries": [
+        {"id": "doc2", "summary": "second"},
+        {"id": "doc0", "summary": "out of range"},
+        {"id": "doc9", "summary": "out of range"},
+        {"id": "doc3", "summary": ""},
+        {"id": "doc1", "summary": {"text": "not a string"}},
+        "not an object",
+    ]})
+
+    summaries, llm = summarize_batched(monkeypatch, reply)
+
+    assert summaries == ["single", "second", "single"]
+    assert (llm.batched, llm.single) == (1, 2)
+
+def test_unparseable_batch_falls_back_to_single_summaries(monkeypatch):
+    summaries, llm = summarize_batched(monkeypatch, "not json")
+
+    assert summaries == ["single", "single", "single"]
+    assert (llm.batched, llm.single) == (1, 3)
+
+def test_over_budget_batch_is_not_sent(monkeypatch):
+    llm = ScriptedLLM("{}")
+    monkeypatch.setattr(clients, "_clients", {"async_openai": llm})
+    chunk_lists = [[{"content": "word " * 200, "page_number": 1}] for _ in range(2)]
+
+    summaries = asyncio.run(search_engine.summarize_sources_batched("query", chunk_lists, budget=100))
+
+    assert summaries == ["single", "single"]
+    assert (llm.batched, llm.single) == (0, 2)
@@ -0,0 +1,112 @@
+import pytest
+from langchain_core.documents import Document
+from qdrant_client import models
+
+import unstructured_processing
+from unstructured_processing import chunk_point_id, is_file_indexed, store_chunks
+
+COLLECTION = "test_collection"
+
+def documents(filename, texts, file_hash):
+    return [Document(page_content=text, metadata={"filename": filename, "file_hash": file_hash}) for text in texts]
+
+def stored(qdrant, filename):
+    records, _ = qdrant.scroll(
+        COLLECTION,
+        scroll_filter=models.Filter(must=[models.FieldCondition(key="metadata.filename", match=models.MatchValue(value=filename))]),
+        limit=100,
+        with_payload=True,
+    )
+    return {str(record.id): record.payload for record in records}
+
+def test_chunk_point_id_is_stable_and_scoped():
+    point_id = chunk_point_id("report.pdf", "text")
+
+    assert chunk_point_id("report.pdf", "text") == point_id
+    assert chunk_point_id("report.pdf", "text", tenant="default") == point_id
+    assert len({point_id, chunk_point_id("other.pdf", "text"), chunk_point_id("report.pdf", "text", 1), chunk_point_id("report.pdf", "text", tenant="acme")}) == 4
+
+def test_reingest_keeps_unchanged_chunks_and_replaces_the_rest(qdrant, embeddings):
+    store_chunks(documents("report.pdf", ["a", "b", "c"], "v1"), embeddings, qdrant, COLLECTION)
+    first = stored(qdrant, "report.pdf")
+    requests = embeddings.requests
+
+    store_chunks(documents("report.pdf", ["a", "c", "d"], "v2"), embeddings, qdrant, COLLECTION)
+    second = stored(qdrant, "report.pdf")
+
+    assert sorted(payload["content"] for payload in second.values()) == ["a", "c", "d"]
+    # unchanged chunks keep their points; only "d" was embedded
+    assert {point_id for point_id, payload in first.items() if payload["content"] in ("a", "c")} < set(second)
+    assert embeddings.requests == requests + 1
+    assert {payload["metadata"]["file_hash"] for payload in second.values()} == {"v2"}
+    assert is_file_indexed(qdrant, COLLECTION, "report.pdf", "v2")
+    assert not is_file_indexed(qdrant, COLLECTION, "report.pdf", "v1")
+
+def test_repeated_chunks_get_their_own_points(qdrant, embeddings):
+    store_chunks(documents("report.pdf", ["same", "same", "other"], "v1"), embeddings, qdrant, COLLECTION)
+    store_chunks(documents("report.pdf", ["same", "other"], "v2"), embeddings, qdrant, COLLECTION)
+
+    assert sorted(payload["content"] for payload in stored(qdrant, "report.pdf").values()) == ["other", "same"]
+
+def test_files_are_synced_independently(qdrant, embeddings):
+    store_chunks(documents("a.pdf", ["x", "y"], "a1") + documents("b.pdf", ["x"], "b1"), embeddings, qdrant, COLLECTION)
+    store_chunks(documents("a.pdf", ["y"], "a2"), embeddings, qdrant, COLLECTION)
+
+    assert [payload["content"] for payload in stored(qdrant, "a.pdf").values()] == ["y"]
+    assert [payload["content"] for payload in stored(qdrant, "b.pdf").values()] == ["x"]
+    assert is_file_indexed(qdrant, COLLECTION, "b.pdf", "b1")
+
+def test_interleaved_files_are_rejected(qdrant, embeddings):
+    chunks = documents("a.pdf", ["x"], "a") + documents("b.pdf", ["y"], "b") + documents("a.pdf", ["z"], "a")
+
+    with pytest.raises(ValueError):
+        store_chunks(chunks, embeddings, qdrant, COLLECTION)
+
+class FailingEmbeddings:
+    """Embeds the first request, then fails every later one."""
+
+    model = "failing-embedding"
+
+    def __init__(self, embeddings):
+        self.embeddings = embeddings
+        self.requests = 0
+
+    def embed_documents(self, texts):
+        self.requests += 1
+        if self.requests > 1:
+            raise ValueError("embeddings unavailable")
+        return self.embeddings.embed_documents(texts)
+
+def test_partly_stored_file_is_not_reported_indexed(qdrant, embeddings):
+    failing = FailingEmbeddings(embeddings)
+
+    with pytest.raises(ValueError):
+        store_chunks(documents("report.pdf", ["a", "b", "c", "d"], "v1"), failing, qdrant, COLLECTION, batch_size=2)
+
+    assert len(stored(qdrant, "report.pdf")) == 2
+    assert not is_file_indexed(qdrant, COLLECTION, "report.pdf", "v1")
+
+    store_chunks(documents("report.pdf", ["a", "b", "c", "d"], "v1"), embeddings, qdrant, COLLECTION, batch_size=2)
+    assert is_file_indexed(qdrant, COLLECTION, "report.pdf", "v1")
+
+def test_is_file_indexed_counts_exactly(qdrant, embeddings, monkeypatch):
+    store_chunks(documents("report.pdf", ["a"], "v1"), embeddings, qdrant, COLLECTION)
+    counts = []
+    count = qdrant.count
+
+    def record(*args, **kwargs):
+        counts.append(kwargs.get("exact"))
+        return count(*args, **kwargs)
+    monkeypatch.setattr(qdrant, "count", record)
+
+    assert is_file_indexed(qdrant, COLLECTION, "report.pdf", "v1")
+    assert counts == [True]
+
+def test_reingest_keeps_other_tenants_summaries(qdrant, embeddings):
+    unstructured_processing.summary_cache.put("default summary", "default", "report.pdf", "summary")
+    unstructured_processing.summary_cache.put("acme summary", "acme", "report.pdf", "summary")
+
+    store_chunks(documents("report.pdf", ["a"], "v1"), embeddings, qdrant, COLLECTION, tenant="acme")
+
+    assert unstructured_processing.summary_cache.get("default summary") == "summary"
+    assert unstructured_processing.summary_cache.get("acme summary") is None
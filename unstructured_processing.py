@@ -1,78 +1,313 @@
 import os
-from unstructured_ingest.connector.local import SimpleLocalConfig
-from unstructured_ingest.interfaces import (
-    PartitionConfig,
-    ProcessorConfig,
-    ReadConfig,
-)
-from unstructured_ingest.runner import LocalRunner
 
-from unstructured.staging.base import elements_from_json
-from unstructured.chunking.title import chunk_by_title
+from langchain_core.documents import Document
+from clients import get_ingestion_embedding_model, get_qdrant_client
+from caches import summary_cache
+from embedding_store import EmbeddingStore
+from embedding_scheduler import EmbeddingScheduler
+from ingestion_queue import INGEST_WORKERS
+from lexical_index import index_name, lexical_index
+from qdrant_setup import DEFAULT_TENANT, ensure_tenant_shard, shard_key, tenant_condition, validate_tenant
+from telemetry import get_logger, span
 
-from langchain.schema import Document
-from qdrant_setup import qdrant_client
-
-from qdrant_client import QdrantClient, models
-from langchain_openai import OpenAIEmbeddings
+from qdrant_client import models
 
 from datetime import datetime
+from itertools import groupby
+from typing import Iterable
 
+import glob
 import uuid
 import math
+import hashlib
+import orjson
 from dotenv import load_dotenv
 
 # load API keys
 load_dotenv()
 
-def process_files(upload_directory, output_directory, qdrant_client, embedding_model, collection):
+logger = get_logger(__name__)
+
+# most chunks sent to the embeddings API per request
+EMBED_BATCH_SIZE = int(os.getenv("EMBED_BATCH_SIZE", 64))
+# most embedding requests allowed in flight at once; lowered automatically while rate limited
+EMBED_MAX_CONCURRENCY = int(os.getenv("EMBED_MAX_CONCURRENCY", 4))
+# number of chunks embedded and upserted together; bounds in-flight memory during ingestion
+UPSERT_BATCH_SIZE = int(os.getenv("UPSERT_BATCH_SIZE", EMBED_BATCH_SIZE * EMBED_MAX_CONCURRENCY))
+
+# "api" partitions with the Unstructured API, "local" partitions in-process without it
+PARTITION_BACKEND = os.getenv("PARTITION_BACKEND", "api")
+# partitioning strategy used by the local backend
+PARTITION_STRATEGY = os.getenv("PARTITION_STRATEGY", "fast")
+# number of documents partitioned in parallel by each ingestion job; defaults to the
+# cores shared out among the INGEST_WORKERS jobs that can run at once
+PARTITION_PROCESSES = int(os.getenv("PARTITION_PROCESSES", max(1, (os.cpu_count() or 1) // INGEST_WORKERS)))
+
+# local store of previously paid-for embeddings, keyed by model and text hash
+embedding_store = EmbeddingStore()
+
+# paces embedding requests to the account's quota, shared by all ingestion jobs
+embedding_scheduler = EmbeddingScheduler(max_concurrency=EMBED_MAX_CONCURRENCY, max_batch_size=EMBED_BATCH_SIZE)
+
+# namespace for deterministic point IDs derived from filename and chunk text
+POINT_ID_NAMESPACE = uuid.UUID("3f6f1c64-8f0e-4a8e-9d4b-6a1f0f6d2c57")
+
+def process_files(upload_directory, output_directory, qdrant_client, embedding_model, collection, progress=None, tenant=DEFAULT_TENANT):
+    """Partitions, chunks, embeds and uploads the documents in the upload directory.
+
+    Args:
+        upload_directory: The directory the uploaded documents are taken from.
+        output_directory: The directory the partitioned .json files are written to.
+        qdrant_client: The qdrant store the vectors will be stored in.
+        embedding_model: The embedding model used to convert the chunks into vectors.
+        collection: The collection the vectors will be stored in.
+        progress: Optionally called as progress(stage, done, total) as the run moves through
+            the partitioning, embedding and upserting stages.
+        tenant: The tenant the documents are stored for.
+
+    Raises:
+        RuntimeError: If the documents could not be partitioned, or some of them could not
+            be partitioned (after the others were stored).
+        ValueError: If the tenant name is invalid.
+    """
+    progress = progress or (lambda stage, done=None, total=None: None)
+    validate_tenant(tenant)
+
+    # skip files whose exact contents are already indexed
+    file_hashes = {}
+    for filename in os.listdir(upload_directory):
+        filepath = os.path.join(upload_directory, filename)
+        if not os.path.isfile(filepath):
+            continue
+        file_hash = file_sha256(filepath)
+        if is_file_indexed(qdrant_client, collection, filename, file_hash, tenant):
+            logger.info("Skipping unchanged file: %s", filename)
+            continue
+        file_hashes[filename] = file_hash
+
+    if not file_hashes:
+        logger.info("No new or changed files to process.")
+        return
+
     # parse document and get json file (can comment out once json files are created)
-    preprocess_documents(upload_directory, output_directory)
+    progress("partitioning", 0, len(file_hashes))
+    if not preprocess_documents(upload_directory, output_directory, files=list(file_hashes), reprocess=True):
+        raise RuntimeError("Documents could not be partitioned.")
+    progress("partitioning", len(file_hashes), len(file_hashes))
+
+    # documents that failed to partition have no output; the rest are still stored
+    failed = [filename for filename in file_hashes if not os.path.isfile(partition_output_path(output_directory, filename))]
+    for filename in failed:
+        del file_hashes[filename]
     
-    # convert json data to chunks and then to langchain docs
-    chunked_docs = process_chunks(output_directory)
-    langchain_docs = chunks_to_docs(chunked_docs)
+    # stream json data to chunks and then to langchain docs, one file at a time
+    langchain_docs = iter_documents(iter_chunks(output_directory, files=list(file_hashes)))
+    langchain_docs = tag_file_hashes(langchain_docs, file_hashes)
     
-    # upload chunks to qdrant
-    store_chunks(langchain_docs, embedding_model, qdrant_client, collection)
+    # embed and upload chunks to qdrant in bounded batches as they are produced
+    store_chunks(langchain_docs, embedding_model, qdrant_client, collection, progress=progress, tenant=tenant)
+
+    if failed:
+        raise RuntimeError(f"Could not partition {', '.join(failed)}.")
 
 # ----- Helper Functions ----- #
 
-def preprocess_documents(input_dir, output_dir): # doc_input_path, output_path
-    """Chunks the documents in the input directory and outputs them as .json files.
+def preprocess_documents(input_dir, output_dir, files=None, backend=PARTITION_BACKEND, reprocess=False): # doc_input_path, output_path
+    """Partitions the documents in the input directory and outputs one .json file per document.
+
+    Outputs of documents that are not being processed are left in place, and a document
+    whose .json output is newer than the document itself is skipped unless reprocess is set.
+    The old output of a document being processed is deleted first, so a document that fails
+    to partition has no output.
 
     Args:
         input_dir: The directory which the original documents will be taken from
         output_dir: The directory which the json files containing the smaller chunks will be stored in.
+        files: The names of the files in input_dir to process, or None to process all of them.
+        backend: "api" to partition with the Unstructured API, or "local" to partition in-process
+            with the unstructured library (no API calls; needs its document extras installed).
+        reprocess: Whether to partition documents that already have an up-to-date .json output.
 
+    Returns:
+        True if the documents were processed, False if Unstructured raised an error.
     """
+    # the ingest stack is heavy to import, so it is only loaded once there is something to partition
+    from unstructured_ingest.connector.local import SimpleLocalConfig
+    from unstructured_ingest.interfaces import (
+        PartitionConfig,
+        ProcessorConfig,
+        ReadConfig,
+    )
+    from unstructured_ingest.runner import LocalRunner
+
     try:
-        clear_directory(output_dir)
+        all_files = sorted(
+            name for name in os.listdir(input_dir)
+            if os.path.isfile(os.path.join(input_dir, name))
+        )
+        if files is None:
+            files = all_files
+
+        if not reprocess:
+            files = [name for name in files if not has_current_output(input_dir, output_dir, name)]
+        if not files:
+            logger.info("All documents already partitioned.")
+            return True
+
+        # a failed partition leaves any earlier output in place, so it is removed first;
+        # otherwise a changed document would be chunked from its previous version
+        for name in files:
+            output_file = partition_output_path(output_dir, name)
+            if os.path.isfile(output_file):
+                os.remove(output_file)
 
         doc_input_path = "./" + input_dir
         output_path = "./" + output_dir
 
+        if backend == "local":
+            partition_config = PartitionConfig(
+                partition_by_api=False,
+                strategy=PARTITION_STRATEGY,
+            )
+        else:
+            partition_config = PartitionConfig(
+                partition_by_api=True,
+                api_key=os.getenv("UNSTRUCTURED_API_KEY"),
+            )
+
         runner = LocalRunner(
             processor_config=ProcessorConfig(
                 verbose=True, # logs verbosity
                 output_dir=output_path, # the local directory to store outputs
-                num_processes=2,
+                # one worker process per document, up to one per core
+                num_processes=max(1, min(PARTITION_PROCESSES, len(files))),
+                reprocess=reprocess,
             ),
             read_config=ReadConfig(),
-            partition_config=PartitionConfig(
-                partition_by_api=True,
-                api_key=os.getenv("UNSTRUCTURED_API_KEY"),
-            ),
+            partition_config=partition_config,
             connector_config=SimpleLocalConfig(
                 input_path=doc_input_path, # where local documents reside
                 recursive=False, # whether to get the documents recursively from given directory
+                # only partition the requested files
+                file_glob=None if files == all_files else [f"*{os.sep}{glob.escape(name)}" for name in files],
             ),
         )
-        runner.run()
+        with span("partitioning", documents=len(files), backend=backend):
+            runner.run()
 
-        print(f"Successfully processed documents.")
+        logger.info("Successfully processed %d documents.", len(files))
+        return True
     except Exception as e:
-        print(f"Error processing documents with Unstructured: {e}")
+        logger.error("Error processing documents with Unstructured: %s", e)
+        return False
+
+def partition_output_path(output_dir, filename):
+    """Returns where the partitioned .json output of a document is written."""
+    return os.path.join(output_dir, filename + ".json")
+
+def has_current_output(input_dir, output_dir, filename):
+    """Checks whether a document's .json output exists and is newer than the document."""
+    output_file = partition_output_path(output_dir, filename)
+    return (
+        os.path.isfile(output_file)
+        and os.path.getmtime(output_file) >= os.path.getmtime(os.path.join(input_dir, filename))
+    )
+
+def file_sha256(filepath):
+    """Returns the sha256 hex digest of a file, reading it in blocks."""
+    digest = hashlib.sha256()
+    with open(filepath, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+def is_file_indexed(qdrant_store, collection, filename, file_hash, tenant=DEFAULT_TENANT):
+    """Checks whether the collection already holds this exact version of a tenant's file.
+
+    The file hash is only recorded once every chunk of the file has been stored, so a file
+    whose ingestion failed part way is not reported as indexed. The count is exact, since an
+    approximate one can be above zero when no point has the hash; the filename index keeps it cheap.
+    """
+    try:
+        result = qdrant_store.count(
+            collection_name=collection,
+            count_filter=models.Filter(
+                must=[
+                    tenant_condition(tenant),
+                    models.FieldCondition(key="metadata.filename", match=models.MatchValue(value=filename)),
+                    models.FieldCondition(key="metadata.file_hash", match=models.MatchValue(value=file_hash)),
+                ],
+            ),
+            exact=True,
+            shard_key_selector=shard_key(tenant),
+        )
+        return result.count > 0
+    except Exception as e:
+        logger.warning("Error checking for indexed file %s: %s", filename, e)
+        return False
+
+def set_file_hash(qdrant_store, collection, filename, file_hash, tenant=DEFAULT_TENANT):
+    """Records file_hash on every stored point of a tenant's file; None marks the file as not fully stored."""
+    qdrant_store.set_payload(
+        collection_name=collection,
+        payload={"file_hash": file_hash},
+        points=models.Filter(
+            must=[
+                tenant_condition(tenant),
+                models.FieldCondition(key="metadata.filename", match=models.MatchValue(value=filename)),
+            ],
+        ),
+        key="metadata",
+        shard_key_selector=shard_key(tenant),
+    )
+
+def chunk_point_id(filename, content, occurrence=0, tenant=DEFAULT_TENANT):
+    """Derives a deterministic point ID from the tenant, the filename and the chunk text.
+
+    Args:
+        filename: The source document the chunk came from.
+        content: The chunk text.
+        occurrence: How many identical chunks precede this one in the same file.
+        tenant: The tenant the document belongs to, so equal filenames of different
+            tenants get different IDs. The default tenant keeps the IDs of points
+            stored before tenants existed.
+
+    Returns:
+        A UUIDv5 string that is stable across re-ingestion of unchanged text.
+    """
+    content_hash = hashlib.sha256(content.encode("utf-8")).hexdigest()
+    name = f"{filename}:{content_hash}:{occurrence}"
+    if tenant != DEFAULT_TENANT:
+        name = f"{tenant}/{name}"
+    return str(uuid.uuid5(POINT_ID_NAMESPACE, name))
+
+def get_point_ids_by_source_document(qdrant_store, collection, filename, tenant=DEFAULT_TENANT):
+    """Returns the IDs of every point stored for the given source document of a tenant."""
+    points_filter = models.Filter(
+        must=[
+            tenant_condition(tenant),
+            models.FieldCondition(
+                key="metadata.filename",
+                match=models.MatchValue(value=filename),
+            ),
+        ],
+    )
+
+    point_ids = set()
+    offset = None
+    while True:
+        records, offset = qdrant_store.scroll(
+            collection_name=collection,
+            scroll_filter=points_filter,
+            limit=256,
+            offset=offset,
+            with_payload=False,
+            with_vectors=False,
+            shard_key_selector=shard_key(tenant),
+        )
+        point_ids.update(str(record.id) for record in records)
+        if offset is None:
+            return point_ids
 
 def clear_directory(directory_path):
     try:
@@ -82,61 +317,86 @@ def clear_directory(directory_path):
             if os.path.isfile(file_path):
                 os.remove(file_path)
 
-        print("All files deleted successfully.")
+        logger.info("All files deleted successfully.")
     except OSError:
-        print("Error occurred while deleting files.")
+        logger.error("Error occurred while deleting files.")
+
+def iter_chunks(output_dir, files=None):
+    """Streams chunked elements from partitioned .json files, one file at a time.
 
-def process_chunks(output_dir):
+    Only a single file's elements are held in memory at once.
+
+    Args:
+        output_dir: The directory which the json files containing the smaller chunks are located.
+        files: The names of the original documents whose .json outputs are chunked, or None to chunk every output.
+
+    Yields:
+        Chunked elements, grouped by source file.
+    """
+    from unstructured.staging.base import elements_from_dicts
+    from unstructured.chunking.title import chunk_by_title
+
+    if files is None:
+        filepaths = [os.path.join(output_dir, filename) for filename in sorted(os.listdir(output_dir))]
+    else:
+        filepaths = [partition_output_path(output_dir, filename) for filename in files]
+
+    for file, filepath in enumerate(filepaths):
+        # documents that failed to partition have no output and are retried on the next run
+        if not os.path.isfile(filepath):
+            logger.warning("No partitioned output found at %s, skipping.", filepath)
+            continue
+
+        try:
+            with span("chunking", file=filepath):
+                with open(filepath, "rb") as f:
+                    elements = elements_from_dicts(orjson.loads(f.read()))
+
+                # chunk elements
+                chunked_elements = chunk_by_title(
+                    elements,
+                    max_characters=1000, # maximum for chunk size
+                    combine_text_under_n_chars=200, # combine chunks if too small
+                    multipage_sections=True,
+                )
+        except Exception as e:
+            logger.error("Error chunking json file %s: %s", filepath, e)
+            continue
+
+        logger.info("Document %d chunked into %d chunks.", file, len(chunked_elements))
+        yield from chunked_elements
+
+def process_chunks(output_dir, files=None):
 
     """Combines smaller chunks to create larger, formatted chunks.
 
     Args:
         output_dir: The directory which the json files containing the smaller chunks are located.
+        files: The names of the original documents whose .json outputs are chunked, or None to chunk every output.
 
     Returns:
         A list of chunked elements.
     """
-    # import element types based on number of filetypes
     try:
-        elements = []
-        element_lists = []
-
-        file = 0
-        for filename in os.listdir(output_dir):
-            filepath = os.path.join(output_dir, filename)
-            elements = elements_from_json(filepath)
-
-            # chunk elements
-            chunked_elements = chunk_by_title(
-                elements,
-                max_characters=1000, # maximum for chunk size
-                combine_text_under_n_chars=200, # combine chunks if too small
-                multipage_sections=True,
-            )
-
-            elem = 0
-            for element in chunked_elements:
-                elem += 1
-                print(f"File element {elem}: {element}\n\n")
-            element_lists.append(chunked_elements)
-            print(f"Document {file} chunked.")
-            file += 1
-
-        # flatten list
-        elements = [
-            element
-            for e_list in element_lists
-            for element in e_list
-        ]
-
-        # debugging!
-        print("Chunked Elements: ")
-        print([f"{element.text}\n" for element in elements])
-
-        print("Successfully combined .json chunks!")
+        elements = list(iter_chunks(output_dir, files))
+        logger.info("Successfully combined .json chunks!")
         return elements
     except Exception as e:
-            print(f"Error chunking json files: {e}")
+            logger.error("Error chunking json files: %s", e)
+
+def iter_documents(chunks):
+    """Streams chunks created using Unstructured as Langchain Documents."""
+    for chunk in chunks:
+        yield Document(
+            page_content=chunk.text,  # The chunk's text content
+            metadata=chunk.metadata.to_dict()
+        )
+
+def tag_file_hashes(docs, file_hashes):
+    """Records the hash of each document's source file in its metadata."""
+    for doc in docs:
+        doc.metadata['file_hash'] = file_hashes.get(doc.metadata.get('filename'))
+        yield doc
 
 def chunks_to_docs(chunks):
     """Converts chunks created using Unstructured to Langchain Documents.
@@ -148,92 +408,218 @@ def chunks_to_docs(chunks):
         A list of Langchain Documents.
     """
     try:
-        langchain_docs = []
-        for chunk in chunks:
-            doc = Document(
-                page_content=chunk.text,  # The chunk's text content
-                metadata=chunk.metadata.to_dict()
-            )
-            langchain_docs.append(doc)
-
-        return langchain_docs
+        return list(iter_documents(chunks))
     except Exception as e:
-        print(f"Error converting chunks to Langchain Documents: {e}")
+        logger.error("Error converting chunks to Langchain Documents: %s", e)
+
+def batched(iterable, batch_size):
+    """Yields lists of up to batch_size consecutive items from an iterable."""
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def embed_texts(texts: list[str], embedding_model, scheduler=None):
+    """Embeds texts in token-packed batches, paced to the embeddings rate limits.
 
-def store_chunks(chunks: list[Document], embedding_model, qdrant_store, collection):
-    """Transforms list of chunks to vectors and uploads them to the given qdrant vector store.
+    Args:
+        texts: The texts to embed.
+        embedding_model: The embedding model used to convert the texts into vectors.
+        scheduler: The EmbeddingScheduler the requests go through; defaults to the shared one.
+
+    Returns:
+        A list of vectors in the same order as the given texts.
+    """
+    return (scheduler or embedding_scheduler).embed(texts, embedding_model)
+
+def embed_texts_with_store(texts: list[str], embedding_model):
+    """Embeds texts, reusing vectors from the local embedding store where the text was embedded before.
 
     Args:
-        chunks: The list of chunks to be uploaded.
-        embedding_model: The embedding model used to convert the chunks into vectors.
-        qdrant_store: The qdrant store the vectors will be stored in.
+        texts: The texts to embed.
+        embedding_model: The embedding model used to convert the texts into vectors.
+
+    Returns:
+        A list of vectors in the same order as the given texts.
+    """
+    model_name = getattr(embedding_model, "model", type(embedding_model).__name__)
+    vectors = embedding_store.get_many(model_name, texts)
+    missing = [i for i, vector in enumerate(vectors) if vector is None]
+    logger.info("Embedding store: %d of %d chunks already embedded", len(texts) - len(missing), len(texts))
+
+    # identical texts within one run are only embedded once
+    missing_texts = list(dict.fromkeys(texts[i] for i in missing))
+    missing_vectors = embed_texts(missing_texts, embedding_model)
+    embedding_store.put_many(model_name, missing_texts, missing_vectors)
+
+    embedded = dict(zip(missing_texts, missing_vectors))
+    for i in missing:
+        vectors[i] = embedded[texts[i]]
+    return vectors
+
+def sync_file_chunks(filename, file_chunks: list[Document], qdrant_store, collection, tenant=DEFAULT_TENANT):
+    """Reconciles one file's chunks with the points already stored for it.
+
+    Stored chunks that no longer appear in the file are deleted, so only the returned chunks
+    still need uploading. The file's hash is cleared first; store_chunks records the new
+    one once the returned chunks have been upserted.
+
+    Args:
+        filename: The source document the chunks came from.
+        file_chunks: Every chunk of the current version of the file.
+        qdrant_store: The qdrant store the vectors are stored in.
+        collection: The collection the vectors are stored in.
+        tenant: The tenant the file belongs to.
+
+    Returns:
+        A list of (point ID, chunk) pairs for the chunks that are not stored yet.
+    """
+    # assign deterministic IDs
+    chunks_by_id = {}
+    for chunk in file_chunks:
+        occurrence = 0
+        chunk_id = chunk_point_id(filename, chunk.page_content, tenant=tenant)
+        while chunk_id in chunks_by_id:
+            occurrence += 1
+            chunk_id = chunk_point_id(filename, chunk.page_content, occurrence, tenant)
+        chunks_by_id[chunk_id] = chunk
+
+    existing_ids = get_point_ids_by_source_document(qdrant_store, collection, filename, tenant)
+    added_ids = [chunk_id for chunk_id in chunks_by_id if chunk_id not in existing_ids]
+    kept_ids = [chunk_id for chunk_id in chunks_by_id if chunk_id in existing_ids]
+    vanished_ids = list(existing_ids.difference(chunks_by_id))
+    logger.info("%s: %d new, %d unchanged, %d removed chunks", filename, len(added_ids), len(kept_ids), len(vanished_ids))
+
+    # the file is not fully stored again until its new chunks are upserted
+    if existing_ids:
+        set_file_hash(qdrant_store, collection, filename, None, tenant)
+
+    if vanished_ids:
+        qdrant_store.delete(
+            collection_name=collection,
+            points_selector=models.PointIdsList(points=vanished_ids),
+            shard_key_selector=shard_key(tenant),
+        )
+        lexical_index.delete(index_name(collection, tenant), vanished_ids)
+
+    # Summaries of re-ingested files were generated from their old contents
+    if added_ids or vanished_ids:
+        summary_cache.invalidate_source(tenant, filename)
+
+    return [(chunk_id, chunks_by_id[chunk_id]) for chunk_id in added_ids]
+
+def iter_new_points(chunks: Iterable[Document], qdrant_store, collection, tenant=DEFAULT_TENANT, synced_files=None):
+    """Streams the chunks that still need uploading, syncing each file as it is reached.
+
+    Args:
+        synced_files: Optionally a list that each file's (filename, file hash) is appended
+            to once the file has been synced, before its chunks are yielded.
+
+    Yields:
+        (point ID, chunk) pairs, with each chunk's set/totalSets/date_added/tenant metadata
+        filled in and its file hash left unset.
     """
     current_timestamp = datetime.now().isoformat()
+    seen_files = set()
+
+    for filename, file_chunks in groupby(chunks, key=lambda chunk: chunk.metadata.get('filename')):
+        if filename in seen_files:
+            raise ValueError(f"Chunks of {filename} must be contiguous.")
+        seen_files.add(filename)
+
+        file_chunks = list(file_chunks)
+        new_chunks = sync_file_chunks(filename, file_chunks, qdrant_store, collection, tenant)
+        if synced_files is not None:
+            synced_files.append((filename, file_chunks[0].metadata.get('file_hash')))
+
+        # divide large files across multiple point data buckets
+        max_set_size = 5
+        totalSets = math.ceil(len(new_chunks) / max_set_size) # records the number of buckets used
+
+        for i, (chunk_id, chunk) in enumerate(new_chunks):
+            metadata = chunk.metadata
+
+            # add metadata to track where the file is and how many buckets are used
+            metadata['set'] = i // max_set_size + 1
+            metadata['totalSets'] = totalSets
+
+            # Add "date added" to metadata
+            metadata['date_added'] = current_timestamp
+            metadata['tenant'] = tenant
+            metadata['file_hash'] = None
 
-    # Index chunks into Qdrant
-    points = []
-
-    # divide large files across multiple point data buckets
-    total_chunks = len(chunks)   
-    max_set_size = 5
-    totalSets = math.ceil(total_chunks/ max_set_size) # records the number of buckets used
-    setCount = 1 # tracks the bucket lable of the current bucket 
-    setSize = 0  # tracks the current size of the set
-
-    for i, chunk in enumerate(chunks):
-        print(f"Current File: {chunk.metadata['filename']}")
-        setSize += 1
-
-        # Extract content and metadata
-        content = chunk.page_content
-        metadata = chunk.metadata
-
-        # add metadata to track where the file is and how many buckets are used
-        metadata['set']  = setCount
-        metadata['totalSets']  = totalSets
-        
-        # Add "date added" to metadata
-        metadata['date_added'] = current_timestamp
-        
-        # Create vector for the chunk
-        vector = embedding_model.embed_documents([content])[0]
-        
-        # Generate a unique UUID for each chunk
-        chunk_id = str(uuid.uuid4())
-        
-        # Append point data
-        points.append({
-            "id": chunk_id,
-            "vector": vector,
-            "payload": {
-                "content": content,
-                "metadata": metadata
-            }
-        })
-
-        print(f"SetSize: {setSize}")
-
-        if setSize >= max_set_size:
-            # Empty the points bucket because it is full
-            qdrant_client.upsert(
+            yield chunk_id, chunk
+
+def store_chunks(chunks: Iterable[Document], embedding_model, qdrant_store, collection, progress=None, batch_size=UPSERT_BATCH_SIZE, tenant=DEFAULT_TENANT):
+    """Transforms chunks to vectors and uploads them to the given qdrant vector store.
+
+    Chunks are consumed as a stream: each file is synced incrementally (chunks get
+    deterministic IDs, only chunks that are not already stored are embedded and upserted,
+    and stored chunks that no longer appear in the file are deleted), and new chunks are
+    embedded and upserted batch_size at a time, so memory use does not grow with the corpus.
+    A file's hash is recorded on its points only after all of its chunks are upserted, so
+    is_file_indexed does not skip a file whose ingestion failed part way.
+
+    Args:
+        chunks: The chunks to be uploaded, as a list or iterator, grouped by source file.
+        embedding_model: The embedding model used to convert the chunks into vectors.
+        qdrant_store: The qdrant store the vectors will be stored in.
+        progress: Optionally called as progress(stage, done, total) during the embedding and upserting stages.
+        batch_size: The number of chunks embedded and upserted together.
+        tenant: The tenant the chunks are stored for; every point is tagged with it.
+    """
+    progress = progress or (lambda stage, done=None, total=None: None)
+    total_chunks = 0
+    ensure_tenant_shard(collection, tenant)
+
+    synced_files = []
+    recorded = 0
+
+    def record_stored_files(count):
+        nonlocal recorded
+        for filename, file_hash in synced_files[recorded:count]:
+            if file_hash:
+                set_file_hash(qdrant_store, collection, filename, file_hash, tenant)
+        recorded = max(recorded, count)
+
+    for batch in batched(iter_new_points(chunks, qdrant_store, collection, tenant, synced_files), batch_size):
+        # Create vectors, only calling the API for text not embedded before
+        progress("embedding", total_chunks, total_chunks + len(batch))
+        vectors = embed_texts_with_store([chunk.page_content for _, chunk in batch], embedding_model)
+
+        progress("upserting", total_chunks, total_chunks + len(batch))
+        with span("qdrant_upsert", size=len(batch)):
+            qdrant_store.upsert(
                 collection_name = collection,
-                points = points
+                points = [
+                    models.PointStruct(
+                        id=chunk_id,
+                        vector=vector,
+                        payload={
+                            "content": chunk.page_content,
+                            "metadata": chunk.metadata
+                        }
+                    )
+                    for (chunk_id, chunk), vector in zip(batch, vectors)
+                ],
+                shard_key_selector=shard_key(tenant),
             )
-            setCount += 1
-            points = [] 
-            setSize = 0  
-            print(f"Uploaded and indexed {setSize} chunks")
-    
-    # Perform the upsert operation
-    if len(points) > 0 :
-        qdrant_store.upsert(
-            collection_name = collection,
-            points = points
-    )
-    
-    print(f"Uploaded and indexed {len(chunks)} total chunks")
-
-def delete_points_by_source_document(input_dir, collection, filename: str, qdrant_only=False, **kwargs: any) -> None:
+        # keep the BM25 index in step with the collection
+        lexical_index.add(index_name(collection, tenant), [(chunk_id, chunk.metadata.get('filename'), chunk.page_content) for chunk_id, chunk in batch])
+        total_chunks += len(batch)
+        progress("upserting", total_chunks, total_chunks)
+        logger.debug("Uploaded and indexed %d chunks", len(batch))
+        # files are contiguous, so every file synced before the latest one has all its chunks upserted
+        record_stored_files(len(synced_files) - 1)
+
+    record_stored_files(len(synced_files))
+    logger.info("Uploaded and indexed %d new chunks", total_chunks)
+
+def delete_points_by_source_document(input_dir, collection, filename: str, qdrant_only=False, tenant=DEFAULT_TENANT, **kwargs: any) -> None:
     """Delete points from the collection associated with a specific source document, and delete that document from local storage.
 
     Args:
@@ -242,6 +628,7 @@ def delete_points_by_source_document(input_dir, collection, filename: str, qdran
         collection: The collection that points will be deleted from.
         filename: The ID of the source document whose associated vectors should be deleted.
         qdrant_only: Whether to only delete the given file from the qdrant database or from the entire system.
+        tenant: The tenant whose document is deleted; other tenants' documents with the same filename are kept.
     """
     try:
         if not qdrant_only:
@@ -256,6 +643,7 @@ def delete_points_by_source_document(input_dir, collection, filename: str, qdran
 
         points_filter = models.Filter(
             must=[
+                tenant_condition(tenant),
                 models.FieldCondition(
                     key="metadata.filename", 
                     match=models.MatchValue(value=filename),
@@ -263,14 +651,18 @@ def delete_points_by_source_document(input_dir, collection, filename: str, qdran
             ],
         )
 
-        qdrant_client.delete(
+        get_qdrant_client().delete(
             collection_name=collection,
             points_selector=models.FilterSelector(filter=points_filter),
+            shard_key_selector=shard_key(tenant),
         )
 
-        print("All points deleted successfully.")
+        lexical_index.delete_file(index_name(collection, tenant), filename)
+        summary_cache.invalidate_source(tenant, filename)
+
+        logger.info("All points deleted successfully.")
     except Exception as e:
-        print(f"Error removing points from qdrant: {e}")
+        logger.error("Error removing points from qdrant: %s", e)
 
 if __name__ == "__main__":
 #     upload_directory = "./uploads"
@@ -279,22 +671,18 @@ if __name__ == "__main__":
     input_dir = "uploads"
     output_dir = "output"
 
-    # Initialize Qdrant client
-    qdrant_client = QdrantClient(url='https://67be5618-eb3c-4be8-af45-490d7595393d.europe-west3-0.gcp.cloud.qdrant.io', 
-        api_key=os.getenv("QDRANT_API_KEY"))
-
-    # Initialize OpenAI Embeddings
-    embedding_model = OpenAIEmbeddings(openai_api_key=os.getenv("OPENAI_API_KEY"))
+    qdrant_client = get_qdrant_client()
+    embedding_model = get_ingestion_embedding_model()
 
     # to parse the documents and get the json file (can comment out once json files are created)
+    # use backend="local" to partition without the Unstructured API
     # preprocess_documents(input_dir, output_dir)
     
     # to convert the json data to chunks and then to langchain docs
     chunked_docs = process_chunks(output_dir)
     langchain_docs = chunks_to_docs(chunked_docs)
-    print("Langchain Docs: ")
     for i in range(len(langchain_docs)):
-        print(f"Doc {i}: {langchain_docs[i]}\n\n")
+        logger.debug("Doc %d: %s", i, langchain_docs[i])
     
     # to upload chunks to qdrant (must run with previous block of code)
     store_chunks(langchain_docs, embedding_model, qdrant_client, "test_collection")